@@ -57,6 +57,9 @@ class Evaluator():  # Do not inherit the one from the nnunet implementation sinc
         self.vit_type = vit_type.lower()
         self.ViT_task_specific_ln = ViT_task_specific_ln
 
+        # -- Set the flag if the cached validation batches should be used (see nnUNetTrainerMultiHead) -- #
+        self.cache_val_batches = getattr(self, 'cache_val_batches', False)
+
     def reinitialize(self, network, network_trainer, tasks_list_with_char, model_list_with_char, version=1, vit_type='base',
                      plans_identifier=default_plans_identifier, mixed_precision=True, extension='multihead', save_csv=True,
                      transfer_heads=False, use_vit=False, use_param_split=False, ViT_task_specific_ln=False, do_LSA=False, do_SPT=False):
@@ -210,6 +213,7 @@ class Evaluator():  # Do not inherit the one from the nnunet implementation sinc
             if output_path not in trainer.output_folder:
                 trainer.output_folder = join(output_path, 'fold_'+str(t_fold))
             trainer.csv = self.save_csv
+            trainer.cache_val_batches = self.cache_val_batches
             os.makedirs(trainer.output_folder, exist_ok=True)
                 
             # -- Adapt the already_trained_on with only the prev_trainer part since this is necessary for the validation part -- #
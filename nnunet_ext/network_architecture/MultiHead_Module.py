@@ -2,10 +2,22 @@
 #----------This class represents a Generic Module enabling multiple heads for any network.--------------#
 #########################################################################################################
 
-import copy
+import copy, weakref, torch
 from torch import nn
 from typing import Type
 from operator import attrgetter
+from collections import OrderedDict
+
+# -- Use torch.func if available, it replaces torch.nn.utils.stateless in newer torch versions -- #
+try:
+    from torch.func import functional_call as _functional_call
+except ImportError:
+    from torch.nn.utils.stateless import functional_call as _functional_call
+
+class _FanOutError(Exception):
+    r"""This exception is raised if the heads of a MultiHead_Module can not be fanned out on a single forward pass.
+    """
+    pass
 
 class MultiHead_Module(nn.Module):
     r"""This class is a Module that can be used for any task where multiple heads using a shared body
@@ -13,7 +25,8 @@ class MultiHead_Module(nn.Module):
         corresponding head/module. This class can be used for any network, since the network class object
         needs to be provided as well.
     """
-    def __init__(self, class_object: Type[nn.Module], split_at, task, prev_trainer=None, *args, **kwargs):
+    def __init__(self, class_object: Type[nn.Module], split_at, task, prev_trainer=None, *args, share_parameters=False,
+                 cache_budget_mb=0, **kwargs):
         r"""Constructor of the Module for multiple heads. 
             :param class_object: This is the class (network) that should be used, ie. that will be split. This needs to
                                  be a class inheriting nn.Module, where the .forward() method is implemented, since this
@@ -28,6 +41,13 @@ class MultiHead_Module(nn.Module):
                                     class when performing an initialization. NOTE: This needs to be done correctly, since
                                     if it is not, class_object has missing/too much positional arguemnts and will fail during
                                     runtime in initialization. This is only necessary when prev_trainer is not provided or None.
+            :param share_parameters: If set, self.body and the head of the active task are not copies but reference the modules
+                                     of the running model (self.model), ie. all three share the same parameter storage. In this
+                                     mode there is nothing to re-split after a backward pass so self.update_after_iteration(..)
+                                     becomes a no-op. Only the inactive heads own their parameters.
+            :param cache_budget_mb: Memory budget in MB for the LRU cache of assembled task views. If a task is assembled
+                                    a second time while the body and its head did not change, the cached view is loaded
+                                    instead of assembling the model again. Set it to 0 to disable the cache.
             NOTE: The model that can be accessed using self.model represents the running model, and is of the same type as 
                   class_object. 'self' btw is a MultiHead_Module consisting of a body (self.body), heads (self.heads) and
                   the running model (self.model) based on the activated task (self.active_task). When training on a new task
@@ -45,6 +65,19 @@ class MultiHead_Module(nn.Module):
         # -- Store the class_object -- #
         self.class_object = class_object
 
+        # -- Store the flag if the body and active head should share the parameters with the running model -- #
+        self.share_parameters = share_parameters
+
+        # -- Define the LRU cache of assembled task views along with its budget and counters -- #
+        # -- NOTE: The body version is increased whenever the body changes so outdated views are not used -- #
+        self._view_cache = OrderedDict()
+        self._body_version = 0
+        self.cache_budget_mb = cache_budget_mb
+        self.cache_hits, self.cache_misses = 0, 0
+
+        # -- Flag if forward_all_heads can fan out the heads on a single pass, None until it has been tried -- #
+        self._fan_out_heads = None
+
         # -- If no model is provided, initialize one -- #
         if prev_trainer is None:
             # -- Initialize a conventional network using the provided class_object -- #
@@ -124,6 +157,10 @@ class MultiHead_Module(nn.Module):
         # -- Now the body is not freezed anymore and we made sure of that -- #
         self.body_freezed = False
 
+        # -- Let the body and the active head reference the modules of the running model if desired -- #
+        if self.share_parameters:
+            self.bind_to_model()
+
     def forward(self, x):
         r"""Forward pass during training --> task needs to be specified before calling forward.
             Assemble the model before callinng this function.
@@ -136,6 +173,223 @@ class MultiHead_Module(nn.Module):
         # -- Return the forward result generated by Generic_UNet.forward -- #
         return res
 
+    def forward_all_heads(self, x, tasks=None):
+        r"""This function performs a forward pass of x for every head in tasks while the shared body is only computed once.
+            The running model is used as it is, ie. nothing is assembled. Every outermost module of the head is hooked, so
+            when it is called with the output of the body, the corresponding module of every head in tasks is applied to it
+            and the results are concatenated along the batch dimension. The rest of the forward pass, eg. building the deep
+            supervision outputs, is then done for all heads at once and the outputs are split per task at the end.
+            Head modules without parameters and buffers are the same for every head and are not fanned out. This only works
+            if the outputs of the heads are not fed back into the body or into other head modules. If this is not the case,
+            eg. for splits within the encoder or if the ViT uses task specific LayerNorms, the full model is computed for
+            every head using the parameters of the head (functional_call) instead.
+            :param x: The input that is used for every head
+            :param tasks: List of task names of the heads that should be used. If None, every head is used.
+            :return: An OrderedDict with the task names as keys and the corresponding outputs (like forward) as values
+            NOTE: In training mode, random modules of the body (eg. dropout) are only sampled once for all heads.
+        """
+        # -- Use every head if no tasks are provided -- #
+        if tasks is None:
+            tasks = list(self.heads.keys())
+        for task in tasks:
+            assert task in self.heads.keys(),\
+                "The provided task \'{}\' is not a known head, so either initialize the task or provide one that already exists: {}.".format(task, list(self.heads.keys()))
+
+        # -- Fan out the heads on a single pass if this has not failed for the split before -- #
+        # -- NOTE: With task specific LayerNorms the output of the ViT (body) depends on the task -- #
+        vit = getattr(self.model, 'ViT', None)
+        task_specific_ln = getattr(vit, 'task_specific_ln', False)
+        if len(tasks) > 1 and not task_specific_ln and self._fan_out_heads is not False:
+            if self._fan_out_heads is None:
+                self._fan_out_heads = self._can_fan_out(x, tasks)    # --> Only checked once since the structure of the split does not change
+            if self._fan_out_heads:
+                try:
+                    return self._fan_out_forward(x, tasks)
+                except _FanOutError:
+                    self._fan_out_heads = False
+
+        # -- Compute the full model for every head -- #
+        res = OrderedDict()
+        prev_vit_task = getattr(vit, 'task_name_use', None)
+        try:
+            for task in tasks:
+                if task_specific_ln:
+                    vit.use_task(task)
+                res[task] = self._head_forward(x, task)
+        finally:
+            # -- Select the previously used LNs again -- #
+            if task_specific_ln and prev_vit_task is not None:
+                vit.use_task(prev_vit_task)
+        return res
+
+    def _head_forward(self, x, task):
+        r"""This function performs a forward pass of x through the running model using the parameters and buffers of the
+            head of task instead of the ones of the active head. The running model itself is not changed.
+            :param x: The input of the model
+            :param task: Task name of the head that should be used
+            :return: The output of the model (like forward)
+        """
+        # -- The running model holds the (latest) parameters of the active head -- #
+        if task == self.active_task:
+            return self.forward(x)
+        # -- The head uses the paths of self.model, so its parameters replace the ones of the active head -- #
+        head = self.heads[task]
+        tensors = OrderedDict(head.named_parameters())
+        tensors.update(head.named_buffers())
+        return _functional_call(self.model, tensors, (x,))
+
+    def _head_module_forward(self, module, path, task, inputs):
+        r"""This function applies module of the running model to inputs using the parameters and buffers of the
+            corresponding module of the head of task. This way the module runs in the mode (train/eval) of the running model.
+            :param module: The module of the running model at path
+            :param path: Path to the module in dot notation
+            :param task: Task name of the head that should be used
+            :param inputs: The inputs of the module
+            :return: The output of the module
+        """
+        head_module = attrgetter(path)(self.heads[task])
+        tensors = OrderedDict(head_module.named_parameters())
+        tensors.update(head_module.named_buffers())
+        return _functional_call(module, tensors, inputs)
+
+    def _can_fan_out(self, x, tasks):
+        r"""This function checks if the heads can be fanned out for the split, ie. if the output of the head is never fed
+            back into the body, eg. concatenated with a skip connection. For this, the fanned out forward pass is performed
+            once on a single sample without gradients in eval mode. Operations outside of modules, like the concatenation
+            with a skip connection, fail with a RuntimeError for the fanned out batch. Such an error is only attributed to
+            the fan out if the forward pass of the model works on the same sample, otherwise it is raised.
+            :param x: An input of the model, only its first sample is used
+            :param tasks: List of task names of the heads that should be used
+            :return: True if the heads can be fanned out, False otherwise
+        """
+        modes = {module: module.training for module in self.model.modules()}
+        self.model.eval()
+        try:
+            with torch.no_grad():
+                try:
+                    self._fan_out_forward(x[:1], tasks)
+                    return True
+                except _FanOutError:
+                    return False
+                except RuntimeError as error:
+                    if 'out of memory' in str(error):
+                        raise
+                    # -- Raises the error if it is not caused by the fan out -- #
+                    self.forward(x[:1])
+                    return False
+        finally:
+            for module, mode in modes.items():
+                module.training = mode
+
+    def _fan_out_forward(self, x, tasks):
+        r"""This function performs a single forward pass of x through the running model in which the outermost modules of
+            the head are replaced by the ones of every head in tasks using forward hooks. A _FanOutError is raised if the
+            output of a head is fed back into the body or into another head module.
+            :param x: The input that is used for every head
+            :param tasks: List of task names of the heads that should be used
+            :return: An OrderedDict with the task names as keys and the corresponding outputs (like forward) as values
+        """
+        batch, nr_tasks = x.size(0), len(tasks)
+
+        def _fanned_out(inputs):
+            # -- Inputs with the batch size of all heads are derived from the output of a head -- #
+            return any(torch.is_tensor(t) and t.dim() > 0 and t.size(0) == batch * nr_tasks for t in inputs)
+
+        def _check_body(module, inputs):
+            if _fanned_out(inputs):
+                raise _FanOutError()
+
+        in_head = [False]   # --> The hook is called again when the module is applied with the parameters of another head
+        def _fan_out(path):
+            def _hook(module, inputs, output):
+                if in_head[0]:
+                    return None
+                if _fanned_out(inputs) or not torch.is_tensor(output):
+                    raise _FanOutError()
+                # -- The running model already computed the output of the active head -- #
+                in_head[0] = True
+                try:
+                    outputs = [output if task == self.active_task else self._head_module_forward(module, path, task, inputs) for task in tasks]
+                finally:
+                    in_head[0] = False
+                return torch.cat(outputs, dim=0)
+            return _hook
+
+        # -- Hook the outermost modules of the head and body, and always remove the hooks again -- #
+        # -- NOTE: Head modules without parameters and buffers (eg. upsampling) are the same for every head -- #
+        handles = list()
+        try:
+            for path in self._get_head_modules():
+                module = attrgetter(path)(self.model)
+                if len(list(module.parameters())) + len(list(module.buffers())) > 0:
+                    handles.append(module.register_forward_hook(_fan_out(path)))
+            for path in self._get_body_modules():
+                handles.append(attrgetter(path)(self.model).register_forward_pre_hook(_check_body))
+            output = self.forward(x)
+        finally:
+            for handle in handles:
+                handle.remove()
+
+        # -- Split the outputs per task, outputs that do not depend on the head are the same for every task -- #
+        def _split(out, idx):
+            if torch.is_tensor(out):
+                if out.dim() > 0 and out.size(0) == batch * nr_tasks:
+                    return out[idx * batch:(idx + 1) * batch]
+                if out.dim() > 0 and out.size(0) == batch:
+                    return out
+                raise _FanOutError()
+            if isinstance(out, (tuple, list)):
+                return type(out)(_split(o, idx) for o in out)
+            return out
+        return OrderedDict((task, _split(output, idx)) for idx, task in enumerate(tasks))
+
+    def _get_head_modules(self, model=None, parent=''):
+        r"""This function returns the paths of the outermost callable modules of the active head, ie. the modules that are
+            called during the forward pass of self.model. Containers like ModuleLists are not callable, so their children
+            are used instead.
+            :param model: The (sub-)module to search in, if None the head of the active task is used
+            :param parent: Path to the (sub-)module in dot notation
+            :return: A list of paths to the modules in dot notation
+        """
+        if model is None:
+            model = self.heads[self.active_task]
+        paths = list()
+        for name, module in model.named_children():
+            path = name if parent == '' else parent + '.' + name
+            if type(module).forward is nn.Module.forward:
+                paths.extend(self._get_head_modules(module, path))
+            else:
+                paths.append(path)
+        return paths
+
+    def _get_body_modules(self, model=None, parent='', head_keys=None):
+        r"""This function returns the paths of the outermost callable modules of self.model that only consist of body
+            parameters, ie. whose output does not depend on the active head. Containers like ModuleLists are not
+            callable, so their children are used instead.
+            :param model: The (sub-)module to search in, if None self.model is used
+            :param parent: Path to the (sub-)module in dot notation
+            :param head_keys: List of module paths of the active head, if None they are extracted
+            :return: A list of paths to the modules in dot notation
+        """
+        # -- Extract the module paths of the active head -- #
+        if model is None:
+            model = self.model
+        if head_keys is None:
+            head_keys = self._get_head_modules()
+
+        # -- Loop through the children and check if they contain any part of the head -- #
+        paths = list()
+        for name, module in model.named_children():
+            path = name if parent == '' else parent + '.' + name
+            if path in head_keys:
+                continue
+            is_body = not any(key.startswith(path + '.') for key in head_keys)
+            if is_body and type(module).forward is not nn.Module.forward:
+                paths.append(path)
+            else:
+                paths.extend(self._get_body_modules(module, path, head_keys))
+        return paths
+
     def update_after_iteration(self, model=None, update_body=True):
         r"""This function is used to update the head and body. This should be used after every backward pass
             of the network that is trained on.
@@ -143,7 +397,16 @@ class MultiHead_Module(nn.Module):
                           current head are updated.
             :param update_body: This boolean flag identifies if the body should be updated as well or only the
                                 head.
+            NOTE: If the parameters are shared with the running model, the body and active head are already up to date
+                  after the optimizer step, so nothing is done unless a different model is provided.
         """
+        # -- The cached views are outdated once the body or the active head changes -- #
+        self._invalidate_cache(None if update_body else self.active_task)
+
+        # -- Nothing to split since body and active head are views on self.model -- #
+        if self.share_parameters and (model is None or model is self.model):
+            return
+
         # -- If model is None set it to self.model -- #
         if model is None:
             model = self.model
@@ -336,26 +599,67 @@ class MultiHead_Module(nn.Module):
         assert task in self.heads.keys(),\
             "The provided task \'{}\' is not a known head, so either initialize the task or provide one that already exists: {}.".format(task, list(self.heads.keys()))
 
+        # -- Only swap the head part of the running model when parameters are shared, the body is already in place -- #
+        if self.share_parameters:
+            self._swap_shared_head(task)
+            return self._update_body_freeze(freeze_body)
+
+        # -- Detach the active head from the running model before another head is loaded into it -- #
+        self._detach_active_head()
+
+        # -- Load the cached assembled view if the body and head did not change since it has been cached -- #
+        state = self._get_cached_view(task)
+        if state is not None:
+            self.active_task = task
+            self.model.load_state_dict(state)
+            return self._update_body_freeze(freeze_body)
+
         # -- Extract the corresponding head based on the task -- #
         head = self.heads[task]
 
-        # -- Assemble the model based on self.body and head to update self.model afterwards -- #
-        assembled_model = nn.Module()
-        
-        # -- Add the full body to assembled_model with respect to its name -- #
-        for name, module in self.body.named_children():
-            assembled_model.add_module(name, module)
-
-        # -- Add all modules from the head based on their names to assembled_model -- #
-        assembled_model, _ = self._join_body_head_recursively(assembled_model, head, list())
+        # -- Assemble the state of the model based on self.body and head to update self.model afterwards -- #
+        # -- NOTE: Both use the full paths of self.model as keys. Do not join the modules themselves, since this -- #
+        # --       would place the modules of the head into the containers of self.body for nested splits -- #
+        # --       and the next assembled head would then be loaded into the modules of this head -- #
+        assembled_state = OrderedDict(self.body.state_dict())
+        assembled_state.update(head.state_dict())
 
         # -- Set the active_task -- #
         self.active_task = task
         
-        # -- Load the state_dict from the assembled model into self.model for updating the running model -- #
-        self.model.load_state_dict(assembled_model.state_dict())
-        del assembled_model
+        # -- Load the assembled state_dict into self.model for updating the running model -- #
+        self.model.load_state_dict(assembled_state)
+        del assembled_state
+
+        # -- Cache the assembled view so switching back to this task is cheap -- #
+        self._cache_view(task)
 
+        # -- Freeze or unfreeze the body and return the updated model -- #
+        return self._update_body_freeze(freeze_body)
+
+    def _detach_active_head(self):
+        r"""This function copies the head of the active task if it references the modules of the running model, which is
+            the case after self.model has been split, otherwise loading another head into self.model would change it as well.
+        """
+        # -- Nothing to do if no head is active or it does not share any parameter with the running model -- #
+        head = self.heads[self.active_task] if self.active_task in self.heads else None
+        if head is None:
+            return
+        model_params = set(id(param) for param in self.model.parameters())
+        if not any(id(param) in model_params for param in head.parameters()):
+            return
+
+        # -- Copy the head, the copy is identical so a cached view of the task stays valid -- #
+        self.heads[self.active_task] = copy.deepcopy(head)
+        view = self._view_cache.get(self.active_task, None)
+        if view is not None and view['head']() is head:
+            view['head'] = weakref.ref(self.heads[self.active_task])
+
+    def _update_body_freeze(self, freeze_body):
+        r"""This function freezes or unfreezes the body of the running model based on freeze_body and self.body_freezed.
+            :param freeze_body: Specify if the body weights should be freezed or not.
+            :return: Function returns the running model (self.model)
+        """
         # -- Freeze the body if desired and not freezed -- #
         if freeze_body and not self.body_freezed:
             # -- Freeze all body weights -- #
@@ -373,6 +677,170 @@ class MultiHead_Module(nn.Module):
         # -- Return the updated model since it might be used in a calling function (inheritance) -- #
         return self.model
 
+    def _get_cached_view(self, task):
+        r"""This function returns the cached state_dict of the assembled model for task if it exists and is still valid,
+            ie. neither the body nor the head of the task changed since it has been cached. Otherwise None is returned.
+            :param task: Task name of the head that should be joined with the body.
+            :return: The cached state_dict or None
+        """
+        # -- Nothing to do if the cache is disabled -- #
+        if self.cache_budget_mb <= 0:
+            return None
+
+        # -- Check that the view exists and that body and head are the same as at the time of caching -- #
+        view = self._view_cache.get(task, None)
+        if view is not None and view['body_version'] == self._body_version and view['head']() is self.heads[task]:
+            # -- Mark the view as most recently used -- #
+            self._view_cache.move_to_end(task)
+            self.cache_hits += 1
+            return view['state']
+
+        # -- The view does not exist or is outdated -- #
+        self._view_cache.pop(task, None)
+        self.cache_misses += 1
+        return None
+
+    def _cache_view(self, task):
+        r"""This function stores a copy of the state_dict of the running model as assembled view for task. Least recently
+            used views are removed until the view fits into the budget. If the view does not fit at all, it is not cached.
+            :param task: Task name of the head that is currently assembled with the body.
+        """
+        # -- Nothing to do if the cache is disabled -- #
+        if self.cache_budget_mb <= 0:
+            return
+
+        # -- Copy the current state and calculate its size in MB -- #
+        state = OrderedDict((k, v.detach().clone()) for k, v in self.model.state_dict().items())
+        size_mb = sum(v.nelement() * v.element_size() for v in state.values()) / 1024**2
+        if size_mb > self.cache_budget_mb:
+            return
+
+        # -- Remove the least recently used views until the new one fits -- #
+        while len(self._view_cache) > 0 and self._get_cache_size() + size_mb > self.cache_budget_mb:
+            self._view_cache.popitem(last=False)
+
+        # -- Store the view along with the body version and a weak reference to the head -- #
+        self._view_cache[task] = {'state': state, 'size_mb': size_mb, 'body_version': self._body_version,
+                                  'head': weakref.ref(self.heads[task])}
+
+    def _get_cache_size(self):
+        r"""This function returns the size of all cached views in MB.
+        """
+        return sum(view['size_mb'] for view in self._view_cache.values())
+
+    def _invalidate_cache(self, task=None):
+        r"""This function removes outdated views from the cache. If task is None the body changed, so all views are
+            outdated, otherwise only the view of the provided task.
+            :param task: Task name of the head that changed or None if the body changed
+        """
+        if task is None:
+            # -- Increase the body version so no view that has been cached before will be used -- #
+            self._body_version += 1
+            self._view_cache.clear()
+        else:
+            self._view_cache.pop(task, None)
+
+    def clear_cache(self):
+        r"""This function removes all assembled views from the cache, the hit and miss counters are kept.
+        """
+        self._invalidate_cache(None)
+
+    def set_cache_budget(self, cache_budget_mb):
+        r"""This function sets the memory budget of the cache in MB and removes the least recently used views
+            that do not fit anymore. Set it to 0 to disable the cache.
+            :param cache_budget_mb: Memory budget in MB for the cache of assembled task views
+        """
+        self.cache_budget_mb = cache_budget_mb
+        while len(self._view_cache) > 0 and self._get_cache_size() > self.cache_budget_mb:
+            self._view_cache.popitem(last=False)
+
+    def get_cache_info(self):
+        r"""This function returns the hit and miss counters along with the number of cached views, their size and
+            the budget in MB, eg. for monitoring purposes.
+        """
+        return {'hits': self.cache_hits, 'misses': self.cache_misses, 'views': list(self._view_cache.keys()),
+                'size_mb': self._get_cache_size(), 'budget_mb': self.cache_budget_mb}
+
+    def load_state_dict(self, *args, **kwargs):
+        r"""Clear the cache before loading a state_dict, since the cached views might be outdated afterwards.
+        """
+        self.clear_cache()
+        return super().load_state_dict(*args, **kwargs)
+
+    def _swap_shared_head(self, task):
+        r"""This function is only used when the parameters are shared. It detaches the head of the currently active
+            task from the running model by giving it its own copy of the parameters, loads the parameters of the head
+            for task into the head part of self.model and lets this head reference the modules of self.model.
+            This way switching a head costs one copy of the head and not of the whole network.
+            :param task: Task name of the head that should be joined with the body.
+        """
+        # -- Nothing to swap if the task is already active -- #
+        if task == self.active_task:
+            return
+
+        # -- The outgoing head gets its own storage again, otherwise loading the new head would overwrite it -- #
+        if self.active_task in self.heads:
+            self.heads[self.active_task] = copy.deepcopy(self.heads[self.active_task])
+
+        # -- The heads use the same module paths as self.model, so the state_dict can be loaded directly -- #
+        _, unexpected = self.model.load_state_dict(self.heads[task].state_dict(), strict=False)
+        assert len(unexpected) == 0,\
+            "The head \'{}\' does not map onto the running model, unexpected keys: {}.".format(task, unexpected)
+
+        # -- Let the new head reference the modules of the running model and set the active_task -- #
+        self._bind_module_to_model(self.heads[task])
+        self.active_task = task
+
+    def bind_to_model(self):
+        r"""This function splits the running model (self.model) into body and the head of the active task and lets both
+            reference the modules of self.model instead of copies, ie. the parameters of self.body, self.heads[self.active_task]
+            and self.model share the same storage. Call this after self.model has been replaced, e.g. when new task
+            specific LNs are registered in the ViT. Calling this function activates the share_parameters mode.
+        """
+        # -- From now on the parameters are shared, the cache is not used in this mode -- #
+        self.share_parameters = True
+        self.clear_cache()
+
+        # -- Split the model using new containers, since the defaults of the recursive function are shared objects -- #
+        body, head, _, _ = self._split_model_recursively_into_body_head(layer_id=0, model=self.model, body=nn.Module(),
+                                                                         head=nn.Module(), parent=list())
+
+        # -- Replace the copied modules with the ones from the running model -- #
+        self.body = self._bind_module_to_model(body)
+        self.heads[self.active_task] = self._bind_module_to_model(head)
+
+    def _bind_module_to_model(self, module, parents=list()):
+        r"""This function replaces all modules in module (body or head) with the modules from self.model that are located
+            at the same path. Containers that hold only a part of the corresponding container in self.model (the split
+            point) are walked recursively and only their children, parameters and buffers are replaced.
+            :param module: The body or a head whose module paths map onto self.model
+            :param parents: List of strings representing the path to module in self.model
+            :return: The updated module that references the modules from self.model
+        """
+        # -- Loop through the children and replace or walk them -- #
+        for name, child in list(module.named_children()):
+            path = [*parents, name]
+            try:
+                model_child = attrgetter('.'.join(path))(self.model)
+            except AttributeError:
+                continue    # --> Part is not in the running model, ie. nothing to share
+            # -- If the child is a complete copy of the module in the model, simply reference the one from the model -- #
+            if type(child) is type(model_child) and\
+               [n for n, _ in child.named_children()] == [n for n, _ in model_child.named_children()]:
+                setattr(module, name, model_child)
+            else:
+                # -- Child is only a part of the model module so share its own parameters and buffers and go deeper -- #
+                for p_name in list(child._parameters.keys()):
+                    if p_name in model_child._parameters:
+                        child._parameters[p_name] = model_child._parameters[p_name]
+                for b_name in list(child._buffers.keys()):
+                    if b_name in model_child._buffers:
+                        child._buffers[b_name] = model_child._buffers[b_name]
+                self._bind_module_to_model(child, path)
+
+        # -- Return the module that is now bound to self.model -- #
+        return module
+
     def _set_requires_grad(self, requires_grad):
         r"""This function is used to freeze/unfreeeze all layers in the body so when training, the body weights are/ are not
             changed during backpropagation.
@@ -391,44 +859,6 @@ class MultiHead_Module(nn.Module):
                 # -- Set requires_grad accordingly -- #
                 param.requires_grad = requires_grad
 
-    def _join_body_head_recursively(self, body, head, parents=list()):
-        r"""This function is used to join a body with a head in a recursive manner. This function
-            is only used internally when assembling a model given a specific task.
-        """
-        # -- Loop through the modules in the head -- #
-        for name, module in head.named_children():
-            # -- If there are still children left, go recursive -- #
-            if len(list(module.children())) > 0:
-                # -- Try to access the module in the body -- #
-                try:
-                    # -- If it does exist, than move on as used to -- #
-                    _ = attrgetter('.'.join([*parents, name]))(body)
-                except:
-                    # -- NOTE: The modules from the head do not exist in body so simply set the modules at the right position -- #
-                    if len(parents) > 0:
-                        # -- We are in a deeper layer so use the tracked path to add the module at correct position -- #
-                        setattr(attrgetter('.'.join(parents))(body), name, module)
-                    else:
-                        # -- No parent exist, ie. first layer, than just add the module -- #
-                        setattr(body, name, module)
-
-                # -- Add the current name into parents to keep track of the path -- #
-                parents.append(name)
-
-                # -- Go one layer deeper -- #
-                body, parents = self._join_body_head_recursively(body, module, parents)
-
-            else:
-                if len(parents) > 0:
-                    # -- We are in a deeper layer so use the tracked path to add the module at correct position -- #
-                    setattr(attrgetter('.'.join(parents))(body), name, module)
-                else:
-                    # -- No parent exist, ie. first layer, than just add the module -- #
-                    setattr(body, name, module)
-
-        # -- Return the updated body, head and parent without the current node -- #
-        return body, parents[:-1]
-    
     def add_new_task(self, task, use_init, model=None):
         r"""Use this function to add the initial module from on the first split.
             Specify the task name with which it will be registered in the ModuleDict.
@@ -439,10 +869,14 @@ class MultiHead_Module(nn.Module):
                   a model, than ensure that it works with the forward function from the
                   class_object. If this does not map than an error will be thrown later on.
         """
+        # -- A cached view of an existing task with the same name is outdated -- #
+        self._invalidate_cache(task)
+
         # -- Create a new task in self.heads with the module from the first split -- #
         if model is None:
-            # -- Add the latest task -- #
-            self.heads[task] = self.heads[list(self.heads.keys())[-1]]
+            # -- Add the latest task, copy it, otherwise the new head would reference the modules of the latest head -- #
+            # -- (or of the running model if the parameters are shared) and loading the initial state would change them -- #
+            self.heads[task] = copy.deepcopy(self.heads[list(self.heads.keys())[-1]])
             
             if use_init:
                 # -- Load the state_dict from the very first split -- #
@@ -475,8 +909,9 @@ class MultiHead_Module(nn.Module):
         if remove_old_tasks:
             for task in list(self.heads.keys()):
                 if task not in list_of_tasks:
-                    # -- Remove it from the head -- #
+                    # -- Remove it from the head and the cache -- #
                     del self.heads[task]
+                    self._invalidate_cache(task)
 
         # -- Assemble the model based on activate_with -- #
         self.assemble_model(activate_with)
@@ -504,6 +939,10 @@ class MultiHead_Module(nn.Module):
         # -- Check that heads are of desired instance -- #
         assert isinstance(heads, nn.ModuleDict), "Provided heads are not a nn.ModuleDict."
 
+        # -- The cached views are outdated for the provided heads -- #
+        for task in (list(self.heads.keys()) if reset else list(heads.keys())):
+            self._invalidate_cache(task)
+
         # -- Reset or update the head based on the reset flag -- #
         if reset:
             # -- Reset the heads -- #
@@ -512,6 +951,11 @@ class MultiHead_Module(nn.Module):
         else:
             # -- Update the heads without clearing it -- #
             self.heads.update(heads)
+
+        # -- Load the new active head into the running model and share the parameters again if desired -- #
+        if self.share_parameters and self.active_task in self.heads:
+            self.model.load_state_dict(self.heads[self.active_task].state_dict(), strict=False)
+            self._bind_module_to_model(self.heads[self.active_task])
         
     def set_body(self, body):
         r"""This function updates the Module representing the body of the model. 
@@ -520,9 +964,15 @@ class MultiHead_Module(nn.Module):
         # -- Check that body is of desired instance -- #
         assert isinstance(body, nn.Module), "Provided body is not a nn.Module.."
 
-        # -- Update the body -- #
+        # -- Update the body and invalidate all cached views -- #
         del self.body
         self.body = copy.deepcopy(body)
+        self._invalidate_cache(None)
+
+        # -- Load the new body into the running model and share the parameters again if desired -- #
+        if self.share_parameters:
+            self.model.load_state_dict(self.body.state_dict(), strict=False)
+            self._bind_module_to_model(self.body)
 
     def get_model_type(self):
         r"""Simply return the running models object type which is the same
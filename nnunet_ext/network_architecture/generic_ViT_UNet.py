@@ -2,10 +2,9 @@
 #----------This class represents a Generic ViT_U-Net model based on the ViT and nnU-Net architecture----------#
 ###############################################################################################################
 
-import torch
+import math, torch
 import numpy as np
 from torch import nn
-from torch.autograd import Variable
 from nnunet.utilities.to_torch import to_cuda
 from nnunet.utilities.nd_softmax import softmax_helper
 from nnunet_ext.utilities.helpful_functions import commDiv
@@ -13,6 +12,78 @@ from nnunet.network_architecture.initialization import InitWeights_He
 from nnunet.network_architecture.generic_UNet import ConvDropoutNormNonlin, Generic_UNet
 from nnunet_ext.network_architecture.vision_transformer import PatchEmbed, VisionTransformer
 
+# -- The three ViT type architecture variants based on original paper as shown here:
+# -- https://arxiv.org/pdf/2010.11929.pdf or https://theaisummer.com/vision-transformer/ -- #
+VIT_TYPES = {'base': {'embed_size': 768, 'head': 12, 'layers': 12},
+             'large': {'embed_size': 1024, 'head': 16, 'layers': 24},
+             'huge': {'embed_size': 1280, 'head': 16, 'layers': 32}}
+
+def _output_size(module, size):
+    r"""This function computes the output size of module analytically from the hyperparameters (kernel sizes, strides,
+        paddings, scale factors) of its convolution, pooling and upsampling layers, which are applied in the order they are
+        registered in, as it is the case for the stages of the Generic_UNet. All other layers do not change the size.
+        :param module: The module, eg. a stage of conv_blocks_context or an upsampling operation of tu
+        :param size: The input size as list [channels, *spatial dimensions] without the batch dimension
+        :return: The output size as list [channels, *spatial dimensions]
+    """
+    for m in module.modules():
+        channels, spatial = size[0], size[1:]
+        expand = lambda v: list(v) if isinstance(v, (tuple, list)) else [v] * len(spatial)
+        if isinstance(m, (nn.Conv2d, nn.Conv3d)):
+            spatial = [(n + 2 * p - d * (k - 1) - 1) // s + 1 for n, k, s, p, d in
+                       zip(spatial, expand(m.kernel_size), expand(m.stride), expand(m.padding), expand(m.dilation))]
+            channels = m.out_channels
+        elif isinstance(m, (nn.ConvTranspose2d, nn.ConvTranspose3d)):
+            spatial = [(n - 1) * s - 2 * p + d * (k - 1) + o + 1 for n, k, s, p, d, o in
+                       zip(spatial, expand(m.kernel_size), expand(m.stride), expand(m.padding), expand(m.dilation), expand(m.output_padding))]
+            channels = m.out_channels
+        elif isinstance(m, (nn.MaxPool2d, nn.MaxPool3d, nn.AvgPool2d, nn.AvgPool3d)):
+            rnd = math.ceil if m.ceil_mode else math.floor
+            stride = m.stride if m.stride is not None else m.kernel_size
+            spatial = [int(rnd((n + 2 * p - d * (k - 1) - 1) / s)) + 1 for n, k, s, p, d in
+                       zip(spatial, expand(m.kernel_size), expand(stride), expand(m.padding), expand(getattr(m, 'dilation', 1)))]
+        elif hasattr(m, 'scale_factor') and hasattr(m, 'mode'):  # --> Upsample of torch or nnU-Net
+            if m.size is not None:
+                spatial = expand(m.size)
+            else:
+                spatial = [int(math.floor(n * f)) for n, f in zip(spatial, expand(m.scale_factor))]
+        size = [channels] + list(spatial)
+    return size
+
+def plan_shapes(network, input_channels, patch_size, decoder=False):
+    r"""This function plans the sizes of the skip connections, the bottleneck and the decoder outputs of a Generic_UNet
+        analytically, ie. the result is identical to pushing a sample of the patch size through the network, but without
+        any computation or memory.
+        :param network: The (built) Generic_UNet
+        :param input_channels: Number of input channels of the network
+        :param patch_size: The patch size, ie. the spatial size of the input
+        :param decoder: Set this flag to plan the output sizes of the decoder stages as well
+        :return: Tuple (skip_sizes, bottleneck_size, out_sizes) of torch.Size objects including the batch dimension,
+                 where out_sizes is None if decoder is not set
+    """
+    # -- Encoder: every stage results in a skip connection followed by the pooling (if not convolutional) -- #
+    size = [input_channels] + list(patch_size)
+    skip_sizes = list()
+    for d in range(len(network.conv_blocks_context) - 1):
+        size = _output_size(network.conv_blocks_context[d], size)
+        skip_sizes.append(torch.Size([1] + size))
+        if not network.convolutional_pooling:
+            size = _output_size(network.td[d], size)
+    size = _output_size(network.conv_blocks_context[-1], size)
+    bottleneck_size = torch.Size([1] + size)
+
+    # -- Decoder: upsampling, concatenation with the skip connection and localization -- #
+    out_sizes = None
+    if decoder:
+        out_sizes = list()
+        for u in range(len(network.tu)):
+            size = _output_size(network.tu[u], size)
+            skip = skip_sizes[-(u + 1)]
+            assert list(skip[2:]) == size[1:], "The upsampled size {} does not match the skip connection {}.".format(size[1:], list(skip[2:]))
+            size = _output_size(network.conv_blocks_localization[u], [size[0] + skip[1]] + size[1:])
+            out_sizes.append(torch.Size([1] + size))
+    return skip_sizes, bottleneck_size, out_sizes
+
 class Generic_ViT_UNet(Generic_UNet):
     r"""This class is a Module that can be used for any segmentation task. It represents a generic combination of the
         Vision Transformer (https://arxiv.org/pdf/2010.11929.pdf) and the generic U-Net architecture known as the
@@ -26,7 +97,7 @@ class Generic_ViT_UNet(Generic_UNet):
                  upscale_logits=False, convolutional_pooling=False, convolutional_upsampling=False,
                  max_num_features=None, basic_block=ConvDropoutNormNonlin, seg_output_use_bias=False,
                  vit_version='V1', vit_type='base', split_gpu=False, ViT_task_specific_ln=False, first_task_name=None,
-                 do_LSA=False, do_SPT=False):
+                 do_LSA=False, do_SPT=False, attn_backend='auto'):
         r"""This function represents the constructor of the Generic_ViT_UNet architecture. It basically uses the
             Generic_UNet class from the nnU-Net Framework as initialization since the presented architecture is
             based on this network. The vit_type needs to be set, which can be one of three possibilities:
@@ -44,7 +115,8 @@ class Generic_ViT_UNet(Generic_UNet):
             either way. When this flag is used, the user needs to provide the first tasks name as well to name the LN layers accordingly.
             If the user wants to use the proposed LSA or SPT methods from https://arxiv.org/pdf/2112.13492v1.pdf, the flags can be set. Note,
             one can set either one flag or both at the same time. --> This functionality is only provided for non task specific LNs and it
-            can not be combined with V4!
+            can not be combined with V4! attn_backend specifies how the attention in the ViT is computed, one of {'auto', 'sdpa', 'manual'},
+            where auto uses scaled_dot_product_attention on the GPU.
         """
         # -- Initialize using parent class --> gives us a generic U-Net we need to alter to create our combined architecture -- #
         super(Generic_ViT_UNet, self).__init__(input_channels, base_num_features, num_classes, num_pool, num_conv_per_stage,
@@ -63,11 +135,8 @@ class Generic_ViT_UNet(Generic_UNet):
         if self.split_gpu:
             assert torch.cuda.device_count() > 1, 'When trying to split the models on multiple GPUs, then please provide more than one..'
 
-        # -- Define the three ViT type architecture variants based on original paper as shown here:
-        # -- https://arxiv.org/pdf/2010.11929.pdf or https://theaisummer.com/vision-transformer/ -- #
-        self.ViT_types = {'base': {'embed_size': 768, 'head': 12, 'layers': 12},
-                          'large': {'embed_size': 1024, 'head': 16, 'layers': 24},
-                          'huge': {'embed_size': 1280, 'head': 16, 'layers': 32}}
+        # -- Use the three ViT type architecture variants based on original paper -- #
+        self.ViT_types = VIT_TYPES
         # -- Make sure the provided type is within the pre-defined bound -- #
         vit_type = vit_type.lower()
         assert vit_type in self.ViT_types, 'Please provide one of the following three types: \'base\', \'large\' or \'huge\'. You provided \'{}\''.format(vit_type)
@@ -82,56 +151,27 @@ class Generic_ViT_UNet(Generic_UNet):
         # -- Define the dictionary to use the correct version to prepare ViT input without doing al the ifs -- #
         self.prepare = {'V1': '_get_ViT_inputV1', 'V2': '_get_ViT_inputV2', 'V3': '_get_ViT_inputV3'}
         
-        # -- Simulate a run to extract the size of the skip connections, we need -- #
-        self.skip_sizes = list()
-        skips = list()
-        
-        # -- Define a random sample with the provided image size -- #
-        sample = torch.randint(3, tuple(self.img_size), dtype=torch.float).unsqueeze(0).unsqueeze(0)
-        # -- Define a padding -- #
-        padding = Variable(torch.zeros(1, 1, *self.img_size))
-        # -- If necessary add the padding until the number of channels is reached -- #
-        while sample.size()[1] != input_channels:
-            sample = torch.cat((sample, padding), 1)
-                
-        # -- Run through context network to get the skip connection sizes -- #
-        for d in range(len(self.conv_blocks_context) - 1):
-            sample = self.conv_blocks_context[d](sample)
-            self.skip_sizes.append(sample.size())
-            skips.append(sample)
-            if not self.convolutional_pooling:
-                sample = self.td[d](sample)
-
-        # -- Run through upsample network to get the final connection sizes --> only for V4 necessary -- #
-        if vit_version == 'V4':
-            self.out_sizes = list()
-            # -- Run through upsampling -- #
-            sample = self.conv_blocks_context[-1](sample)
-            for u in range(len(self.tu)):
-                sample = self.tu[u](sample)
-                sample = torch.cat((sample, skips[-(u + 1)]), dim=1)
-                sample = self.conv_blocks_localization[u](sample)
-                # -- Add this sample size --> necessary for ViT V4 -- #
-                self.out_sizes.append(sample.size())
+        # -- Plan the sizes of the skip connections (and the decoder outputs for V4) analytically, ie. without a forward pass -- #
+        self.skip_sizes, bottleneck_size, out_sizes = plan_shapes(self, input_channels, self.img_size, decoder=self.version == 'V4')
+        if self.version == 'V4':
+            self.out_sizes = out_sizes
 
         # -- Extract the necessary number of classes there are equal for V1 to V3 but not for V4 -- #
-        if vit_version == 'V4':
+        if self.version == 'V4':
             self.num_classesViT = list()
             for img_size in self.out_sizes:
                 self.num_classesViT.append(np.prod(img_size[1:]))    # --> V4: U-Net -- ViT -- Segmentation Head, so the dimension is equal to input of U-Net
         else:
-            num_classes_shape = list(self.conv_blocks_context[-1](sample).size())
-            self.num_classesViT = np.prod(num_classes_shape[1:])
-        del sample, skips
+            self.num_classesViT = np.prod(bottleneck_size[1:])
 
         # -- Determine the img_size of the feature map that should be used -- #
-        if vit_version == 'V4':
+        if self.version == 'V4':
             self.img_size = [list(size[1:]) for size in self.out_sizes]  # Remove batch dimension
         else:
             self.img_size = list(self.skip_sizes[self.use_skip][2:])
 
         # -- Calculate the patch dimension -- #
-        if vit_version == 'V4':
+        if self.version == 'V4':
             # -- Loop through img_size and extract patch_sizes and input channel -- #
             self.patch_size = list()
             self.in_chans = list()
@@ -152,7 +192,7 @@ class Generic_ViT_UNet(Generic_UNet):
             
         # -- Set img_depth -- #
         if len(patch_size) == 3:
-            if vit_version == 'V4':
+            if self.version == 'V4':
                 img_depth = [size[0] for size in self.img_size] # 3D
             else:
                 img_depth = [self.img_size[0]]
@@ -184,7 +224,8 @@ class Generic_ViT_UNet(Generic_UNet):
             'task_specific_ln': ViT_task_specific_ln,
             'task_name': first_task_name,
             'is_LSA': do_LSA,
-            'is_SPT': do_SPT
+            'is_SPT': do_SPT,
+            'attn_backend': attn_backend
             }
 
         # -- Initialize ViT generically -- #
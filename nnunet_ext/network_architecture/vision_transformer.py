@@ -3,7 +3,8 @@
 ###############################################################################################################
 
 import math, torch
-from torch import nn, einsum
+from torch import nn
+import torch.nn.functional as F
 from einops import rearrange
 from functools import partial
 from timm.models.layers.mlp import Mlp
@@ -13,6 +14,10 @@ from timm.models.vision_transformer import Attention as AttentionTimm
 from timm.models.layers.patch_embed import PatchEmbed as PatchEmbed2D
 from timm.models.vision_transformer import VisionTransformer as VisionTransformer2D
 
+# -- Supported backends of the attention, auto uses scaled_dot_product_attention on the GPU if the torch version provides it -- #
+ATTENTION_BACKENDS = ['auto', 'sdpa', 'manual']
+_HAS_SDPA = hasattr(F, 'scaled_dot_product_attention')
+
 class PatchEmbed(PatchEmbed2D):
     r"""This class represents the three and two dimensional Patch Embedding based on the
         two dimensional one from the timm module.
@@ -51,10 +56,9 @@ class PatchEmbed(PatchEmbed2D):
 
         # -- If task specific norms, than do this for the patch embeddings as well -- #
         if task_specific_ln:
-            self.norm = nn.ModuleDict()
-            self.norm[task_name] = norm_layer(embed_dim) if norm_layer else nn.Identity()
+            self.norm = TaskLayerNorm(embed_dim, task_name, norm_layer)
 
-    def forward(self, x, task_name):
+    def forward(self, x, task_name=None):
         r"""Represents the forward mechanism when called PatchEmbed(...)(x)."""
         # -- Copied from timm module -- #
         if self.embed2D:
@@ -71,40 +75,124 @@ class PatchEmbed(PatchEmbed2D):
         if self.flatten:
             x = x.flatten(2).transpose(1, 2)
         if self.task_specific_ln:
-            x = self.norm[task_name](x)
+            x = self.norm(x, task_name)
         else:
             x = self.norm(x)
         # -- Copied from timm module -- #
 
         return x
 
+class TaskLayerNorm(nn.Module):
+    r"""This class represents task specific LayerNorms in one module. The affine parameters of every task are registered
+        in this module, so they are always on the same device as the rest of the model and nothing has to be moved during
+        the forward pass. The active task is selected by its index using use_task(..). If a list of task names is set, one
+        for every sample of the batch, the affine parameters of the tasks are stacked and every sample is normalized with
+        the LN of its task, ie. a batch with mixed tasks can be processed in one forward pass.
+        NOTE: The parameters of the tasks are kept separately and are only stacked for mixed batches, so the parameters
+              of inactive tasks do not receive any gradient and are not changed by the optimizer (eg. weight decay).
+    """
+    def __init__(self, dim, task_name, norm_layer=None):
+        r"""Constructor of the task specific LayerNorm, the LN of the first task is built using norm_layer.
+            :param dim: The normalized (last) dimension
+            :param task_name: The name of the first task
+            :param norm_layer: The norm layer the parameters are built from, if None the module represents an Identity
+        """
+        super().__init__()
+        norm = norm_layer(dim) if norm_layer else nn.Identity()
+        self.dim = dim
+        self.is_identity = not isinstance(norm, nn.LayerNorm)
+        self.eps = getattr(norm, 'eps', 1e-6)
+        self.elementwise_affine = getattr(norm, 'elementwise_affine', False)
+        self.tasks = list()
+        self.task_idx = None
+        self.weight, self.bias = nn.ParameterList(), nn.ParameterList()
+        self.register_new_task(task_name)
+
+    def __contains__(self, task_name):
+        r"""Specifies if a LN is registered for task_name, ie. `task_name in norm`.
+        """
+        return task_name in self.tasks
+
+    def register_new_task(self, task_name):
+        r"""This function registers the LN of a new task, which is initialized like a new LayerNorm.
+        """
+        assert task_name not in self.tasks, "The task {} is already registered.".format(task_name)
+        self.tasks.append(task_name)
+        if self.elementwise_affine and not self.is_identity:
+            # -- Create the parameters on the device of the existing ones -- #
+            device = self.weight[0].device if len(self.weight) > 0 else None
+            self.weight.append(nn.Parameter(torch.ones(self.dim, device=device)))
+            self.bias.append(nn.Parameter(torch.zeros(self.dim, device=device)))
+
+    def task_index(self, task_name):
+        r"""This function returns the index of task_name, or a list of indices if a list of task names is provided.
+        """
+        if isinstance(task_name, (list, tuple)):
+            return [self.tasks.index(task) for task in task_name]
+        return self.tasks.index(task_name)
+
+    def use_task(self, task_name):
+        r"""This function selects the LN of task_name, or the LNs of every sample if a list of task names is provided.
+        """
+        self.task_idx = self.task_index(task_name)
+
+    def forward(self, x, task_name=None):
+        r"""Normalizes x with the LN of the active task(s), or of task_name (one or one per sample) if it is provided.
+        """
+        if self.is_identity:
+            return x
+        task_idx = self.task_idx if task_name is None else self.task_index(task_name)
+        assert task_idx is not None, "When using task specific LNs, than please set a task_name for the forward call using ViT.use_task(..).."
+        if not isinstance(task_idx, list):
+            weight = self.weight[task_idx] if self.elementwise_affine else None
+            bias = self.bias[task_idx] if self.elementwise_affine else None
+            return F.layer_norm(x, (self.dim,), weight, bias, self.eps)
+
+        # -- Mixed batch: normalize without affine parameters and apply the stacked parameters of every sample -- #
+        assert len(task_idx) == x.size(0), "Please provide one task for every sample of the batch.."
+        x = F.layer_norm(x, (self.dim,), None, None, self.eps)
+        if not self.elementwise_affine:
+            return x
+        idx = torch.tensor(task_idx, device=x.device)
+        shape = (x.size(0),) + (1,) * (x.dim() - 2) + (self.dim,)
+        weight = torch.stack(list(self.weight))[idx].view(shape)
+        bias = torch.stack(list(self.bias))[idx].view(shape)
+        return torch.addcmul(bias, x, weight)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        r"""Convert state_dicts with one LayerNorm per task in a ModuleDict, ie. prefix.<task_name>.weight, into the
+            format of this module, so models trained with the previous task specific LNs can still be loaded.
+        """
+        for idx, task in enumerate(self.tasks):
+            for name in ['weight', 'bias']:
+                if prefix + task + '.' + name in state_dict:
+                    state_dict[prefix + name + '.' + str(idx)] = state_dict.pop(prefix + task + '.' + name)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
 class Block(nn.Module):
     r"""Modify the blocks so we can have task specific LNs.
     """
     def __init__(self, dim, num_heads, mlp_ratio=4., qkv_bias=False, drop=0., attn_drop=0.,
                  drop_path=0., act_layer=nn.GELU, norm_layer=nn.LayerNorm, task_specific_ln=False, task_name=None,
-                 is_LSA=False, num_patches=16):
+                 is_LSA=False, num_patches=16, attn_backend='auto'):
         # -- Initialize -- #
         super().__init__()
         
-        # -- Specify if LayerNorms should be task specific, ie. in a ModuleDict -- #
+        # -- Specify if LayerNorms should be task specific, ie. a TaskLayerNorm -- #
         self.task_specific_ln = task_specific_ln
         if self.task_specific_ln:
-            self.use_task_name = None   # --> user has to set it by using ViT.use_task(..)
             assert task_name is not None and isinstance(task_name, str), "When using task specific LNs, than please provide a task_name during initialization.."
-            self.norm1 = nn.ModuleDict()
-            self.norm1[task_name] = norm_layer(dim)
+            self.norm1 = TaskLayerNorm(dim, task_name, norm_layer)  # --> user has to select the task by using ViT.use_task(..)
         else:
             self.norm1 = norm_layer(dim)
         
         self.attn = Attention(dim, num_heads=num_heads, qkv_bias=qkv_bias, attn_drop=attn_drop, proj_drop=drop,\
-                              is_LSA=is_LSA, num_patches=num_patches)
+                              is_LSA=is_LSA, num_patches=num_patches, attn_backend=attn_backend)
         # NOTE: drop path for stochastic depth, we shall see if this is better than dropout here
         self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
         
         if self.task_specific_ln:
-            self.norm2 = nn.ModuleDict()
-            self.norm2[task_name] = norm_layer(dim)
+            self.norm2 = TaskLayerNorm(dim, task_name, norm_layer)
         else:
             self.norm2 = norm_layer(dim)
 
@@ -114,21 +202,26 @@ class Block(nn.Module):
     def forward(self, x):
         r"""If task_specific_ln is used, don't forget to call ViT.use_task(..) to select the correct LNs for the blocks.
         """
-        if self.task_specific_ln:
-            assert self.use_task_name is not None and isinstance(self.use_task_name, str), "When using task specific LNs, than please set a task_name for the forward call using ViT.use_task(..).."
-            x = x + self.drop_path(self.attn(self.norm1[self.use_task_name].to(x.device.index)(x)))
-            x = x + self.drop_path(self.mlp(self.norm2[self.use_task_name].to(x.device.index)(x)))
-        else:
-            x = x + self.drop_path(self.attn(self.norm1(x)))
-            x = x + self.drop_path(self.mlp(self.norm2(x)))
+        x = x + self.drop_path(self.attn(self.norm1(x)))
+        x = x + self.drop_path(self.mlp(self.norm2(x)))
         return x
 
 class Attention(AttentionTimm):
-    def __init__(self, dim, num_heads=8, qkv_bias=False, attn_drop=0., proj_drop=0., is_LSA=False, num_patches=16):
+    r"""This class extends the Attention from timm with the Locality Self-Attention (LSA) and with pluggable attention backends.
+        Both, LSA and the standard attention, are computed either by torch.nn.functional.scaled_dot_product_attention (sdpa)
+        or by explicit matrix multiplications (manual). The backend can be one of ATTENTION_BACKENDS, where auto uses sdpa on
+        the GPU and manual on the CPU. For LSA, the learned per-head temperature is folded into the queries and the diagonal
+        is masked using a precomputed additive mask, so the full attention matrix is not modified in place on every forward.
+    """
+    def __init__(self, dim, num_heads=8, qkv_bias=False, attn_drop=0., proj_drop=0., is_LSA=False, num_patches=16, attn_backend='auto'):
         # -- Do not modify the attention module if not LSA -- #
         qkv_bias = False if is_LSA else qkv_bias    # --> Overwrite this; in LSA bias is false, see https://github.com/aanna0701/SPT_LSA_ViT/blob/main/models/vit.py#L61
         super().__init__(dim, num_heads, qkv_bias, attn_drop, proj_drop)
 
+        # -- Set the backend that computes the attention -- #
+        assert attn_backend in ATTENTION_BACKENDS, "The attention backend {} is not supported, choose one of {}.".format(attn_backend, ATTENTION_BACKENDS)
+        self.attn_backend = attn_backend
+
         # -- Set LSA flag and make changes is LSA is true -- #
         self.LSA = is_LSA
 
@@ -142,16 +235,17 @@ class Attention(AttentionTimm):
             # self.scale = head_dim ** -0.5
             self.dim = dim
             self.inner_dim = inner_dim
-            self.attend = nn.Softmax(dim = -1)
             self._init_weights(self.qkv)
             self.to_out = nn.Sequential(
                 nn.Linear(self.inner_dim, self.dim),
                 nn.Dropout(attn_drop)
             ) if project_out else nn.Identity()
 
-            self.scale = nn.Parameter(self.scale*torch.ones(num_heads))    
-            self.mask = torch.eye(self.num_patches+1, self.num_patches+1)
-            self.mask = torch.nonzero((self.mask == 1), as_tuple=False)
+            # -- Learned temperature of every head and additive mask that removes the diagonal (attention of a token to itself) -- #
+            self.scale = nn.Parameter(self.scale*torch.ones(num_heads))
+            mask = torch.zeros(self.num_patches+1, self.num_patches+1)
+            mask.fill_diagonal_(float('-inf'))
+            self.register_buffer('attn_mask', mask, persistent=False)  # --> not in the state_dict, so old checkpoints can still be loaded
 
     def _init_weights(self, m):
         if isinstance(m, (nn.Linear, nn.Conv2d)):
@@ -162,26 +256,42 @@ class Attention(AttentionTimm):
                 nn.init.constant_(m.bias, 0)
                 nn.init.constant_(m.weight, 1.0)
 
+    def use_sdpa(self, x):
+        r"""This function returns if the attention for the input x is computed using scaled_dot_product_attention.
+            If the installed torch version does not provide it, the manual backend is always used.
+        """
+        if self.attn_backend == 'manual' or not _HAS_SDPA:
+            return False
+        return self.attn_backend == 'sdpa' or x.is_cuda
+
     def forward(self, x):
-        if self.LSA:
-            # -- Perform forward function from Attention with LSA --> copied and modified from https://github.com/aanna0701/SPT_LSA_ViT/blob/main/models/vit.py#L75 -- #
-            b, _, _, h = *x.shape, self.heads
-            qkv = self.qkv(x).chunk(3, dim = -1)
-            q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h = h), qkv)
-
-            scale = self.scale
-            dots = torch.mul(einsum('b h i d, b h j d -> b h i j', q, k), scale.unsqueeze(0).unsqueeze(-1).unsqueeze(-1).expand((b, h, 1, 1)))
-            dots[:, :, self.mask[:, 0], self.mask[:, 1]] = -987654321
-
-            attn = self.attend(dots)
-            out = einsum('b h i j, b h j d -> b h i d', attn, v) 
-                
-            out = rearrange(out, 'b h n d -> b n (h d)')
-            x = self.to_out(out)
+        r"""Represents the forward mechanism of the (LSA) attention using the selected backend.
+        """
+        B, N, _ = x.shape
+        # -- Compute queries, keys and values with shape (B, heads, N, head_dim) -- #
+        qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv[0], qkv[1], qkv[2]
+
+        # -- In LSA every head has its own learned temperature and the diagonal is masked -- #
+        scale = self.scale.view(1, -1, 1, 1).to(q.dtype) if self.LSA else self.scale
+        mask = self.attn_mask.to(q.dtype) if self.LSA else None
+
+        if self.use_sdpa(x):
+            # -- sdpa scales by 1/sqrt(head_dim) itself, so only the remaining factor is folded into the queries -- #
+            out = F.scaled_dot_product_attention(q * (scale * q.size(-1) ** 0.5), k, v, attn_mask=mask,
+                                                 dropout_p=self.attn_drop.p if self.training else 0.)
         else:
-            # -- Do not modify the attention module if not LSA -- #
-            x = super().forward(x)
-        return x
+            attn = (q * scale) @ k.transpose(-2, -1)
+            if mask is not None:
+                attn = attn + mask
+            attn = self.attn_drop(attn.softmax(dim=-1))
+            out = attn @ v
+        out = out.transpose(1, 2).reshape(B, N, -1)
+
+        # -- LSA uses its own output projection --> copied and modified from https://github.com/aanna0701/SPT_LSA_ViT/blob/main/models/vit.py#L75 -- #
+        if self.LSA:
+            return self.to_out(out)
+        return self.proj_drop(self.proj(out))
 
 class VisionTransformer(VisionTransformer2D):
     r"""This class extends the ViT from timm (https://github.com/rwightman/pytorch-image-models/blob/a41de1f666f9187e70845bbcf5b092f40acaf097/timm/models/vision_transformer.py)
@@ -190,7 +300,8 @@ class VisionTransformer(VisionTransformer2D):
     def __init__(self, ViT_2d: bool, img_size=224, patch_size=16, img_depth=None, in_chans=3, num_classes=1000, embed_dim=768, depth=12,
                  num_heads=12, mlp_ratio=4., qkv_bias=True, representation_size=None, distilled=False,
                  drop_rate=0., attn_drop_rate=0., drop_path_rate=0., embed_layer=PatchEmbed, norm_layer=partial(nn.LayerNorm, eps=1e-6),
-                 act_layer=nn.GELU, weight_init='', task_specific_ln=False, task_name=None, is_LSA=False, is_SPT=False):
+                 act_layer=nn.GELU, weight_init='', task_specific_ln=False, task_name=None, is_LSA=False, is_SPT=False,
+                 attn_backend='auto'):
         r"""This function represents the constructor of ViT. The user has to specify if a 2D ViT (from timm module)
             should be provided or a 3D one. If so, all parameters and arguments need to have the correct dimensions,
             otherwise the initialization might fail (best case scenario) or the results/training process is not as
@@ -200,6 +311,7 @@ class VisionTransformer(VisionTransformer2D):
             During the forward, the desired task needs to be mentioned as well.
             We also provide the Shifted Patch Tokenization (SPT) and Locality Self-Attention (LSA) modification presented in
             https://arxiv.org/pdf/2112.13492v1.pdf from https://github.com/aanna0701/SPT_LSA_ViT.
+            attn_backend specifies how the attention of all blocks is computed, see Attention and ATTENTION_BACKENDS.
         """
         # -- We do not accept task_specific in combination with LSA or SPT or both -- #
         if task_specific_ln:
@@ -216,7 +328,7 @@ class VisionTransformer(VisionTransformer2D):
         self.act_layer = act_layer or nn.GELU
         self.norm_layer = norm_layer or partial(nn.LayerNorm, eps=1e-6)
 
-        # -- Specify if LayerNorms should be task specific, ie. in a ModuleDict -- #
+        # -- Specify if LayerNorms should be task specific, ie. a TaskLayerNorm -- #
         self.task_specific_ln = task_specific_ln
         if self.task_specific_ln:
             assert task_name is not None and isinstance(task_name, str), "When using task specific LNs, than please provide a task_name during initialization.."
@@ -257,15 +369,13 @@ class VisionTransformer(VisionTransformer2D):
                 Block(
                     dim=embed_dim, num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, drop=drop_rate,
                     attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=self.norm_layer, act_layer=self.act_layer,\
-                    is_LSA=True, num_patches=num_patches)
+                    is_LSA=True, num_patches=num_patches, attn_backend=attn_backend)
                 for i in range(depth)])
 
         # -- Remove and create a new self.norm if user wants task_specific_ln -- #
         if self.task_specific_ln:    # --> If not task specific, we don't have anything to do
-            # -- Create a new ModuleDict -- #
-            self.norm = nn.ModuleDict()
-            # -- Register LN based on task_name -- #
-            self.norm[task_name] = self.norm_layer(self.embed_dim)
+            # -- Create a new TaskLayerNorm with the LN for task_name -- #
+            self.norm = TaskLayerNorm(self.embed_dim, task_name, self.norm_layer)
 
             # -- Recreate the blocks and patch embedding from the initialization if the user wants task specific LNs since this would not be done yet -- #
             dpr = [x.item() for x in torch.linspace(0, drop_path_rate, depth)]  # stochastic depth decay rule
@@ -273,13 +383,21 @@ class VisionTransformer(VisionTransformer2D):
                 Block(
                     dim=embed_dim, num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, drop=drop_rate,
                     attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=self.norm_layer, act_layer=self.act_layer,
-                    task_specific_ln=self.task_specific_ln, task_name=task_name)
+                    task_specific_ln=self.task_specific_ln, task_name=task_name, attn_backend=attn_backend)
                 for i in range(depth)])
             
             init_size = init_size[1:] if len(init_size) == 3 else init_size
             self.patch_embed = embed_layer(img_size=init_size, patch_size=init_patch, in_chans=init_channel, embed_dim=embed_dim, norm_layer=norm_layer,\
                                            embed2D=True, task_specific_ln=self.task_specific_ln, task_name=task_name)
 
+        # -- Replace the attention of the blocks from timm as well, so every block uses the desired attention backend -- #
+        for block in self.blocks:
+            if not isinstance(block.attn, Attention):
+                attn = Attention(embed_dim, num_heads=num_heads, qkv_bias=qkv_bias, attn_drop=attn_drop_rate, proj_drop=drop_rate,
+                                 attn_backend=attn_backend)
+                attn.load_state_dict(block.attn.state_dict())   # --> Keep the initialized weights, the parameter names are identical
+                block.attn = attn
+
         # -- Define empty list of all the patch_embeddings and the heads -- #
         self.patch_embeds = []
         if distilled:
@@ -343,21 +461,15 @@ class VisionTransformer(VisionTransformer2D):
         if self.SPT or self.LSA:
             assert False, "When using SPT or LSA, task specific LNs are not allowed, so you can not call this function.."
 
-        # -- Register new LN in self.norm -- #
-        self.norm[task_name] = nn.Identity() if 'Identity' in str(type(self.norm[list(self.norm.keys())[0]])) else self.norm_layer(self.embed_dim)
-
-        # -- For every patch_embed and block register a new LN as well -- #
-        for patch_e in self.patch_embeds:
-            # -- Register new LN for norm -- #
-            patch_e.norm[task_name] = nn.Identity() if 'Identity' in str(type(patch_e.norm[list(patch_e.norm.keys())[0]])) else self.norm_layer(self.embed_dim)
-        for i in range(self.block_depth):
-            # -- Register new LN for norm1 and norm2 -- #
-            self.blocks[i].norm1[task_name], self.blocks[i].norm2[task_name] = nn.Identity() if 'Identity' in str(type(self.blocks[i].norm1[list(self.blocks[i].norm1.keys())[0]])) else self.norm_layer(self.embed_dim),\
-                                                                               nn.Identity() if 'Identity' in str(type(self.blocks[i].norm2[list(self.blocks[i].norm2.keys())[0]])) else self.norm_layer(self.embed_dim)
-            
+        # -- Register a new LN in every task specific LN, ie. self.norm, the patch embeddings and the blocks -- #
+        for module in self.modules():
+            if isinstance(module, TaskLayerNorm) and task_name not in module:
+                module.register_new_task(task_name)
+
     def use_task(self, task_name):
         r"""This function has to be used to specify which task_name to use in the forward function. Call this before every
-            iteration with the desired task_name to correctly use the desired LayerNorms.
+            iteration with the desired task_name to correctly use the desired LayerNorms. If a list of task names is provided,
+            one for every sample of the following batches, every sample is normalized with the LNs of its task.
         """
         # -- Be sure this is not called when doing SPT or LSA -- #
         if self.SPT or self.LSA:
@@ -365,10 +477,10 @@ class VisionTransformer(VisionTransformer2D):
 
         # -- Set the variable -- #
         self.task_name_use = task_name
-        # -- Set the task_names in blocks as well since its sequential and with the standard forward we can not set it -- #
-        for i in range(self.block_depth):
-            # -- Set the use_task_name that is used in the forward function -- #
-            self.blocks[i].use_task_name = task_name
+        # -- Select the task in every LN as well, since the blocks are sequential and with the standard forward we can not set it -- #
+        for module in self.modules():
+            if isinstance(module, TaskLayerNorm):
+                module.use_task(task_name)
 
     def forward_features(self, x, idx, task_name): # Modified so idx specifies which embeddings to use
         if self.SPT:
@@ -385,7 +497,7 @@ class VisionTransformer(VisionTransformer2D):
         self.blocks(x)
         # -- For self.norm we have to do it here 'by hand' -- #
         if self.task_specific_ln:
-            x = self.norm[task_name].to(x.device.index)(x)
+            x = self.norm(x, task_name)
         else:
             x = self.norm(x)
         if self.dist_token is None:
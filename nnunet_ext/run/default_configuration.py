@@ -3,7 +3,7 @@
 #----------Implementation inspired by original implementation, same code is marked as such.-------------#
 #########################################################################################################
 
-import nnunet, nnunet_ext
+import os, nnunet, nnunet_ext
 from batchgenerators.utilities.file_and_folder_operations import *
 from nnunet.training.model_restore import recursive_find_python_class
 from nnunet.experiment_planning.summarize_plans import summarize_plans
@@ -11,13 +11,39 @@ from nnunet.training.network_training.nnUNetTrainerV2 import nnUNetTrainerV2
 from nnunet.paths import network_training_output_dir as orig_network_training_output_dir
 from nnunet_ext.paths import network_training_output_dir, preprocessing_output_dir, default_plans_identifier
 
+# -- Process-wide caches for the resolved configurations and the trainer classes, since the configuration is resolved -- #
+# -- for every task at every validation and loading the plans or searching the trainer class every time is expensive -- #
+_CONFIGURATION_CACHE = dict()
+_TRAINER_CLASS_CACHE = dict()
+
+def clear_default_configuration_cache():
+    r"""This function empties the cached configurations and trainer classes, eg. after the plans have been
+        modified in a way that does not change their modification time.
+    """
+    _CONFIGURATION_CACHE.clear()
+    _TRAINER_CLASS_CACHE.clear()
+
+def find_trainer_class(search_in, network_trainer, base_module):
+    r"""This function returns the trainer class with the name network_trainer that is searched in search_in.
+        The result is cached, so the package is only imported and walked once per trainer.
+    """
+    key = (tuple(search_in), network_trainer, base_module)
+    if key not in _TRAINER_CLASS_CACHE:
+        _TRAINER_CLASS_CACHE[key] = recursive_find_python_class([join(*search_in)], network_trainer,
+                                                                current_module=base_module)
+    return _TRAINER_CLASS_CACHE[key]
+
 #------------------------------------------- Partially copied from original implementation -------------------------------------------#
 def get_default_configuration(network, task, running_task, network_trainer, tasks_joined_name, plans_identifier=default_plans_identifier,
-                              search_in=None, base_module=None, extension_type='multihead', print_loss_info=True, param_search=False):
+                              search_in=None, base_module=None, extension_type='multihead', print_loss_info=True, param_search=False,
+                              quiet=False):
     r"""This function extracts paths to the plans_file, specifies the output_folder_name, dataset_directory, batch_dice, stage, and trainer_class.
         The extension type specifies which nnUNet extension will be used (multihead, rehearsal, etc.).
         When using the Generic_Vit_UNet (and only then), the running_task, tasks_joined_name and extension_type
         should be set to None!
+        The resolved configuration is cached per (network, task, network_trainer, plans_identifier, extension_type) and
+        only resolved again if the plans file has been modified since then. The configuration summary is only printed
+        when the configuration is resolved, and never if quiet is set.
     """
     # -- If network_trainer is actual trainer than transform it into a string -- #
     if not isinstance(network_trainer, str):
@@ -50,20 +76,32 @@ def get_default_configuration(network, task, running_task, network_trainer, task
     else:
         plans_file = join(preprocessing_output_dir, task, plans_identifier + "_plans_3D.pkl")
 
-    plans = load_pickle(plans_file)
-    possible_stages = list(plans['plans_per_stage'].keys())
+    # -- Use the cached configuration if the plans file did not change since it has been resolved -- #
+    key = (network, task, network_trainer, plans_identifier, extension_type, tuple(search_in), base_module)
+    mtime = os.path.getmtime(plans_file)
+    config = _CONFIGURATION_CACHE.get(key, None)
+    resolve = config is None or config['mtime'] != mtime
+    if resolve:
+        plans = load_pickle(plans_file)
+        possible_stages = list(plans['plans_per_stage'].keys())
 
-    if (network == '3d_cascade_fullres' or network == "3d_lowres") and len(possible_stages) == 1:
-        raise RuntimeError("3d_lowres only applies if there is more than one stage. This task does "
-                           "not require the cascade. Run 3d_fullres instead.")
+        if (network == '3d_cascade_fullres' or network == "3d_lowres") and len(possible_stages) == 1:
+            raise RuntimeError("3d_lowres only applies if there is more than one stage. This task does "
+                               "not require the cascade. Run 3d_fullres instead.")
 
-    if network == '2d' or network == "3d_lowres":
-        stage = 0
-    else:
-        stage = possible_stages[-1]
+        if network == '2d' or network == "3d_lowres":
+            stage = 0
+        else:
+            stage = possible_stages[-1]
+
+        trainer_class = find_trainer_class(search_in, network_trainer, base_module)
 
-    trainer_class = recursive_find_python_class([join(*search_in)], network_trainer,
-                                                current_module=base_module)
+        batch_dice = (network == '2d' or len(possible_stages) > 1) and not network == '3d_lowres'
+        config = {'mtime': mtime, 'stage': stage, 'trainer_class': trainer_class, 'batch_dice': batch_dice,
+                  'data_identifier': plans['data_identifier']}
+        _CONFIGURATION_CACHE[key] = config
+        del plans
+    stage, trainer_class, batch_dice = config['stage'], config['trainer_class'], config['batch_dice']
                                                 
     if tasks_joined_name is None or running_task is None: # Should only be None when using the Generic_ViT_UNet
         output_folder_name = join(network_training_output_dir, network, task, network_trainer + "__" + plans_identifier)
@@ -83,24 +121,22 @@ def get_default_configuration(network, task, running_task, network_trainer, task
         copy_dir(source, dest)
     """
 
-    print("###############################################")
-    print("I am running the following nnUNet: %s" % network)
-    print("My trainer class is: ", trainer_class)
-    print("For that I will be using the following configuration:")
-    summarize_plans(plans_file)
-    print("I am using stage %d from these plans" % stage)
+    if resolve and not quiet:
+        print("###############################################")
+        print("I am running the following nnUNet: %s" % network)
+        print("My trainer class is: ", trainer_class)
+        print("For that I will be using the following configuration:")
+        summarize_plans(plans_file)
+        print("I am using stage %d from these plans" % stage)
 
-    if (network == '2d' or len(possible_stages) > 1) and not network == '3d_lowres':
-        batch_dice = True
-        if print_loss_info:
-            print("I am using batch dice + CE loss")
-    else:
-        batch_dice = False
         if print_loss_info:
-            print("I am using sample dice + CE loss")
+            if batch_dice:
+                print("I am using batch dice + CE loss")
+            else:
+                print("I am using sample dice + CE loss")
 
-    print("\nI am using data from this folder: ", join(dataset_directory, plans['data_identifier']))
-    print("###############################################")
+        print("\nI am using data from this folder: ", join(dataset_directory, config['data_identifier']))
+        print("###############################################")
     
     if param_search:
         # -- Only return the dataset_directory, batch_dice, stage and trainer_class -- #
@@ -84,6 +84,9 @@ def run_evaluation():
                         help='Set this flag if Locality Self-Attention should be used for the ViT.')
     parser.add_argument('--do_SPT', action='store_true', default=False,
                         help='Set this flag if Shifted Patch Tokenization should be used for the ViT.')
+    parser.add_argument('--cache_val_batches', action='store_true', default=False,
+                        help='Set this flag if the validation batches should be sampled once with a fixed seed and stored'+
+                             ' in a cache next to the preprocessed data, so they can be reused by every evaluation and training.')
 
     # -- Build mapping for network_trainer to corresponding extension name -- #
     ext_map = {'nnViTUNetTrainer': None, 'nnViTUNetTrainerCascadeFullRes': None,
@@ -208,6 +211,7 @@ def run_evaluation():
     evaluator = Evaluator(network, network_trainer, (tasks_for_folder, char_to_join_tasks), (use_model_w_tasks, char_to_join_tasks), 
                           version, vit_type, plans_identifier, mixed_precision, ext_map[network_trainer], save_csv, transfer_heads,
                           use_vit, False, ViT_task_specific_ln, do_LSA, do_SPT)
+    evaluator.cache_val_batches = args.cache_val_batches
     evaluator.evaluate_on(fold, evaluate_on_tasks, use_head, always_use_last_head, do_pod)
 
 # -- Main function for setup execution -- #
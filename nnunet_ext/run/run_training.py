@@ -163,6 +163,26 @@ def run_training(extension='multihead'):
                         help='Set this flag if a new head should not be initialized using the last head'
                             ' during training, ie. the very first head from the initialization of the class is used.'
                             ' Default: The previously trained head is used as initialization of the new head.')
+    parser.add_argument('--share_mh_params', required=False, default=False, action="store_true",
+                        help='Set this flag if the body and active head of the Multi Head Network should share the parameters'
+                            ' with the running model, so the network does not need to be split after every iteration.'
+                            ' Default: The body and heads are updated by splitting the running model after every iteration.')
+    parser.add_argument('--mh_cache_mb', type=float, required=False, default=0,
+                        help='Specify the memory budget in MB for the cache of assembled task views of the Multi Head Network.'
+                            ' If a head is activated again while the body and head did not change, the cached view is loaded'
+                            ' instead of assembling the model again. Default: 0, ie. the cache is disabled.')
+    parser.add_argument('--cache_val_batches', required=False, default=False, action="store_true",
+                        help='Set this flag if the validation batches should be sampled once per task with a fixed seed and'
+                            ' stored in a memory-mapped cache next to the preprocessed data. Every validation then streams the'
+                            ' same batches from the cache instead of using the augmentation pipeline. Default: False.')
+    parser.add_argument('--foreground_index', required=False, default=False, action="store_true",
+                        help='Set this flag if the foreground locations of every case and class should be sampled once in'
+                            ' parallel and stored next to the preprocessed data. The data loaders then choose the foreground'
+                            ' patches using this index instead of the locations in the properties of every case. Default: False.')
+    parser.add_argument('--max_alive_pipelines', type=int, required=False, default=3,
+                        help='Specify how many data pipelines (dataloaders and augmenters) of other tasks are kept alive between'
+                            ' validations, so they do not need to be built again every time. Set it to 0 to build them again'
+                            ' for every validation. Default: 3.')
     
     # -- Add arguments for rehearsal method -- #
     if extension == 'rehearsal':
@@ -175,6 +195,21 @@ def run_training(extension='multihead'):
                                 ' The number should be between 0 and 1 specifying the percentage that will be considered.'
                                 ' This percentage is used for each previous task individually.'
                                 ' Default: 0.25, ie. 25% of each previous task will be considered.')
+        parser.add_argument('--replay_mode', action='store', type=str, required=False, default='fraction',
+                            choices=['fraction', 'reservoir', 'class_balanced'],
+                            help='Specify how the replayed cases of the previous tasks are selected: a fraction (-samples_in_perc) of'
+                                ' every task, reservoir sampling over all tasks or a class balanced selection. The last two need'
+                                ' --replay_budget. Default: fraction.')
+        parser.add_argument('--replay_budget', action='store', type=int, required=False, default=None,
+                            help='Specify the maximum number of replayed cases over all previous tasks. Default: None.')
+        parser.add_argument('--replay_budget_mb', action='store', type=float, required=False, default=None,
+                            help='Specify the maximum size of the replayed cases in MB. Default: None, ie. no limit.')
+        parser.add_argument('--replay_ratio', action='store', type=float, required=False, default=None,
+                            help='Specify the ratio of replayed cases in every batch. If it is not set, the replayed cases are'
+                                ' joined with the dataset of the current task. Default: None.')
+        parser.add_argument('--replay_pin', action='store_true', default=False,
+                            help='Set this flag if the replayed cases should be copied as uncompressed numpy files into a cache'
+                                ' folder next to the trained_on file, so they can be memory-mapped. Default: False')
     
     # -- Add arguments for ewc methods -- #
     if extension in ['ewc', 'ewc_vit', 'ewc_unet', 'ewc_ln', 'ownm1', 'ownm2', 'ownm3', 'ownm4']:
@@ -182,6 +217,22 @@ def run_training(extension='multihead'):
                             help='Specify the importance of the previous tasks for the EWC method.'
                                 ' This number represents the lambda value in the loss function calculation as proposed in the paper.'
                                 ' Default: ewc_lambda = 0.4')
+        parser.add_argument('--fisher_batches', type=int, required=False, default=None,
+                            help='Specify the number of batches that are used to estimate the Fisher values after the training'
+                                ' on a task. Less batches trade accuracy for time. Default: The number of batches per epoch.')
+        parser.add_argument('--fisher_autocast', type=str, required=False, default=None, choices=['none', 'fp16', 'bf16'],
+                            help='Specify if the forward pass should be autocasted during the estimation of the Fisher values.'
+                                ' Default: Autocast as it is done during the training.')
+
+    # -- Add arguments for the EWC Trainers, the own methods do not consolidate their values -- #
+    if extension in ['ewc', 'ewc_vit', 'ewc_unet', 'ewc_ln']:
+        parser.add_argument('--consolidate_ewc', required=False, default=False, action="store_true",
+                            help='Set this flag if the fisher and param values of all finished tasks should be folded into one'
+                                ' consolidated set of values, so the memory and time of the EWC loss do not grow with the number of tasks.'
+                                ' Default: False')
+        parser.add_argument('--keep_task_ewc_values', required=False, default=False, action="store_true",
+                            help='Set this flag if the per task fisher and param values should still be stored for analysis'
+                                ' when --consolidate_ewc is used. Default: False')
 
     # -- Add arguments for RW method -- #
     if extension == 'rw':
@@ -195,11 +246,34 @@ def run_training(extension='multihead'):
                             help='Specify after which iteration (batch iteration, not epoch) the fisher values are updated/calculated.'
                                 ' Default: The result will be updated every 10th epoch.')
 
+    # -- Add arguments for all EWC based methods -- #
+    if extension in ['ewc', 'ewc_vit', 'ewc_unet', 'ewc_ln', 'ownm1', 'ownm2', 'ownm3', 'ownm4', 'rw']:
+        parser.add_argument('--ewc_grad_hook', required=False, default=False, action="store_true",
+                            help='Set this flag if the gradient of the EWC penalty should be added to the gradients after the'
+                                ' backward pass instead of adding the penalty to the loss. This avoids building a graph for the'
+                                ' penalty, reducing memory and time per iteration. The penalty is then logged separately once per epoch'
+                                ' and is not part of the train loss. Default: False')
+        parser.add_argument('--tensor_store_fp16', required=False, default=False, action="store_true",
+                            help='Set this flag if the Fisher, param and score values should be stored in half precision'
+                                ' to save disk space and time. Default: False')
+
     # -- Add arguments for lwf method -- #
     if extension == 'lwf':
         parser.add_argument('-lwf_temperature', action='store', type=float, nargs=1, required=False, default=2.0,
                             help='Specify the temperature variable for the LwF method.'
                                 ' Default: lwf_temperature = 2.0')
+        parser.add_argument('--lwf_seeded_batches', action='store_true', default=False,
+                            help='Set this flag if the target logits of the previous heads should be computed once and stored.'
+                                ' Every epoch then draws its batches from num_batches_per_epoch (num_val_batches_per_epoch) fixed'
+                                ' batches whose crop and augmentation are determined by their seed, so the augmentation is limited'
+                                ' to these batches. Otherwise the target logits are computed for every batch. Default: False')
+        parser.add_argument('--lwf_logits_int8', action='store_true', default=False,
+                            help='Set this flag if the target logits should be quantized to 8 bit instead of stored in half precision'
+                                ' in the memory-mapped logit store. Only used with --lwf_seeded_batches. Default: False')
+        parser.add_argument('--lwf_logits_prefetch', action='store_true', default=False,
+                            help='Set this flag if the stored target logits of the next batch should be prefetched into pinned'
+                                ' memory by a background thread while the current batch is trained. Only used with --lwf_seeded_batches.'
+                                ' Default: False')
 
     # -- Add arguments for PLOP method -- #
     if extension in ['plop', 'pod', 'ownm1', 'ownm2', 'ownm3', 'ownm4']:
@@ -209,7 +283,34 @@ def run_training(extension='multihead'):
         parser.add_argument('-pod_scales', action='store', type=int, nargs=1, required=False, default=3,
                             help='Specify the number of scales for the PLOP method.'
                                 ' Default: pod_scales = 3')
+        parser.add_argument('--pod_layers', action='store', type=str, nargs='+', required=False, default=None,
+                            help='Specify regular expressions of the module names whose outputs are used for the POD embeddings.'
+                                ' A convolutional layer is used if any of the expressions is found in its name.'
+                                ' Default: All convolutional layers (PLOP, POD) or the ones in seg_outputs (own methods).')
+        parser.add_argument('--pod_stages', action='store', type=int, nargs='+', required=False, default=None,
+                            help='Specify the stages of the layers used for the POD embeddings, ie. the first index in the module'
+                                ' name like 2 in conv_blocks_context.2.blocks.0.conv. Default: All stages.')
+        parser.add_argument('--pod_max_depth', action='store', type=int, required=False, default=None,
+                            help='Specify the maximum depth, ie. the number of dots in the module name, of the layers used for'
+                                ' the POD embeddings. Default: All depths.')
+        parser.add_argument('--pod_pool', action='store', type=int, required=False, default=1,
+                            help='Specify the kernel size of the average pooling applied to the captured layer outputs before'
+                                ' they are stored to save memory. Default: pod_pool = 1, ie. no pooling.')
     
+    # -- Add arguments for all methods using the outputs of the old model -- #
+    if extension in ['mib', 'plop', 'pod', 'ownm1', 'ownm2', 'ownm3', 'ownm4']:
+        parser.add_argument('--teacher_cache_size', action='store', type=int, required=False, default=0,
+                            help='Specify the number of samples whose outputs (and POD features) of the old model are cached'
+                                ' in half precision in a memory-mapped file. Setting it turns on seeded batches: every epoch draws'
+                                ' its batches from num_batches_per_epoch (num_val_batches_per_epoch) fixed batches whose crop and'
+                                ' augmentation are determined by their seed, so the augmentation is limited to these batches.'
+                                ' A sample is identified by its task, case, the seed of the crop and augmentation of its batch and'
+                                ' its position in the batch, so the old model only runs for samples it has not seen yet.'
+                                ' Default: 0, ie. the cache and the seeded batches are disabled.')
+        parser.add_argument('--teacher_cache_topk', action='store', type=int, required=False, default=None,
+                            help='Specify the number of logits per voxel that are stored in the teacher cache. The other'
+                                ' logits are set to their log-mean-exp, so the top-k softmax probabilities are preserved. Default: All logits are stored.')
+
     # -- Add arguments for MiB method -- #
     if extension in ['mib', 'ownm1', 'ownm2', 'ownm3']:
         parser.add_argument('-mib_alpha', action='store', type=float, nargs=1, required=False, default=1.0,
@@ -286,6 +387,44 @@ def run_training(extension='multihead'):
     # -- LSA and SPT flags -- #
     do_LSA = args.do_LSA
     do_SPT = args.do_SPT
+
+    # -- Extract the flag if the Multi Head Network should share the parameters with the running model -- #
+    share_mh_params = args.share_mh_params
+    mh_cache_mb = args.mh_cache_mb
+    max_alive_pipelines = args.max_alive_pipelines
+    cache_val_batches = args.cache_val_batches
+    use_foreground_index = args.foreground_index
+
+    # -- Extract the flags if the EWC values of finished tasks should be consolidated -- #
+    consolidate_ewc = getattr(args, 'consolidate_ewc', False)
+    keep_task_ewc_values = getattr(args, 'keep_task_ewc_values', False)
+    ewc_grad_hook = getattr(args, 'ewc_grad_hook', False)
+    fisher_batches = getattr(args, 'fisher_batches', None)
+    tensor_store_fp16 = getattr(args, 'tensor_store_fp16', False)
+    fisher_autocast = getattr(args, 'fisher_autocast', None)
+
+    # -- Extract the settings of the cache for the outputs of the old model -- #
+    teacher_cache_size = getattr(args, 'teacher_cache_size', 0)
+    teacher_cache_topk = getattr(args, 'teacher_cache_topk', None)
+
+    # -- Extract the settings of the store for the target logits of the LwF method -- #
+    lwf_seeded_batches = getattr(args, 'lwf_seeded_batches', False)
+    lwf_logits_int8 = getattr(args, 'lwf_logits_int8', False)
+    lwf_logits_prefetch = getattr(args, 'lwf_logits_prefetch', False)
+
+    # -- Extract the settings of the replay buffer of the rehearsal method -- #
+    replay_mode = getattr(args, 'replay_mode', 'fraction')
+    replay_budget = getattr(args, 'replay_budget', None)
+    replay_budget_mb = getattr(args, 'replay_budget_mb', None)
+    replay_ratio = getattr(args, 'replay_ratio', None)
+    replay_pin = getattr(args, 'replay_pin', False)
+    assert replay_ratio is None or 0 < replay_ratio < 1, "The replay_ratio needs to be in (0, 1)."
+
+    # -- Extract the selection and pooling of the captured layers for the POD embeddings -- #
+    pod_layers = getattr(args, 'pod_layers', None)
+    pod_stages = getattr(args, 'pod_stages', None)
+    pod_max_depth = getattr(args, 'pod_max_depth', None)
+    pod_pool = getattr(args, 'pod_pool', 1)
     
     num_epochs = args.num_epochs    # The number of epochs to train for each task
     if isinstance(num_epochs, list):    # When the num_epochs get returned as a list, extract the number to avoid later appearing errors
@@ -801,6 +940,41 @@ def run_training(extension='multihead'):
                 trainer = trainer_class(split, all_tasks[0], plans_file, t_fold, output_folder=output_folder_name, dataset_directory=dataset_directory,\
                                         batch_dice=batch_dice, stage=stage, network=network,
                                         already_trained_on=already_trained_on, **(args_f[trainer_class.__name__]))
+                # -- Set the settings before the trainer is initialized, so they are used as soon as the data pipelines -- #
+                # -- and the Multi Head Network are built -- #
+                # -- Set if the Multi Head Network should share the parameters with the running model -- #
+                trainer.share_mh_parameters = share_mh_params
+                trainer.mh_cache_budget_mb = mh_cache_mb
+                trainer.max_alive_pipelines = max_alive_pipelines
+                trainer.cache_val_batches = cache_val_batches
+                trainer.use_foreground_index = use_foreground_index
+                trainer.teacher_cache_size = teacher_cache_size
+                trainer.teacher_cache_topk = teacher_cache_topk
+                if hasattr(trainer, 'lwf_logits_int8'):
+                    trainer.lwf_seeded_batches = lwf_seeded_batches
+                    trainer.lwf_logits_int8 = lwf_logits_int8
+                    trainer.lwf_logits_prefetch = lwf_logits_prefetch
+                if hasattr(trainer, 'replay_buffer'):
+                    trainer.replay_mode = replay_mode
+                    trainer.replay_budget = replay_budget
+                    trainer.replay_budget_mb = replay_budget_mb
+                    trainer.replay_ratio = replay_ratio
+                    trainer.replay_pin = replay_pin
+                if hasattr(trainer, 'consolidate_ewc'):
+                    trainer.consolidate_ewc = consolidate_ewc
+                    trainer.keep_task_ewc_values = keep_task_ewc_values
+                if hasattr(trainer, 'fisher_batches'):
+                    trainer.fisher_batches = fisher_batches
+                    trainer.fisher_autocast = fisher_autocast
+                if hasattr(trainer, 'ewc_grad_hook'):
+                    trainer.ewc_grad_hook = ewc_grad_hook
+                    trainer.tensor_store_fp16 = tensor_store_fp16
+                if hasattr(trainer, 'feature_capture'):
+                    trainer.pod_layers = pod_layers if pod_layers is not None else trainer.pod_layers
+                    trainer.pod_stages = pod_stages
+                    trainer.pod_max_depth = pod_max_depth
+                    trainer.pod_pool = pod_pool
+
                 trainer.initialize(not validation_only, num_epochs=num_epochs, prev_trainer_path=prev_trainer_path)
 
                 # NOTE: Trainer has only weights and heads of first task at this point
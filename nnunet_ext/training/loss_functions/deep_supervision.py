@@ -2,10 +2,11 @@
 #---------------------Corresponding deep_supervision.py file for nnUNet extensions.---------------------#
 #########################################################################################################
 
-import torch, copy
+import torch, math
 import torch.nn as nn
 import torch.nn.functional as F
 from nnunet_ext.training.loss_functions.embeddings import *
+from nnunet_ext.training.loss_functions.ewc_penalty import FlatEWCPenalty
 from nnunet_ext.training.loss_functions.crossentropy import *
 from nnunet_ext.training.loss_functions.knowledge_distillation import *
 from nnunet.training.loss_functions.deep_supervision import MultipleOutputLoss2
@@ -38,6 +39,14 @@ class MultipleOutputLossEWC(MultipleOutputLoss2):
         self.match = match
         self.match_true = match_true
 
+        # -- Define the engine that calculates the penalty using flattened fisher and param values -- #
+        self.ewc_penalty = FlatEWCPenalty(match_sth, match, match_true)
+
+        # -- If this is set, the penalty is not added to the loss, instead its gradient is added to the gradients of the -- #
+        # -- parameters after the backward pass when calling apply_penalty_gradients -- #
+        self.ewc_grad_hook = False
+        self._pending_penalty = None
+
     def update_ewc_params(self, fisher, params):
         r"""The ewc parameters should be updated after every finished run before training on a new task.
         """
@@ -46,6 +55,9 @@ class MultipleOutputLossEWC(MultipleOutputLoss2):
         self.fisher = fisher
         self.params = params
 
+        # -- The flattened values need to be built again -- #
+        self.ewc_penalty.reset()
+
     def update_network_params(self, network_params):
         r"""The network parameters should be updated after every finished iteration of an epoch, 
             in order for the loss to use always the current network parameters. --> use this in
@@ -54,25 +66,41 @@ class MultipleOutputLossEWC(MultipleOutputLoss2):
         # -- Update the network_params -- #
         self.network_params = network_params
 
+    def apply_penalty_gradients(self):
+        r"""This function adds the gradient of the penalty of the last forward call to the gradients of the network
+            parameters. It has to be called after the backward pass when ewc_grad_hook is set, otherwise it does nothing.
+        """
+        if self._pending_penalty is None:
+            return
+        factor, importance = self._pending_penalty
+        self._pending_penalty = None
+        self.ewc_penalty.add_gradients(self.network_params, self.tasks, self.fisher, self.params, factor, importance)
+
+    def penalty_value(self):
+        r"""This function returns the penalty of the last apply_penalty_gradients call, eg. for logging purposes.
+        """
+        return self.ewc_penalty.last_value()
+
+    def _add_penalty(self, loss, factor, importance=None):
+        r"""This function adds factor * penalty to the loss, or remembers it so its gradient can be added after the
+            backward pass using apply_penalty_gradients if ewc_grad_hook is set.
+        """
+        if self.ewc_grad_hook:
+            self._pending_penalty = (factor, importance)
+            return loss
+        return loss + factor * self.ewc_penalty(self.network_params, self.tasks, self.fisher, self.params, importance)
+
     def forward(self, x, y, reg=True):
         # -- Calculate the loss first using the parent class -- #
         loss = super(MultipleOutputLossEWC, self).forward(x, y)
+        self._pending_penalty = None
 
         if reg: # Do regularization ?
             # -- Update the loss as proposed in the paper and return this loss to the calling function instead -- #
-            # -- Loop through the tasks the model has already been trained on -- #
-            for task in self.tasks:
-                for name, param in self.network_params: # Get named parameters of the current model
-                    # -- Only consider those parameters in which the matching phrase is matched if desired or all -- #
-                    if (self.match_case and self.match_true and all(m_name in name for m_name in self.match))\
-                    or (self.match_case and not self.match_true and all(m_name not in name for m_name in self.match))\
-                    or (not self.match_case):                
-                        # -- Extract corresponding fisher and param values -- #
-                        fisher_value = self.fisher[task][name]
-                        param_value = self.params[task][name]
-                        
-                        # -- loss = loss_{t} + ewc_lambda/2 * \sum_{i} F_{i}(param_{i} - param_{t-1, i})**2 -- #
-                        loss += self.ewc_lambda/2 * (fisher_value * (param - param_value).pow(2)).sum()
+            # -- The penalty is calculated for all tasks the model has already been trained on at once, only considering -- #
+            # -- those parameters in which the matching phrase is matched if desired or all -- #
+            # -- loss = loss_{t} + ewc_lambda/2 * \sum_{t} \sum_{i} F_{t, i}(param_{i} - param_{t, i})**2 -- #
+            loss = self._add_penalty(loss, self.ewc_lambda/2)
                 
         # -- Return the updated loss value -- #
         return loss
@@ -97,7 +125,7 @@ class MultipleOutputLossRW(MultipleOutputLossEWC):
         """
         # -- Update the parameters -- #
         super(MultipleOutputLossRW, self).update_ewc_params(fisher, params)
-        self.parameter_importance = parameter_importance
+        self.parameter_importance = parameter_importance    # --> The penalty engine has been reset by the parent
         # -- Omit last one since this is computed on the fly and is reserved for next task -- #
         self.tasks = list(self.fisher.keys())[:-1]
 
@@ -106,20 +134,9 @@ class MultipleOutputLossRW(MultipleOutputLossEWC):
         loss = super().forward(x, y, reg=False)
 
         # -- Update the loss as proposed in the paper and return this loss to the calling function instead -- #
-        # -- Loop through the tasks the model has already been trained on -- #
-        for task in self.tasks:
-            for name, param in self.network_params: # Get named parameters of the current model
-                # -- Only consider those parameters in which the matching phrase is matched if desired or all -- #
-                if (self.match_case and self.match_true and all(m_name in name for m_name in self.match))\
-                or (self.match_case and not self.match_true and all(m_name not in name for m_name in self.match))\
-                or (not self.match_case):                
-                    # -- Extract corresponding fisher and param values -- #
-                    fisher_value = self.fisher[task][name]
-                    param_value = self.params[task][name]
-                    importance = self.parameter_importance[task][name]
-                    
-                    # -- loss = loss_{t} + ewc_lambda * \sum_{i} (F_{i} + S(param_{i})) * (param_{i} - param_{t-1, i})**2 -- #
-                    loss += self.ewc_lambda * ((fisher_value + importance) * (param - param_value).pow(2)).sum()
+        # -- The penalty is calculated for all tasks the model has already been trained on at once -- #
+        # -- loss = loss_{t} + ewc_lambda * \sum_{t} \sum_{i} (F_{t, i} + S_{t, i}) * (param_{i} - param_{t, i})**2 -- #
+        loss = self._add_penalty(loss, self.ewc_lambda, self.parameter_importance)
                 
         # -- Return the updated loss value -- #
         return loss
@@ -221,8 +238,6 @@ class MultipleOutputLossPLOP(nn.Module):
         self.nr_classes = nr_classes
         self.pod_lambda = pod_lambda
         self.weight_factors = weight_factors
-        # self.ce = UnbiasedCrossEntropy(old_cl = self.nr_classes)  # Unbiased CE as in paper
-        self.ce = RobustCrossEntropyLoss(ignore_index=255)    # Use CE --> old_classes is 0 since we don't have changing labels between new tasks
 
     def update_plop_params(self, old_interm_results, interm_results, thresholds, max_entropy):
         r"""The old_interm_results and interm_results should be updated before calculating the loss (every batch).
@@ -245,10 +260,11 @@ class MultipleOutputLossPLOP(nn.Module):
         else:
             weights = self.weight_factors
 
-        pseudo_loss = weights[0] * self._pseudo_label_loss(x[0], x_o[0], y[0].squeeze(), idx=0)
-        for i in range(1, len(x)):
+        # -- Outputs with a weight of 0 are skipped completely -- #
+        pseudo_loss = 0
+        for i in range(len(x)):
             if weights[i] != 0:
-                pseudo_loss += weights[i] * self._pseudo_label_loss(x[i], x_o[i], y[i].squeeze(), idx=i)
+                pseudo_loss += weights[i] * self._pseudo_label_loss(x[i], x_o[i], y[i], idx=i)
                 
         # -- Update the loss as proposed in the paper and return this loss to the calling function instead -- #
         dist_loss = 0
@@ -270,49 +286,43 @@ class MultipleOutputLossPLOP(nn.Module):
     def _pseudo_label_loss(self, x, x_o, y, idx):
         r"""This function calculates the pseudo label loss using entropy dealing with the background shift.
             x_o should be the old models prediction and idx the index of the current selected output --> do not forget to detach x_o!
+            The probabilities, entropy, confidence mask and targets are computed once and both cross-entropy terms are
+            evaluated from a single per-voxel cross-entropy, since their targets never overlap.
+            NOTE: Empty sets are handled differently than before: if a sample has no background voxels, its adaptive factor is
+                  0 instead of 0/0 = NaN, and if there are no (NOT) pseudo labeled voxels, the corresponding CE term is 0 instead
+                  of NaN, so such a batch no longer results in a NaN loss.
         """
-        # -- Define the background mask --> everything that is 0 -- #
-        labels = copy.deepcopy(y)
-        mask_background = labels == 0
-
-        # -- Calculate the softmax of the old output -- #
-        probs = torch.softmax(x_o, dim=1)
-        # -- Extract the pseudo labels -- #
-        _, pseudo_labels = probs.max(dim=1)
-        # -- Extract the valid pseudo mask -- #
-        mask_valid_pseudo = (entropy(probs) / self.max_entropy) < self.thresholds[idx][pseudo_labels]
-        # -- Don't consider all labels that are not confident enough -- #
-        labels[~mask_valid_pseudo & mask_background] = 255
-        # -- Consider all other labels as pseudo ones -- #
-        labels[mask_valid_pseudo & mask_background] = pseudo_labels[mask_valid_pseudo & mask_background].float()
-        # -- Extract the number of certain background pixels -- #
-        num = (mask_valid_pseudo & mask_background).float().sum(dim=(1,2))
-        # -- Total number of bacground pixels -- #
-        den =  mask_background.float().sum(dim=(1,2))
-        # -- Calculate the adaptive factor -- #
-        classif_adaptive_factor = num / den
-        classif_adaptive_factor = classif_adaptive_factor[:, None, None]
-        
-        # -- NOT Pseudo Loss -- #
-        # -- Calculate the unbiased CE for the non pseudo labels --> Now use the actual output of current model -- #
-        mask = mask_background & mask_valid_pseudo
-        lab = copy.deepcopy(y)
-        if mask is not None:
-            lab[mask] = 255
-        loss_not_pseudo = self.ce(x, lab.long())
-
-        # -- Pseudo Loss -- #
-        # -- Prepare labels for the pseudo loss -- #
-        _labels = copy.deepcopy(y)
-        _labels[~(mask_background & mask_valid_pseudo)] = 255
-        _labels[mask_background & mask_valid_pseudo] = pseudo_labels[mask_background & mask_valid_pseudo].float()
-        # -- Calculate the pseudo loss -- #
-        # ce = RobustCrossEntropyLoss(ignore_index=255, reduction="none") # We have different datastructure than normal
-        loss_pseudo = self.ce(x, _labels)
-        
+        # -- Remove the channel dimension of the labels if there is one -- #
+        if y.dim() == x.dim():
+            y = y[:, 0]
+        spatial_dims = tuple(range(1, y.dim()))
+        with torch.no_grad():
+            # -- Define the background mask --> everything that is 0 -- #
+            mask_background = y == 0
+            # -- Calculate the softmax of the old output and extract the pseudo labels -- #
+            probs = torch.softmax(x_o.detach(), dim=1)
+            pseudo_labels = probs.argmax(dim=1)
+            # -- Entropy per voxel, see entropy(), normalized by the maximum entropy -- #
+            ent = torch.log(probs + 1e-8).mul_(probs).mean(dim=1).mul_(-1 / math.log(probs.size(1) + 1e-8))
+            # -- Background voxels with confident pseudo labels -- #
+            mask_pseudo = ent.div_(self.max_entropy).lt(self.thresholds[idx][pseudo_labels]).logical_and_(mask_background)
+            # -- Confident background voxels are trained on the pseudo labels, every other voxel on the actual labels -- #
+            targets = torch.where(mask_pseudo, pseudo_labels, y.long())
+            mask_labeled = targets != 255
+            mask_not_pseudo = mask_labeled & ~mask_pseudo
+            # -- The adaptive factor: number of certain background pixels / total number of background pixels -- #
+            # -- NOTE: Empty sets would lead to 0/0, so their terms are 0 instead -- #
+            num = mask_pseudo.sum(dim=spatial_dims)
+            classif_adaptive_factor = num / mask_background.sum(dim=spatial_dims).clamp_min(1)
+
+        # -- Calculate the CE once per voxel and split it into the pseudo and NOT pseudo loss -- #
+        ce = F.cross_entropy(x, targets, ignore_index=255, reduction='none')
+        loss_pseudo_sum = (ce * mask_pseudo).sum()
+        loss_pseudo = loss_pseudo_sum / num.sum().clamp_min(1)
+        loss_not_pseudo = (ce.sum() - loss_pseudo_sum) / mask_not_pseudo.sum().clamp_min(1)
+
         # -- Return the joined loss -- #
-        loss = classif_adaptive_factor * (loss_pseudo + loss_not_pseudo)
-        return loss.mean()
+        return classif_adaptive_factor.float().mean() * (loss_pseudo + loss_not_pseudo)
 
 # -- Loss function that only considers POD, no local pseudo labeling as in PLOP -- #
 class MultipleOutputLossPOD(MultipleOutputLoss2):
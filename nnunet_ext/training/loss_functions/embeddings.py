@@ -1,4 +1,5 @@
 import torch
+import torch.nn.functional as F
 
 def pod_embed(embedding_tensor):
         # -- Calculate the POD embedding -- #
@@ -6,17 +7,64 @@ def pod_embed(embedding_tensor):
         h_p = torch.mean(embedding_tensor, -2)  # Over H: W × C height-pooled slices of embedding_tensor using mean
         return torch.cat((w_p, h_p), dim=2)       # Concat over C axis
 
+def block_sums(embedding_tensor, dim, size, n):
+        # -- Sum over n consecutive blocks of the provided size along dim (-1 or -2), which is replaced by the n blocks -- #
+        # -- The complete blocks are reshaped (a view, no copy), blocks at the border are cut off or even empty -- #
+        length = embedding_tensor.size(dim)
+        full = min(n, length // size)
+        sums = list()
+        if full > 0:
+            x = embedding_tensor.narrow(dim, 0, full*size)
+            d = dim % x.dim()
+            sums.append(x.reshape(*x.shape[:d], full, size, *x.shape[d+1:]).sum(d+1))
+        for j in range(full, n):
+            start = min(j*size, length)
+            sums.append(embedding_tensor.narrow(dim, start, min(size, length - start)).sum(dim, keepdim=True))
+        sizes = torch.tensor([min(size, max(0, length - j*size)) for j in range(n)], device=embedding_tensor.device, dtype=embedding_tensor.dtype)
+        return (torch.cat(sums, dim) if len(sums) > 1 else sums[0]), sizes
+
+def fit_windows(x, dim, size, n):
+        # -- Crop or zero pad dim to n*size and split it into n windows, padded values have no influence on the L2 norm -- #
+        length = x.size(dim)
+        x = x.narrow(dim, 0, n*size) if n*size <= length else torch.cat((x, x.new_zeros(*x.shape[:dim % x.dim()], n*size - length, *x.shape[dim % x.dim()+1:])), dim)
+        d = dim % x.dim()
+        return x.reshape(*x.shape[:d], n, size, *x.shape[d+1:])
+
+def pooled_windows(embedding_tensor, w, h, n_w, n_h):
+        # -- Calculate the width- and height-pooled slices of all n_w x n_h windows of size w x h at once -- #
+        # -- Every slice is reduced along its pooled axis first, so no tensor of the full size is created -- #
+        # -- Windows at the border might be cut off, so divide by their actual size like pod_embed on the sliced window -- #
+        w_p, h_sizes = block_sums(embedding_tensor, -1, h, n_h)        # (..., H, n_h)
+        h_p, w_sizes = block_sums(embedding_tensor, -2, w, n_w)        # (..., n_w, W)
+        w_p = fit_windows(w_p / h_sizes, -2, w, n_w)                    # (..., n_w, w, n_h)
+        h_p = fit_windows(h_p / w_sizes.view(-1, 1), -1, h, n_h)        # (..., n_w, n_h, h)
+        return w_p, h_p
+
+def finest_window_sums(embedding_tensor, w, h, n_w, n_h):
+        # -- Calculate the row sums of every column block and the column sums of every row block of the n_w x n_h windows -- #
+        # -- of size w x h, ie. one pass over the tensor, the windows need to fit into the tensor -- #
+        x = embedding_tensor[..., :n_w*w, :n_h*h]
+        x = x.reshape(*x.shape[:-2], n_w, w, n_h, h)
+        return x.sum(-1).flatten(-3, -2), x.sum(-3)     # (..., n_w*w, n_h) and (..., n_w, n_h, h)
+
+def nested_windows(row_sums, col_sums, w_f, h_f, w, h, n_w, n_h):
+        # -- Derive the width- and height-pooled slices of n_w x n_h windows of size w x h from the sums of the finest -- #
+        # -- windows of size w_f x h_f, where w and h are multiples of w_f and h_f -- #
+        w_p = row_sums[..., :n_w*w, :n_h*(h//h_f)]
+        w_p = w_p.reshape(*w_p.shape[:-2], n_w, w, n_h, h//h_f).sum(-1) / h        # (..., n_w, w, n_h)
+        h_p = col_sums[..., :n_w*(w//w_f), :n_h*(h//h_f), :].flatten(-2, -1)
+        h_p = h_p.reshape(*h_p.shape[:-2], n_w, w//w_f, n_h, h).sum(-3) / w       # (..., n_w, n_h, h)
+        return w_p, h_p
+
 def local_POD(h_, h_old, scales):
         # -- Calculate the local POD embedding using intermediate convolutional outputs -- #
         assert h_.size() == h_old.size(), "The embedding tensors of the current and old model should have the same shape.."
-        
-        # -- Initialize the embedding lists/tensors that are filled in the double for loop -- #
-        POD_ = None
-        POD_old = None
+
         # -- Extract the height and width of the current embeddings -- #
         W = h_.size(-1)
         H = h_.size(-2)
-        # -- Calculate embeddings for every scale in scales -- #
+        # -- Calculate the window sizes and numbers for every scale in scales -- #
+        windows = list()
         for scale in range(0, scales, 1):  # step size = 1
             # -- Calculate step sizes -- #
             w = int(W/(2**scale))
@@ -25,17 +73,42 @@ def local_POD(h_, h_old, scales):
             assert w > 0 and h > 0,\
                 "The number of scales ({}) are too big in such a way that during scale {} either the step size for H ({}) or W ({}) is 0..".format(scales, scale, h, w)
 
-            # -- Loop through W and H in h and w steps -- #
-            for i in range(0, W-w, w):
-                for j in range(0, H-h, h):
-                    # -- Calculate the POD embeddings for the extracted slice based on i and j -- #
-                    pod_ = pod_embed(h_[..., i:i+w, j:j+h])
-                    pod_old = pod_embed(h_old[..., i:i+w, j:j+h])
-                    # -- In-Place concatenation of the POD embeddings along channels axis -- #
-                    POD_ = pod_ if POD_ is None else torch.cat((POD_, pod_), dim=2)                  # concat over channel axis --> 0 batch 1 channel ?
-                    POD_old = pod_old if POD_old is None else torch.cat((POD_old, pod_old), dim=2)   # concat over channel axis --> 0 batch 1 channel ?
+            # -- The windows start at every w along the height and every h along the width, ie. i in range(0, W-w, w) and j in range(0, H-h, h) -- #
+            # -- NOTE: Like in the original implementation the last window is not used, eg. scale 0 has no window at all -- #
+            n_w, n_h = len(range(0, W-w, w)), len(range(0, H-h, h))
+            if n_w > 0 and n_h > 0:
+                windows.append((w, h, n_w, n_h))
+        if len(windows) == 0:
+            return torch.zeros((), device=h_.device, dtype=h_.dtype)
+
+        # -- If the windows of every scale consist of the windows of the finest scale, the tensors are only pooled once -- #
+        # -- NOTE: The embeddings are means, so the difference of the embeddings is the embedding of the difference, -- #
+        # --       they are calculated separately so the difference of the full tensors is never created -- #
+        w_f, h_f, n_wf, n_hf = windows[-1]
+        nested = n_wf*w_f <= H and n_hf*h_f <= W and all(w % w_f == 0 and h % h_f == 0 and n_w*w <= n_wf*w_f and n_h*h <= n_hf*h_f
+                                                         for w, h, n_w, n_h in windows)
+        if nested:
+            (row_sums, col_sums), (row_sums_old, col_sums_old) = [finest_window_sums(t, w_f, h_f, n_wf, n_hf) for t in (h_, h_old)]
+            row_sums, col_sums = row_sums - row_sums_old, col_sums - col_sums_old
+
+        # -- Calculate the embeddings of all windows for every scale -- #
+        embeddings = list()
+        for w, h, n_w, n_h in windows:
+            if nested:
+                w_p, h_p = nested_windows(row_sums, col_sums, w_f, h_f, w, h, n_w, n_h)
+            else:
+                w_p, h_p = pooled_windows(h_, w, h, n_w, n_h)
+                w_p_old, h_p_old = pooled_windows(h_old, w, h, n_w, n_h)
+                w_p, h_p = w_p - w_p_old, h_p - h_p_old
+            if h_.dim() == 4:
+                # -- 2D: Every sample and channel has one embedding vector consisting of all windows at all scales -- #
+                embeddings.extend([w_p.flatten(start_dim=2), h_p.flatten(start_dim=2)])
+            else:
+                # -- 3D: The embeddings are concatenated along the depth, so every pooled slice is a vector on its own -- #
+                embeddings.extend([w_p.transpose(-1, -2).flatten(start_dim=0, end_dim=-2), h_p.flatten(start_dim=0, end_dim=-2)])
 
         # -- Return the L2 distance between the POD embeddings based on their original implementation from here: -- #
         # -- https://github.com/arthurdouillard/CVPR2021_PLOP/blob/0fb13774735961a6cb50ccfee6ca99d0d30b27bc/train.py#L934 -- #
-        layer_loss = torch.stack([torch.linalg.norm(p_ - p_o, dim=-1) for p_, p_o in zip(POD_, POD_old)])
-        return torch.mean(layer_loss)
\ No newline at end of file
+        if h_.dim() == 4:
+            return torch.mean(torch.linalg.norm(torch.cat(embeddings, dim=-1), dim=-1))
+        return torch.mean(torch.cat([torch.linalg.norm(e, dim=-1) for e in embeddings]))
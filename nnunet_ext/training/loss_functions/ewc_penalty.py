@@ -0,0 +1,192 @@
+#########################################################################################################
+#----------This class represents the penalty engine for the EWC based loss functions.-------------------#
+#########################################################################################################
+
+import torch
+
+# -- Define the key under which the consolidated values of all finished tasks are stored -- #
+CONSOLIDATED_KEY = 'consolidated'
+
+def consolidate_ewc_values(weights, anchors, task, key=CONSOLIDATED_KEY):
+    r"""This function folds the weights (eg. Fisher values) and anchor parameters of task into the consolidated values
+        stored under key and removes the values of task from both dictionaries. Since
+        \sum_{t} F_{t} * (param - param_{t})**2 = P * (param - m)**2 + const with the accumulated precision P = \sum_{t} F_{t}
+        and the precision-weighted anchor m = \sum_{t} F_{t} * param_{t} / P, the penalty of all finished tasks only needs
+        the memory of a single task while its gradients are identical. Only the constant value of the penalty is omitted.
+        :param weights: Dictionary with the weights per task and parameter name
+        :param anchors: Dictionary with the anchor parameters per task and parameter name
+        :param task: The task that should be folded into the consolidated values
+        :param key: The key under which the consolidated values are stored
+    """
+    task_weights, task_anchors = weights.pop(task), anchors.pop(task)
+    prec, mean = weights.get(key, dict()), anchors.get(key, dict())
+    for name, anchor in task_anchors.items():
+        # -- Weights might be a single value for parameters without gradients, so expand them to the parameter shape -- #
+        weight = task_weights[name].to(anchor.device).expand_as(anchor)
+        if name not in prec:
+            prec[name], mean[name] = weight.clone(), anchor.clone()
+        else:
+            new_prec = prec[name].to(anchor.device) + weight
+            # -- Where the accumulated precision is 0 the anchor has no influence, so simply use the new one -- #
+            mean[name] = torch.where(new_prec > 0, (prec[name].to(anchor.device) * mean[name].to(anchor.device) + weight * anchor) / new_prec, anchor)
+            prec[name] = new_prec
+    weights[key], anchors[key] = prec, mean
+
+class FlatEWCPenalty():
+    r"""This class calculates the quadratic penalty \sum_{t} \sum_{i} W_{t, i} * (param_{i} - param_{t, i})**2 of the EWC based
+        approaches (EWC, RW, Own approaches). Instead of looping over every task and every named parameter, the matched
+        parameters, weights (eg. Fisher values) and anchor parameters of all tasks are flattened into contiguous buffers
+        once, so the penalty is calculated with a handful of fused operations. The values in the provided dictionaries
+        are replaced by views into these buffers, so they are not stored twice. Instead of adding the penalty to the loss,
+        its gradient can also be added directly to the gradients of the parameters after the backward pass using
+        add_gradients, so autograd does not need to build a graph for the penalty at all.
+    """
+    def __init__(self, match_sth=False, match=list(), match_true=True):
+        r"""Constructor of the penalty engine.
+            :param match_sth: Set this to True if only parameters matching the phrases in match should be considered
+            :param match: List of phrases that are used for the matching
+            :param match_true: If True all phrases need to be in the name of a parameter, otherwise none of them
+        """
+        self.match_case = match_sth
+        self.match = match
+        self.match_true = match_true
+
+        # -- Cache the matching per parameter name since the names do not change during training -- #
+        self._matches = dict()
+        self.reset()
+
+    def reset(self):
+        r"""This function removes the flattened buffers, so they are built again during the next call. Call it
+            whenever the weights or anchor parameters changed.
+        """
+        self._layout = None
+        self._weights = None
+        self._anchors = None
+        self._importance = None
+        self._precision = None
+        self._weighted_anchors = None
+        self._last = None
+
+    def matches(self, name):
+        r"""This function returns if the parameter with the provided name should be considered in the penalty.
+        """
+        if name not in self._matches:
+            self._matches[name] = (self.match_case and self.match_true and all(m_name in name for m_name in self.match))\
+                                  or (self.match_case and not self.match_true and all(m_name not in name for m_name in self.match))\
+                                  or (not self.match_case)
+        return self._matches[name]
+
+    def __call__(self, network_params, tasks, weights, anchors, importance=None):
+        r"""This function calculates the penalty for the current network parameters.
+            :param network_params: Iterable of (name, param) tuples of the current model, eg. model.named_parameters()
+            :param tasks: List of tasks that should be considered
+            :param weights: Dictionary with the weights per task and parameter name, eg. the Fisher values
+            :param anchors: Dictionary with the anchor parameters per task and parameter name
+            :param importance: Optional dictionary with values that are added to the weights (eg. RW scores)
+            :return: The penalty as a scalar tensor
+        """
+        params = self._prepare(network_params, tasks, weights, anchors, importance)
+        if params is None:
+            return 0
+
+        # -- Calculate the penalty for all tasks at once: W * (param - anchor)**2 -- #
+        flat_params = torch.cat([p.reshape(-1) for p in params])
+        return (self._total_weights() * (flat_params.unsqueeze(0) - self._anchors).pow(2)).sum()
+
+    @torch.no_grad()
+    def add_gradients(self, network_params, tasks, weights, anchors, factor, importance=None):
+        r"""This function adds the gradient of factor * penalty, ie. 2 * factor * \sum_{t} W_{t} * (param - param_{t}),
+            to the .grad of the parameters. Call it after the backward pass of the loss without the penalty. Since
+            \sum_{t} W_{t} * (param - param_{t}) = (\sum_{t} W_{t}) * param - \sum_{t} W_{t} * param_{t}, only two flat
+            buffers are necessary for this, independent of the number of tasks.
+            :param network_params: Iterable of (name, param) tuples of the current model, eg. model.named_parameters()
+            :param tasks: List of tasks that should be considered
+            :param weights: Dictionary with the weights per task and parameter name, eg. the Fisher values
+            :param anchors: Dictionary with the anchor parameters per task and parameter name
+            :param factor: The factor of the penalty, eg. ewc_lambda/2 for EWC
+            :param importance: Optional dictionary with values that are added to the weights (eg. RW scores)
+        """
+        params = self._prepare(network_params, tasks, weights, anchors, importance)
+        if params is None:
+            self._last = None
+            return
+        if self._precision is None:
+            weights = self._total_weights()
+            self._precision = weights.sum(0)
+            self._weighted_anchors = (weights * self._anchors).sum(0)
+            del weights
+
+        # -- Calculate the gradient for all parameters at once and add it to the gradients of every parameter -- #
+        flat_params = torch.cat([p.detach().reshape(-1) for p in params])
+        grads = (2 * factor) * (self._precision * flat_params - self._weighted_anchors)
+        for param, grad in zip(params, grads.split([p.numel() for p in params])):
+            if param.grad is None:
+                param.grad = grad.view_as(param).to(param.dtype)
+            else:
+                param.grad.add_(grad.view_as(param))
+
+        # -- Keep the parameters so the penalty can be calculated later on if it is necessary, eg. for logging -- #
+        self._last = (flat_params, factor)
+
+    @torch.no_grad()
+    def last_value(self):
+        r"""This function calculates the penalty for the parameters of the last add_gradients call. It is only computed
+            when it is called, so the penalty value does not have to be calculated during every iteration.
+            :return: The penalty as a float, 0 if add_gradients did not add anything
+        """
+        if self._last is None:
+            return 0
+        flat_params, factor = self._last
+        return factor * (self._total_weights() * (flat_params.unsqueeze(0) - self._anchors).pow(2)).sum().item()
+
+    def _total_weights(self):
+        r"""This function returns the weights of the penalty, ie. the weights plus the importance values if provided.
+            They are only added when necessary, so the sum is not stored next to the flattened weights and importance values.
+        """
+        return self._weights if self._importance is None else self._weights + self._importance
+
+    def _prepare(self, network_params, tasks, weights, anchors, importance=None):
+        r"""This function extracts the matched parameters and builds the flattened buffers if necessary.
+            :return: The list of matched parameters or None if there is nothing to regularize
+        """
+        # -- Extract the matched parameters, the iterable might be a generator so it can be used only once -- #
+        # -- Frozen parameters can not change, so they are not considered and have no Fisher values -- #
+        names, params = list(), list()
+        for name, param in network_params:
+            if param.requires_grad and self.matches(name):
+                names.append(name)
+                params.append(param)
+        if len(tasks) == 0 or len(params) == 0:
+            return None
+
+        # -- Build the flattened buffers if they do not exist or the parameters changed -- #
+        layout = (tuple(tasks), tuple(names), tuple(tuple(p.shape) for p in params), params[0].device, params[0].dtype)
+        if layout != self._layout:
+            self._build(layout, names, tasks, weights, anchors, importance)
+        return params
+
+    def _build(self, layout, names, tasks, weights, anchors, importance=None):
+        r"""This function flattens the weights, anchors and importance values of every task into buffers of shape
+            (nr_tasks, nr_params). Every value that is already on the device with the dtype of the buffers is replaced
+            by a view into the buffer in its dictionary, so the buffers are the only storage of these values.
+        """
+        device, dtype, shapes = layout[-2], layout[-1], layout[2]
+        numels = [int(torch.Size(shape).numel()) for shape in shapes]
+
+        def _flatten(values):
+            buffer = torch.empty((len(tasks), sum(numels)), device=device, dtype=dtype)
+            for idx, task in enumerate(tasks):
+                for view, name, shape in zip(buffer[idx].split(numels), names, shapes):
+                    view, value = view.view(shape), values[task][name]
+                    # -- Values might be a single value for parameters without gradients, so expand them to the parameter shape -- #
+                    view.copy_(value.detach().expand(shape))
+                    # -- Replace the value if it would be a second copy of the view, values with gradients are kept -- #
+                    if value.device == device and value.dtype == dtype and value.shape == view.shape and not value.requires_grad:
+                        values[task][name] = view
+            return buffer
+
+        self._weights = _flatten(weights)
+        self._anchors = _flatten(anchors)
+        self._importance = _flatten(importance) if importance is not None else None
+        self._precision, self._weighted_anchors = None, None
+        self._layout = layout
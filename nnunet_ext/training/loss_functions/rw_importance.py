@@ -0,0 +1,87 @@
+#########################################################################################################
+#-------This class represents the engine for the RW importance scores and the online Fisher values.-----#
+#########################################################################################################
+
+import torch
+
+class RWImportance():
+    r"""This class updates the importance scores and the online (EWC++) Fisher values of the Riemannian Walk
+        (https://arxiv.org/pdf/1801.10112.pdf). The Fisher values, scores and the parameters of the previous update
+        of all trainable parameters are kept in flattened buffers on the device of the network. The dictionaries that
+        are returned by bind only contain views into these buffers, so one update consists of a handful of fused
+        operations over all parameters and the parameters never leave the device.
+    """
+    def __init__(self, alpha, epsilon=1e-8):
+        r"""Constructor of the RW engine.
+            :param alpha: The factor of the current squared gradients in the moving average of the Fisher values
+            :param epsilon: Small value that is added to the denominator of the scores
+        """
+        self.alpha = alpha
+        self.epsilon = epsilon
+        self.reset()
+
+    def reset(self):
+        r"""This function removes all buffers, call bind before the next update.
+        """
+        self._params = None
+        self._fisher = None
+        self._scores = None
+        self._prev = None
+        self._weights = dict()
+
+    def bind(self, network_params):
+        r"""This function builds zero initialized Fisher and score buffers for the trainable parameters.
+            :param network_params: Iterable of (name, param) tuples of the current model, eg. model.named_parameters()
+            :return: Two dictionaries of the form {name: tensor} holding the Fisher values and scores of every parameter
+        """
+        self.reset()
+        # -- If the network is split onto several GPUs, the buffers are on the device of the first parameter -- #
+        self._params = [(name, param) for name, param in network_params if param.requires_grad]
+        assert len(self._params) > 0, "There are no trainable parameters to calculate the RW values for."
+        device = self._params[0][1].device
+        numel = sum(p.numel() for _, p in self._params)
+        self._fisher = torch.zeros(numel, device=device)
+        self._scores = torch.zeros(numel, device=device)
+        return self._views(self._fisher), self._views(self._scores)
+
+    @torch.no_grad()
+    def update(self):
+        r"""This function updates the scores and the Fisher values using the current gradients of the parameters.
+            Parameters without gradients are not changed, just like in the reference implementation.
+        """
+        assert self._fisher is not None, "Call bind before the first update."
+        grads = [p.grad for _, p in self._params]
+        has_grad = tuple(g is not None for g in grads)
+        if not any(has_grad):
+            return
+        flat_grads = torch.cat([g.detach().reshape(-1).to(self._fisher) if g is not None else self._fisher.new_zeros(p.numel())
+                                for g, (_, p) in zip(grads, self._params)])
+        flat_params = torch.cat([p.detach().reshape(-1).to(self._fisher) for _, p in self._params])
+
+        # -- Score: delta(L) / 0.5*F_t*delta(param)^2 = g * (prev - param) / (0.5*F_t*(prev - param)^2 + eps) --> only positive or zero values -- #
+        # -- Parameters without gradients have zero gradients here, so their scores do not change -- #
+        if self._prev is not None:
+            delta = self._prev.sub_(flat_params)
+            den = torch.addcmul(torch.full_like(delta, self.epsilon), self._fisher, delta.pow(2), value=0.5)
+            self._scores.add_((flat_grads * delta).div_(den).clamp_min_(0))
+        self._prev = flat_params
+
+        # -- Update the Fisher values: F_t = alpha * g^2 + (1-alpha) * F_t-1 as a single lerp -- #
+        self._fisher.lerp_(flat_grads.pow_(2), self._weight(has_grad))
+
+    def _weight(self, has_grad):
+        r"""This function returns the weight of the Fisher lerp, ie. alpha or a flat buffer that is 0 for every parameter
+            without gradients, so their Fisher values do not change. The buffer is cached per gradient pattern.
+        """
+        if all(has_grad):
+            return self.alpha
+        if has_grad not in self._weights:
+            self._weights[has_grad] = torch.cat([torch.full((p.numel(),), self.alpha if g else 0., device=self._fisher.device)
+                                                 for g, (_, p) in zip(has_grad, self._params)])
+        return self._weights[has_grad]
+
+    def _views(self, buffer):
+        r"""This function splits the flat buffer into views of the parameter shapes.
+        """
+        views = buffer.split([p.numel() for _, p in self._params])
+        return {name: view.view_as(p) for view, (name, p) in zip(views, self._params)}
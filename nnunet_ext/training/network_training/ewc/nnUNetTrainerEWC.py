@@ -9,17 +9,38 @@
 
 import torch
 from time import time
-from torch.cuda.amp import autocast
+from tqdm import trange
 from nnunet_ext.paths import default_plans_identifier
-from nnunet.utilities.to_torch import maybe_to_torch, to_cuda
+from nnunet.utilities.to_torch import maybe_to_torch
 from batchgenerators.utilities.file_and_folder_operations import *
 from nnunet.training.loss_functions.dice_loss import DC_and_CE_loss
+from nnunet.training.loss_functions.deep_supervision import MultipleOutputLoss2
 from nnunet_ext.training.loss_functions.deep_supervision import MultipleOutputLossEWC as EWCLoss
+from nnunet_ext.training.loss_functions.ewc_penalty import CONSOLIDATED_KEY, consolidate_ewc_values
+from nnunet_ext.utilities.tensor_store import STORE_DEVICE, TensorStore, load_tensor_values
 from nnunet_ext.training.network_training.multihead.nnUNetTrainerMultiHead import nnUNetTrainerMultiHead
 
 # -- Define globally the Hyperparameters for this trainer along with their type -- #
 HYPERPARAMS = {'ewc_lambda': float}
 
+def get_fisher_parameters(trainer):
+    r"""This function returns the (name, param) tuples of the network of trainer for which Fisher values are estimated, ie.
+        all parameters that require a gradient and are considered by the EWC loss, eg. only the ViT parameters for EWC ViT.
+        It is used by every trainer that estimates Fisher values with nnUNetTrainerEWC.after_train, eg. the own methods.
+    """
+    # -- The own methods train the first task with a loss without EWC, so use their own loss for the matching -- #
+    loss = trainer.loss if hasattr(trainer.loss, 'ewc_penalty') else getattr(trainer, 'own_loss', trainer.loss)
+    matches = loss.ewc_penalty.matches if hasattr(loss, 'ewc_penalty') else (lambda name: True)
+    return [(name, param) for name, param in trainer.network.named_parameters() if param.requires_grad and matches(name)]
+
+def get_task_loss(loss, output, target):
+    r"""This function calculates the loss of the current task without any regularization, ie. the loss the
+        Fisher values are estimated for.
+    """
+    if isinstance(loss, MultipleOutputLoss2):
+        return MultipleOutputLoss2.forward(loss, output, target)
+    return loss(output, target)
+
 class nnUNetTrainerEWC(nnUNetTrainerMultiHead):
     def __init__(self, split, task, plans_file, fold, output_folder=None, dataset_directory=None, batch_dice=True, stage=None,
                  unpack_data=True, deterministic=True, fp16=False, save_interval=5, already_trained_on=None, use_progress=True,
@@ -69,20 +90,31 @@ class nnUNetTrainerEWC(nnUNetTrainerMultiHead):
             self.fisher = dict()
             self.params = dict()
         else:
-            self.fisher = load_pickle(self.already_trained_on[str(self.fold)]['fisher_at'])
-            self.params = load_pickle(self.already_trained_on[str(self.fold)]['params_at'])
-
-            # -- Put data on GPU since the data is moved to CPU before it is stored -- #
-            for task in self.fisher.keys():
-                for key in self.fisher[task].keys():
-                    to_cuda(self.fisher[task][key])
-            for task in self.params.keys():
-                for key in self.params[task].keys():
-                    to_cuda(self.params[task][key])
+            # -- The values of a task are only loaded (onto the GPU) once they are used -- #
+            self.fisher = load_tensor_values(self.already_trained_on[str(self.fold)]['fisher_at'], STORE_DEVICE)
+            self.params = load_tensor_values(self.already_trained_on[str(self.fold)]['params_at'], STORE_DEVICE)
 
         # -- Define the path where the fisher and param values should be stored/restored -- #
         self.ewc_data_path = join(self.trained_on_path, 'ewc_data')
 
+        # -- Specify if the fisher and param values of finished tasks should be folded into one consolidated set of values -- #
+        # -- so the memory and time of the EWC loss stay constant with the number of tasks, see consolidate_ewc_values -- #
+        self.consolidate_ewc = False
+        # -- Specify if the per task values should still be stored for analysis when they are consolidated -- #
+        self.keep_task_ewc_values = False
+
+        # -- Specify if the gradient of the EWC penalty should be added to the gradients after the backward pass instead -- #
+        # -- of adding the penalty to the loss, so no graph needs to be built for it, see MultipleOutputLossEWC -- #
+        self.ewc_grad_hook = False
+
+        # -- Specify the number of batches used to estimate the Fisher values (None: num_batches_per_epoch) and if the -- #
+        # -- forward pass should be autocasted (None: as during training, 'none', 'fp16' or 'bf16'), see after_train -- #
+        self.fisher_batches = None
+        self.fisher_autocast = None
+
+        # -- Specify if the fisher and param values should be stored in half precision -- #
+        self.tensor_store_fp16 = False
+
     def initialize(self, training=True, force_load_plans=False, num_epochs=500, prev_trainer_path=None, call_for_eval=False):
         r"""Overwrite the initialize function so the correct Loss function for the EWC method can be set.
         """
@@ -92,16 +124,9 @@ class nnUNetTrainerEWC(nnUNetTrainerMultiHead):
         # -- If this trainer has already trained on other tasks, then extract the fisher and params -- #
         if prev_trainer_path is not None and self.already_trained_on[str(self.fold)]['fisher_at'] is not None\
                                          and self.already_trained_on[str(self.fold)]['params_at'] is not None:
-            self.fisher = load_pickle(self.already_trained_on[str(self.fold)]['fisher_at'])
-            self.params = load_pickle(self.already_trained_on[str(self.fold)]['params_at'])
-
-            # -- Put data on GPU since the data is moved to CPU before it is stored -- #
-            for task in self.fisher.keys():
-                for key in self.fisher[task].keys():
-                    to_cuda(self.fisher[task][key])
-            for task in self.params.keys():
-                for key in self.params[task].keys():
-                    to_cuda(self.params[task][key])
+            # -- The values of a task are only loaded (onto the GPU) once they are used -- #
+            self.fisher = load_tensor_values(self.already_trained_on[str(self.fold)]['fisher_at'], STORE_DEVICE)
+            self.params = load_tensor_values(self.already_trained_on[str(self.fold)]['params_at'], STORE_DEVICE)
         
         # -- Reset self.loss from MultipleOutputLoss2 to DC_and_CE_loss so the EWC Loss can be initialized properly -- #
         self.loss = DC_and_CE_loss({'batch_dice': self.batch_dice, 'smooth': 1e-5, 'do_bg': False}, {})
@@ -129,14 +154,6 @@ class nnUNetTrainerEWC(nnUNetTrainerMultiHead):
             # -- Print Loss update -- #
             self.print_to_log_file("I am using EWC loss now")
         
-        # -- Put data on GPU since the data is moved to CPU before it is stored -- #
-        for task in self.fisher.keys():
-            for key in self.fisher[task].keys():
-                to_cuda(self.fisher[task][key])
-        for task in self.params.keys():
-            for key in self.params[task].keys():
-                to_cuda(self.params[task][key])
-
         # -- Update the fisher and param values in the loss function -- #
         self.loss.update_ewc_params(self.fisher, self.params)
 
@@ -148,10 +165,16 @@ class nnUNetTrainerEWC(nnUNetTrainerMultiHead):
                   to train, so it will be 500 and it does not set a prev_trainer. The prev_trainer will be set to None!
                   --> Initialize the trainer using your desired num_epochs and prev_trainer before calling run_training.  
         """
+        # -- Set the regularization mode of the loss -- #
+        self.loss.ewc_grad_hook = self.ewc_grad_hook
+
         # -- If there is at least one head and the current task is not in the heads, the network has finished on one task -- #
         # -- In such a case the fisher/param values should exist and should not be empty -- #
+        # -- Consolidated tasks are not in the fisher/param values anymore, so count them separately -- #
+        consolidated = self.already_trained_on[str(self.fold)].get('ewc_consolidated_tasks', list())
+        nr_tasks = lambda values: len(values) - int(CONSOLIDATED_KEY in values) + len(consolidated)
         if len(self.mh_network.heads) > 0 and task not in self.mh_network.heads:
-            assert len(self.fisher) == len(self.mh_network.heads) and len(self.params) == len(self.mh_network.heads),\
+            assert nr_tasks(self.fisher) == len(self.mh_network.heads) and nr_tasks(self.params) == len(self.mh_network.heads),\
             "The number of tasks in the fisher/param values are not as expected --> should be the same as in the Multi Head network."
 
         # -- Execute the training for the desired epochs -- #
@@ -166,23 +189,20 @@ class nnUNetTrainerEWC(nnUNetTrainerMultiHead):
         # -- This will update the parameters for the current task in self.fisher and self.params -- #
         self.after_train()
 
-        # -- Put data from GPU to CPU before storing them in files -- #
-        for task in self.fisher.keys():
-            for key in self.fisher[task].keys():
-                self.fisher[task][key].cpu()
-        for task in self.params.keys():
-            for key in self.params[task].keys():
-                self.params[task][key].cpu()
+        # -- Fold the values of all finished tasks into the consolidated values if desired -- #
+        if self.consolidate_ewc:
+            self.consolidate_ewc_values()
 
-        # -- Dump both dicts as pkl files -- #
-        maybe_mkdir_p(self.ewc_data_path)
-        write_pickle(self.fisher, join(self.ewc_data_path, 'fisher_values.pkl'))
-        write_pickle(self.params, join(self.ewc_data_path, 'param_values.pkl'))
+        # -- Store both dicts, only the values of the current (or consolidated) task changed, so only they are written -- #
+        changed = [task, CONSOLIDATED_KEY]
+        TensorStore(join(self.ewc_data_path, 'fisher_values'), self.tensor_store_fp16).save(self.fisher, changed)
+        TensorStore(join(self.ewc_data_path, 'param_values'), self.tensor_store_fp16).save(self.params, changed)
 
-        if self.already_trained_on[str(self.fold)]['fisher_at'] is None or self.already_trained_on[str(self.fold)]['params_at'] is None:
+        if self.already_trained_on[str(self.fold)]['fisher_at'] != join(self.ewc_data_path, 'fisher_values')\
+        or self.already_trained_on[str(self.fold)]['params_at'] != join(self.ewc_data_path, 'param_values'):
             # -- Update the already_trained_on file that the values exist if necessary -- #
-            self.already_trained_on[str(self.fold)]['fisher_at'] = join(self.ewc_data_path, 'fisher_values.pkl')
-            self.already_trained_on[str(self.fold)]['params_at'] = join(self.ewc_data_path, 'param_values.pkl')
+            self.already_trained_on[str(self.fold)]['fisher_at'] = join(self.ewc_data_path, 'fisher_values')
+            self.already_trained_on[str(self.fold)]['params_at'] = join(self.ewc_data_path, 'param_values')
             
             # -- Save the updated dictionary as a json file -- #
             save_json(self.already_trained_on, join(self.trained_on_path, self.extension+'_trained_on.pkl'))
@@ -193,6 +213,27 @@ class nnUNetTrainerEWC(nnUNetTrainerMultiHead):
         
         return ret  # Finished with training for the specific task
 
+    def consolidate_ewc_values(self):
+        r"""This function folds the fisher and param values of every task into the consolidated values, ie. the accumulated
+            fisher values and the fisher weighted params. The EWC loss then only has to consider one set of values
+            independent of the number of tasks, while the gradients are identical to the ones using the per task values.
+            If self.keep_task_ewc_values is set, the per task values are stored in the ewc_data folder for analysis beforehand.
+        """
+        consolidated = self.already_trained_on[str(self.fold)].setdefault('ewc_consolidated_tasks', list())
+        for task in [t for t in self.fisher.keys() if t != CONSOLIDATED_KEY]:
+            # -- Store the per task values if they should be kept for analysis -- #
+            if self.keep_task_ewc_values:
+                TensorStore(join(self.ewc_data_path, 'task_values', 'fisher_values'), self.tensor_store_fp16).save_task(task, self.fisher[task])
+                TensorStore(join(self.ewc_data_path, 'task_values', 'param_values'), self.tensor_store_fp16).save_task(task, self.params[task])
+            consolidate_ewc_values(self.fisher, self.params, task)
+            consolidated.append(task)
+
+        # -- Update the values in the loss function since the tasks changed -- #
+        self.loss.update_ewc_params(self.fisher, self.params)
+
+        # -- Save the updated dictionary so the consolidated tasks are known when restoring -- #
+        save_json(self.already_trained_on, join(self.trained_on_path, self.extension+'_trained_on.pkl'))
+
     def run_iteration(self, data_generator, do_backprop=True, run_online_evaluation=False, detach=True, no_loss=False):
         r"""This function needs to be changed for the EWC method, since it is very important, even
             crucial to update the current models network parameters that will be used in the loss function
@@ -215,60 +256,77 @@ class nnUNetTrainerEWC(nnUNetTrainerMultiHead):
 
     def after_train(self):
         r"""This function needs to be executed once the training of the current task is finished.
-            The function will use the same data to generate the gradients again and setting the
-            models parameters.
+            The function estimates the (empirical) Fisher values as the running mean of the squared gradients of the
+            loss over self.fisher_batches batches, without changing the weights, and sets the models parameters.
+            Only parameters that require a gradient and are considered by the EWC loss (matching) are estimated.
+            The values are accumulated in-place on the device of the network. If self.fisher_autocast is set to
+            'fp16' or 'bf16' the forward pass is autocasted, if it is None, autocasting is used as during training.
         """
+        # -- Extract the parameters to estimate, the number of batches and the autocast type -- #
+        # -- NOTE: This function is used by the own methods as well, so only rely on attributes they define too -- #
+        named_params = get_fisher_parameters(self)
+        nr_batches = self.fisher_batches or self.num_batches_per_epoch
+        cast = self.fisher_autocast if self.fisher_autocast is not None else ('fp16' if self.fp16 else 'none')
+        assert cast in ['none', 'fp16', 'bf16'], "The fisher_autocast should be one of None, \'none\', \'fp16\' or \'bf16\', not \'{}\'.".format(cast)
+        device = next(self.network.parameters()).device
+
         # -- Update the log -- #
-        self.print_to_log_file("Running one last epoch without changing the weights to extract Fisher and Parameter values...")
+        self.print_to_log_file("Estimating the Fisher values of {} parameters using {} batches (autocast: {}) without changing the weights..."\
+                               .format(len(named_params), nr_batches, cast))
         start_time = time()
         #------------------------------------------ Partially copied from original implementation ------------------------------------------#
         # -- Put the network in train mode and kill gradients -- #
         self.network.train()
         self.optimizer.zero_grad()
 
-        # -- Do loop through the data based on the number of batches -- # self.tr_gen
-        for _ in range(self.num_batches_per_epoch):
-            self.optimizer.zero_grad()
-            # -- Extract the data -- #
-            data_dict = next(self.tr_gen)
-            data = data_dict['data']
-            target = data_dict['target']
-
-            # -- Push data to GPU -- #
-            data = maybe_to_torch(data)
-            target = maybe_to_torch(target)
-            if torch.cuda.is_available():
-                data = to_cuda(data)
-                target = to_cuda(target)
-
-            # -- Respect the fact if the user wants to autocast during training -- #
-            if self.fp16:
-                with autocast():
+        # -- Initialize the Fisher values with zeros, a parameter without a gradient has no importance -- #
+        fisher = {name: torch.zeros_like(param) for name, param in named_params}
+        to_device = lambda x: [i.to(device, non_blocking=True) for i in x] if isinstance(x, (list, tuple)) else x.to(device, non_blocking=True)
+
+        # -- Do loop through the data based on the number of batches -- #
+        nr_used = 0
+        with trange(nr_batches, disable=not self.use_progress_bar) as tbar:
+            for _ in tbar:
+                tbar.set_description("Estimating Fisher values")
+                self.optimizer.zero_grad(set_to_none=True)
+                # -- Extract the data and push it to the device of the network -- #
+                data_dict = next(self.tr_gen)
+                data = to_device(maybe_to_torch(data_dict['data']))
+                target = to_device(maybe_to_torch(data_dict['target']))
+
+                # -- Calculate the loss of the current task (without any regularization) and do backpropagation but do NOT update the weights -- #
+                with torch.autocast(device_type=device.type, dtype=torch.bfloat16 if cast == 'bf16' else torch.float16, enabled=cast != 'none'):
                     output = self.network(data)
                     del data
-                    loss = self.loss(output, target)
-                # -- Do backpropagation but do NOT update the weights -- #
-                self.amp_grad_scaler.scale(loss).backward()
-            else:
-                output = self.network(data)
-                del data
-                loss = self.loss(output, target)
-                # -- Do backpropagation but do NOT update the weights -- #
-                loss.backward()
-
-            del target
-
-        # -- Set fisher and params in current fold from last iteration --> final model parameters -- #
-        for name, param in self.network.named_parameters():
-            # -- Update the fisher and params dict -- #
-            if param.grad is None:
-                self.fisher[self.task][name] = torch.tensor([1], device='cuda:0')
-            else:
-                self.fisher[self.task][name] = param.grad.data.clone().pow(2)
-            self.params[self.task][name] = param.data.clone()
-
-        # -- Discard the calculated loss -- #
-        del loss
+                    loss = get_task_loss(self.loss, output, target)
+                del target, output
+                # -- fp16 gradients are scaled to avoid underflows, so scale them back before squaring -- #
+                scale = self.amp_grad_scaler.get_scale() if cast == 'fp16' and self.amp_grad_scaler is not None else 1.
+                (loss * scale).backward()
+                del loss
+                if scale != 1.:
+                    grads = [param.grad for _, param in named_params if param.grad is not None]
+                    for grad in grads:
+                        grad.div_(scale)
+                    # -- Skip the batch if the gradients overflowed -- #
+                    if len(grads) > 0 and not torch.stack([torch.isfinite(grad).all() for grad in grads]).all():
+                        continue
+
+                # -- Update the running mean of the squared gradients in-place: F = F + (g**2 - F) / n -- #
+                # -- Parameters without a gradient in this batch contribute a 0 -- #
+                nr_used += 1
+                for name, param in named_params:
+                    if param.grad is None:
+                        fisher[name].mul_(1. - 1. / nr_used)
+                    else:
+                        fisher[name].lerp_(param.grad.pow(2), 1. / nr_used)
+
+        # -- Set fisher and params in current fold --> final model parameters -- #
+        self.optimizer.zero_grad()
+        for name, param in named_params:
+            self.fisher[self.task][name] = fisher[name]
+            self.params[self.task][name] = param.detach().clone()
         #------------------------------------------ Partially copied from original implementation ------------------------------------------#
         # -- Update the log -- #
-        self.print_to_log_file("Extraction and saving of Fisher and Parameter values took %.2f seconds" % (time() - start_time))
\ No newline at end of file
+        self.print_to_log_file("Estimation of the Fisher values using {} batches took {:.2f} seconds ({:.3f} seconds per batch)"\
+                               .format(nr_used, time() - start_time, (time() - start_time) / max(nr_batches, 1)))
@@ -53,8 +53,9 @@ class nnUNetTrainerEWCLN(nnUNetTrainerEWC):
         r"""This function needs to be changed for this EWC method, since we only want to
             use ViT related parameters in our EWC Loss.
         """
-        # -- Run iteration as usual -- #
-        loss = super(nnUNetTrainerMultiHead, self).run_iteration(data_generator, do_backprop, run_online_evaluation)
+        # -- Run iteration as usual, skipping the one of the EWC Trainer that considers every parameter -- #
+        # -- NOTE: Use the one of the Multi Head Trainer, so after_backward() adds the EWC gradients if ewc_grad_hook is set -- #
+        loss = nnUNetTrainerMultiHead.run_iteration(self, data_generator, do_backprop, run_online_evaluation, detach, no_loss)
         
         # -- After running one iteration and calculating the loss, update the parameters of the loss for the next iteration -- #
         # -- NOTE: The gradients DO exist even after the loss detaching of the super function, however the loss function -- #
@@ -18,6 +18,7 @@ from nnunet.utilities.nd_softmax import softmax_helper
 from nnunet.utilities.to_torch import maybe_to_torch, to_cuda
 from batchgenerators.utilities.file_and_folder_operations import *
 from nnunet.training.loss_functions.dice_loss import DC_and_CE_loss
+from nnunet_ext.utilities.logit_store import LogitStore
 from nnunet_ext.utilities.helpful_functions import calculate_target_logits
 from nnunet.training.network_training.nnUNetTrainerV2 import nnUNetTrainerV2
 from nnunet_ext.training.loss_functions.deep_supervision import MultipleOutputLossLWF as LwFloss
@@ -86,8 +87,17 @@ class nnUNetTrainerLWF(nnUNetTrainerMultiHead):
         # -- of the grand parent class with the non LwF loss -- #
         self.do_val = False
 
-        # -- Define an empty dict for the target_logits -- #
-        self.target_logits = dict()
+        # -- Define the store of the target_logits and the model that computes them (MultiHead Network after the freeze run) -- #
+        # -- The target_logits are only stored if lwf_seeded_batches is set, since a sample can only be identified by the seed -- #
+        # -- of its batch, otherwise the teacher computes them for every batch. They are stored on disk in half precision, -- #
+        # -- or quantized to 8 bit if lwf_logits_int8 is set -- #
+        self.lwf_seeded_batches = False
+        self.lwf_logits_int8 = False
+        self.lwf_logits_prefetch = False
+        self.logit_store = None
+        self.teacher_network = None
+        # -- The next batch along with its generator, if the target_logits are prefetched -- #
+        self._next_batch = None
 
     def initialize(self, training=True, force_load_plans=False, num_epochs=500, prev_trainer_path=None, call_for_eval=False):
         r"""Overwrite the initialize function so the correct Loss function for the LWF method can be set.
@@ -121,6 +131,11 @@ class nnUNetTrainerLWF(nnUNetTrainerMultiHead):
             # -- Print Loss update -- #
             self.print_to_log_file("I am using LwF loss now")
 
+    def use_seeded_batches(self):
+        r"""The target_logits are stored per sample, so the batches are drawn from the seeded batches if lwf_seeded_batches is set.
+        """
+        return self.lwf_seeded_batches or super().use_seeded_batches()
+
     def run_training(self, task, output_folder):
         r"""Perform training using LwF Trainer. Simply executes training method of parent class
             while updating trained_on.pkl file. It is important to provide the right path, in which the results
@@ -158,6 +173,9 @@ class nnUNetTrainerLWF(nnUNetTrainerMultiHead):
                 self.network.ViT.register_new_task(task)
                 # -- Update self.mh_network.model as well since we now have a set of new LNs -- #
                 self.mh_network.model = copy.deepcopy(self.network)
+                # -- Body and active head need to reference the new running model -- #
+                if self.mh_network.share_parameters:
+                    self.mh_network.bind_to_model()
             # -- Set the correct task_name for training -- #
             self.network.ViT.use_task(task)
 
@@ -246,8 +264,8 @@ class nnUNetTrainerLWF(nnUNetTrainerMultiHead):
                 # -- Update the log -- #
                 self.print_to_log_file("Calculate the target_logits before training..")
                 start_time = time()
-                # -- Calculate the target_logits -- #
-                self.target_logits = calculate_target_logits(self.mh_network, self.tr_gen, self.num_batches_per_epoch, self.fp16)
+                # -- Calculate the target_logits using a copy of the MultiHead Network, since the network will be trained from here on -- #
+                self._update_target_logits(copy.deepcopy(self.mh_network), reset=True)
                 # -- Update the log -- #
                 self.print_to_log_file("Calculation of the target_logits took %.2f seconds" % (time() - start_time))
 
@@ -262,6 +280,10 @@ class nnUNetTrainerLWF(nnUNetTrainerMultiHead):
             ret = super().run_training(task, output_folder)
 
         # -- Reset everything for next task since the information is no longer necessary -- #
+        if self.logit_store is not None:
+            self.print_to_log_file("Target logits: %d hits, %d misses" % (self.logit_store.hits, self.logit_store.misses))
+            self.logit_store.reset()
+        self.logit_store, self.teacher_network, self._next_batch = None, None, None
         # -- Reset the val_metrics_exist flag since the training is finished and restoring will fail otherwise -- #
         self.already_trained_on[str(self.fold)]['val_metrics_should_exist'] = False
         # -- Set the flag to False -- #
@@ -310,49 +332,68 @@ class nnUNetTrainerLWF(nnUNetTrainerMultiHead):
         else:
             # -- Check if we are performing an iteration for validation purposes only, then we do not have to do all the following -- #
             if len(self.mh_network.heads) > 1: # --> only do this if we want backpropagation, ie. during training and we have at least one task
+                # -- Create a copy from the data_generator so the data_generator won't be touched. -- #
+                # -- This way, each previous task uses the same batch, as well as the model that will train -- #
+                # -- using the data_generator and thus same batch. -- #
+                # -- Extract the current batch once, so the target_logits and every head use the same batch -- #
+                # -- NOTE: If the target_logits are prefetched, the next batch is drawn already, so its target_logits -- #
+                # --       can be read while the current batch is trained -- #
+                if self._next_batch is not None and self._next_batch[0] is data_generator:
+                    data_dict = self._next_batch[1]
+                else:
+                    data_dict = next(data_generator)
+                self._next_batch = (data_generator, next(data_generator)) if self.logit_store is not None and self.lwf_logits_prefetch else None
+                x = maybe_to_torch(data_dict['data'])
+                if torch.cuda.is_available():
+                    x = to_cuda(x)
+                tasks = list(self.mh_network.heads.keys())
+
+                # -- Remove the softmax layer at the end by replacing the corresponding element with an identity function -- #
+                self.network.inference_apply_nonlin = lambda x: x
+                # -- Set network to eval -- #
+                self.network.eval()
+
+                # -- Make predictions with every head at once, so the shared body is only computed once -- #
+                # -- NOTE: No gradients are necessary since the outputs are detached anyway -- #
+                with torch.no_grad():
+                    if self.fp16:
+                        with autocast():
+                            outputs = self.mh_network.forward_all_heads(x)
+                    else:
+                        outputs = self.mh_network.forward_all_heads(x)
+                # -- Do detach the output so the loss has no effect on the old network during backward step -- #
+                # -- NOTE: The logits stay on the device, so the target_logits are decoded there as well -- #
+                all_pred_logits = {task: output[0].detach() for task, output in outputs.items()}
+
+                # -- Get the target_logits of this batch, the heads whose logits are not stored are computed by the teacher -- #
+                keys = data_dict.get('sample_keys', None)
+                all_target_logits = self._compute_missing_target_logits(tasks, keys, x)
+                del x, outputs
+
                 # Run per head and use LWF loss while updating the corresponding logits!
-                for task in list(self.mh_network.heads.keys()):
+                for task in tasks:
                     # -- Build the current network -- #
                     self.network = self.mh_network.assemble_model(task)
                     # -- Set the correct task_name for training -- #
                     if self.use_vit and self.ViT_task_specific_ln:
                         self.network.ViT.use_task(task)
-                    # -- Remove the softmax layer at the end by replacing the corresponding element with an identity function -- #
-                    self.network.inference_apply_nonlin = lambda x: x
-                    # -- Set network to eval -- #
-                    self.network.eval()
-                    # -- Create a copy from the data_generator so the data_generator won't be touched. -- #
-                    # -- This way, each previous task uses the same batch, as well as the model that will train -- #
-                    # -- using the data_generator and thus same batch. -- #
-                    data = tee(data_generator, 1)[0]
-                    # -- Extract the current batch from data -- #
-                    x = next(data)
-                    x = maybe_to_torch(x['data'])
-                    if torch.cuda.is_available():
-                        x = to_cuda(x)
-
-                    # -- Make predictions using the loaded model and data -- #
-                    if self.fp16:
-                        with autocast():
-                            output = self.network(x)[0]
-                    else:
-                        output = self.network(x)[0]
-                        
-                    # -- Do detach the output so the loss has no effect on the old network during backward step -- #
-                    pred_logits = output.detach().cpu()
+                    pred_logits = all_pred_logits[task]
+                    target_logits = all_target_logits.pop(task, None)
+                    if target_logits is None:
+                        target_logits = self.logit_store.load(task, keys, pred_logits.device)
+                    # -- Start reading the target_logits of the next batch for this head in the background -- #
+                    if self._next_batch is not None:
+                        self.logit_store.prefetch(task, self._next_batch[1]['sample_keys'])
 
-                    del x, output
                     # -- Update the LwF loss -- #
-                    self.loss.update_logits(pred_logits, self.target_logits[task][self.batch_idx % 250])  # Use modulo since self.batch_idx is a running number
+                    self.loss.update_logits(pred_logits, target_logits.to(pred_logits.device))
                     # -- Add the softmax layer again by replacing the corresponding element with softmax_helper -- #
                     self.network.inference_apply_nonlin = softmax_helper
                     # -- Put model into train mode -- #
                     self.network.train()
-                    # -- Run iteration as usual and return the loss -- #
-                    ret = super().run_iteration(tee(data_generator, 1)[0], do_backprop, run_online_evaluation)
+                    # -- Run iteration as usual on the same batch and return the loss -- #
+                    ret = super().run_iteration(iter([data_dict]), do_backprop, run_online_evaluation)
 
-                # -- Get next element in the generator since we always use a deepcopy of the generator -- #
-                _ = next(data_generator)
                 # -- Add one to the running index so we know at which batch we currently are -- #
                 self.batch_idx += 1
             else:
@@ -433,9 +474,60 @@ class nnUNetTrainerLWF(nnUNetTrainerMultiHead):
         # -- Update the log -- #
         self.print_to_log_file("Calculate the target_logits..")
         start_time = time()
-        # -- Calculate the target_logits -- #
-        self.target_logits = calculate_target_logits(mh_network_cpy, self.tr_gen, self.num_batches_per_epoch, self.fp16)
+        # -- Calculate the target_logits, the store of the interrupted run is used again since the model is the same -- #
+        self._update_target_logits(mh_network_cpy, reset=False)
         self.network = self.mh_network.model
         del mh_network_cpy
         # -- Update the log -- #
-        self.print_to_log_file("Calculation of the target_logits took %.2f seconds" % (time() - start_time))
\ No newline at end of file
+        self.print_to_log_file("Calculation of the target_logits took %.2f seconds" % (time() - start_time))
+
+    def _update_target_logits(self, mh_network, reset=True):
+        r"""This function builds the store of the target_logits and fills it using every head of mh_network for every seeded
+            training and validation batch. mh_network is only kept as the teacher if the target_logits of a batch could
+            not be stored, otherwise every batch of the training is in the store and it is not necessary anymore.
+            Without seeded batches, nothing is stored and mh_network computes the target_logits of every batch.
+            :param mh_network: The MultiHead Network that computes the target_logits, it should not be trained anymore
+            :param reset: Set this flag if an existing store should be removed, otherwise only the missing logits are computed
+        """
+        if self.logit_store is not None:
+            self.logit_store.reset()
+            self.logit_store = None
+        self.teacher_network = mh_network
+        if not self.use_seeded_batches():
+            return
+        self.logit_store = LogitStore(join(self.output_folder, 'lwf_target_logits'),
+                                      (self.num_batches_per_epoch + self.num_val_batches_per_epoch) * self.batch_size,
+                                      self.lwf_logits_int8, self.lwf_logits_prefetch)
+        if reset:
+            self.logit_store.reset()
+        keys = calculate_target_logits(self.teacher_network, [self.tr_gen, self.val_gen], self.num_batches_per_epoch, self.fp16,
+                                       store=self.logit_store)
+        # -- Free the copy of the MultiHead Network once the target_logits of every head are stored for every batch -- #
+        if all(self.logit_store.contains(task, batch_keys) for task in self.teacher_network.heads.keys() for batch_keys in keys):
+            self.teacher_network = None
+
+    def _compute_missing_target_logits(self, tasks, keys, x):
+        r"""This function computes the target_logits of the heads that are not stored for the batch using the teacher
+            and stores them, so they can be used again if the same samples occur again. Without a store, the target_logits
+            of every head are computed.
+            :return: A dictionary with the computed target_logits per task
+        """
+        if self.logit_store is None:
+            missing = tasks
+        else:
+            missing = self.logit_store.missing_tasks(tasks, keys)
+        if len(missing) == 0:
+            return dict()
+        assert self.teacher_network is not None,\
+            "The target_logits of the heads {} are not stored for the batch and the teacher has already been freed.".format(missing)
+        with torch.no_grad():
+            if self.fp16:
+                with autocast():
+                    outputs = self.teacher_network.forward_all_heads(x, missing)
+            else:
+                outputs = self.teacher_network.forward_all_heads(x, missing)
+        target_logits = {task: output[0].detach() for task, output in outputs.items()}
+        if self.logit_store is not None:
+            for task, logits in target_logits.items():
+                self.logit_store.store(task, keys, logits)
+        return target_logits
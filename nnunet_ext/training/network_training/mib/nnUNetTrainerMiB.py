@@ -138,7 +138,7 @@ class nnUNetTrainerMiB(nnUNetTrainerMultiHead):
                     # -- Extract the old results using the old network -- #
                     if self.split_gpu and not self.use_vit:
                         data = to_cuda(data, gpu_id=1)
-                    output_o = self.network_old(data) # --> self.old_interm_results is filled with intermediate result now!
+                    output_o = self.old_network_forward(data, data_dict.get('sample_keys', None)) # --> self.old_interm_results is filled with intermediate result now!
                     (x.detach for x in output_o)
                     if not no_loss:
                         loss = self.loss(output, output_o, target)
@@ -153,7 +153,7 @@ class nnUNetTrainerMiB(nnUNetTrainerMultiHead):
                 output = self.network(data)
                 if self.split_gpu and not self.use_vit:
                     data = to_cuda(data, gpu_id=1)
-                output_o = self.network_old(data)
+                output_o = self.old_network_forward(data, data_dict.get('sample_keys', None))
                 (x.detach for x in output_o)
                 del data
                 if not no_loss:
@@ -4,17 +4,18 @@
 #########################################################################################################
 
 import numpy as np
-import os, copy, torch
+import os, copy, torch, hashlib, json, shutil
 from itertools import tee
 from torch.cuda.amp import autocast
 from collections import OrderedDict
 from sklearn.model_selection import KFold
 from sklearn.model_selection import train_test_split
 from nnunet_ext.utilities.helpful_functions import *
-from nnunet.utilities.nd_softmax import softmax_helper
-from nnunet.utilities.tensor_utilities import sum_tensor
 from nnunet_ext.training.model_restore import restore_model
 from nnunet.utilities.to_torch import maybe_to_torch, to_cuda
+from nnunet_ext.utilities.teacher_cache import TeacherCache
+from nnunet_ext.utilities.seeded_batches import seed_batches
+from nnunet_ext.utilities.foreground_index import attach_foreground_index
 from nnunet.network_architecture.generic_UNet import Generic_UNet
 from batchgenerators.utilities.file_and_folder_operations import *
 from nnunet.training.loss_functions.dice_loss import DC_and_CE_loss
@@ -35,6 +36,10 @@ torch.multiprocessing.set_sharing_strategy('file_system')
 # -- Define globally the Hyperparameters for this trainer along with their type -- #
 HYPERPARAMS = {}
 
+# -- Define the attributes that represent the data pipeline of a task, ie. plans, datasets, dataloaders and generators -- #
+PIPELINE_ATTRIBUTES = ['plans', 'dataset_directory', 'folder_with_preprocessed_data', 'dataset', 'dataset_tr', 'dataset_val',
+                       'dl_tr', 'dl_val', 'tr_gen', 'val_gen']
+
 class nnUNetTrainerMultiHead(nnUNetTrainerV2): # Inherit default trainer class for 2D, 3D low resolution and 3D full resolution U-Net 
     def __init__(self, split, task, plans_file, fold, output_folder=None, dataset_directory=None, batch_dice=True, stage=None,
                  unpack_data=True, deterministic=True, fp16=False, save_interval=5, already_trained_on=None, use_progress=True,
@@ -179,6 +184,35 @@ class nnUNetTrainerMultiHead(nnUNetTrainerV2): # Inherit default trainer class f
         # -- Define flag for evaluation (per batch or per subject) -- #
         self.eval_batch = True
 
+        # -- Define flag if body and active head should share the parameters with the running model -- #
+        # -- If so, the Multi Head Network does not need to be split after every iteration -- #
+        self.share_mh_parameters = False
+
+        # -- Define the memory budget in MB for the cache of assembled task views, 0 disables the cache -- #
+        # -- If set, switching between unchanged heads (eg. during validation) only loads a cached state -- #
+        self.mh_cache_budget_mb = 0
+
+        # -- Define the registry of data pipelines per task, so the pipelines of the previous tasks are not built again -- #
+        # -- for every validation, along with the maximum number of pipelines (with worker processes) that are kept alive -- #
+        self.pipelines = OrderedDict()
+        self.max_alive_pipelines = 3
+        self._train_pipeline_key = None
+
+        # -- Define flag if the validation batches should be sampled once per task and stored in a memory-mapped cache -- #
+        # -- along with the seed that is used for the sampling, so every validation uses the exact same batches -- #
+        self.cache_val_batches = False
+        self.val_batch_cache_seed = 12345
+
+        # -- Define flag if the data loaders should choose the foreground patches using the foreground index that is stored -- #
+        # -- next to the preprocessed data, see nnunet_ext/utilities/foreground_index.py -- #
+        self.use_foreground_index = False
+
+        # -- Define the number of samples whose outputs of the old model are cached by the distillation based trainers -- #
+        # -- along with the optional number of stored logits per voxel, 0 disables the cache, see old_network_forward -- #
+        self.teacher_cache_size = 0
+        self.teacher_cache_topk = None
+        self.teacher_cache, self._teacher_cache_model = None, None
+
         # -- Set the flag if the param_split should be used instead of the general split -- #
         # -- Only set this to True if the parameter search method is used -- #
         self.param_split = use_param_split
@@ -468,11 +502,43 @@ class nnUNetTrainerMultiHead(nnUNetTrainerV2): # Inherit default trainer class f
         running_task_list.append(task)
         running_task = join_texts_with_char(running_task_list, '_')
         
+        # -- Keep the data pipeline of the previous task alive, so it can be reused during validation -- #
+        if self._train_pipeline_key is not None:
+            self._store_pipeline(self._train_pipeline_key)
+
+        # -- Build the data pipeline for the new task or reuse it from the registry if it already exists -- #
+        self._train_pipeline_key = self._activate_pipeline(task, running_task, self.trainer_class_name,
+                                                           print_loss_info=print_loss_info)
+
+        #--------------------------------- Copied from original implementation ---------------------------------#
+        self.print_to_log_file("TRAINING KEYS:\n %s" % (str(self.dataset_tr.keys())),
+                                also_print_to_console=False)
+        self.print_to_log_file("VALIDATION KEYS:\n %s" % (str(self.dataset_val.keys())),
+                                also_print_to_console=False)
+        #--------------------------------- Copied from original implementation ---------------------------------#
+
+    def _activate_pipeline(self, task, running_task, prev_trainer, **kwargs):
+        r"""This function sets the data pipeline (plans, datasets, dataloaders and generators) of a task. If the pipeline
+            is in the registry it is reused, otherwise it is built which includes the creation of the augmenters and the
+            unpacking of the dataset if desired. The pipeline is removed from the registry while it is active, use
+            _store_pipeline to put it back once it is not used anymore.
+            :param task: The task for which the pipeline should be activated
+            :param running_task: The joined names of all tasks trained so far including task
+            :param prev_trainer: The name of the trainer that has been used to train on task
+            :param kwargs: Further keyword arguments for get_default_configuration, eg. print_loss_info
+            :return: The key of the pipeline in the registry
+        """
+        # -- Reuse the pipeline if it exists -- #
+        key = (task, running_task, prev_trainer)
+        state = self.pipelines.pop(key, None)
+        if state is not None:
+            self._set_pipeline_state(state)
+            return key
+
         # -- Get default configuration for nnunet/nnunet_ext model -- #
         plans_file, _, self.dataset_directory, _, stage, \
-        _ = get_default_configuration(self.network_name, task, running_task, self.trainer_class_name,\
-                                      self.tasks_joined_name, self.identifier, extension_type=self.extension,\
-                                      print_loss_info=print_loss_info)
+        _ = get_default_configuration(self.network_name, task, running_task, prev_trainer,\
+                                      self.tasks_joined_name, self.identifier, extension_type=self.extension, **kwargs)
 
         # -- Load the plans file -- #
         self.plans = load_pickle(plans_file)
@@ -482,16 +548,15 @@ class nnUNetTrainerMultiHead(nnUNetTrainerV2): # Inherit default trainer class f
                                                   "_stage%d" % stage)
                                             
         # -- Create the corresponding dataloaders for train and val (dataset loading and split performed in function) -- #
-        # -- Since we do validation, there is no need to unpack the data -- #
-        del self.dl_tr, self.dl_val # --> Avoid memory leak
         self.dl_tr, self.dl_val = self.get_basic_generators()
+        self._attach_foreground_index()
         
         # -- Unpack the dataset if this is desired -- #
         if self.unpack_data:
             unpack_dataset(self.folder_with_preprocessed_data)
 
         # -- Extract corresponding self.val_gen --> the used function is extern and does not change any values from self -- #
-        del self.tr_gen, self.val_gen # --> Avoid memory leak
+        # -- NOTE: The worker processes are only started once the generators are used for the first time -- #
         self.tr_gen, self.val_gen = get_moreDA_augmentation(self.dl_tr, self.dl_val,
                                                             self.data_aug_params['patch_size_for_spatialtransform'],
                                                             self.data_aug_params,
@@ -499,12 +564,140 @@ class nnUNetTrainerMultiHead(nnUNetTrainerV2): # Inherit default trainer class f
                                                             pin_memory=self.pin_memory,
                                                             use_nondetMultiThreadedAugmenter=False)
 
-        #--------------------------------- Copied from original implementation ---------------------------------#
-        self.print_to_log_file("TRAINING KEYS:\n %s" % (str(self.dataset_tr.keys())),
-                                also_print_to_console=False)
-        self.print_to_log_file("VALIDATION KEYS:\n %s" % (str(self.dataset_val.keys())),
-                                also_print_to_console=False)
-        #--------------------------------- Copied from original implementation ---------------------------------#
+        # -- Draw the batches from a fixed set of seeded batches if outputs of another model are stored per sample -- #
+        if self.use_seeded_batches():
+            self.tr_gen = seed_batches(self.tr_gen, self.num_batches_per_epoch, task)
+            self.val_gen = seed_batches(self.val_gen, self.num_val_batches_per_epoch, task, first_seed=self.num_batches_per_epoch)
+        return key
+
+    def use_seeded_batches(self):
+        r"""This function returns if the batches of the data pipelines are drawn from a fixed set of seeded batches, ie.
+            num_batches_per_epoch training and num_val_batches_per_epoch validation batches, whose samples are identified
+            by their case, crop and augmentation seed ('sample_keys'), see nnunet_ext/utilities/seeded_batches.py. This is
+            the case if the outputs of the old model are cached (teacher_cache_size > 0), since a sample can only be found
+            in the cache if it is used again. Note that the augmentation is then limited to these batches.
+        """
+        return self.teacher_cache_size > 0
+
+    def _attach_foreground_index(self):
+        r"""This function sets the class_locations of every case in the current datasets to the locations of the foreground
+            index, if self.use_foreground_index is set. The entries of the datasets are updated in place, so the existing data
+            loaders use the index as well, as long as their worker processes have not been started yet.
+        """
+        if not self.use_foreground_index:
+            return
+        for dataset in [getattr(self, 'dataset', None), getattr(self, 'dataset_tr', None), getattr(self, 'dataset_val', None)]:
+            if dataset is not None:
+                attach_foreground_index(dataset)
+
+    def _store_pipeline(self, key):
+        r"""This function puts the currently set data pipeline into the registry under key. If more than
+            self.max_alive_pipelines pipelines are in the registry, the least recently used ones are closed.
+            :param key: The key of the pipeline that is returned by _activate_pipeline
+        """
+        self.pipelines[key] = self._get_pipeline_state()
+        self.pipelines.move_to_end(key)
+        while len(self.pipelines) > max(self.max_alive_pipelines, 0):
+            _, state = self.pipelines.popitem(last=False)
+            self._close_pipeline(state)
+
+    def _get_pipeline_state(self):
+        r"""This function returns the currently set data pipeline as a dictionary.
+        """
+        return {attr: getattr(self, attr, None) for attr in PIPELINE_ATTRIBUTES}
+
+    def _set_pipeline_state(self, state):
+        r"""This function sets the data pipeline based on a dictionary returned by _get_pipeline_state.
+        """
+        for attr, value in state.items():
+            setattr(self, attr, value)
+
+    def _close_pipeline(self, state, force=False):
+        r"""This function stops the worker processes of the generators from a data pipeline.
+            :param state: The data pipeline as returned by _get_pipeline_state
+            :param force: Stop the generators even if they are used by the trainer at the moment, eg. since the
+                          currently set pipeline is not used anymore
+        """
+        for gen in [state['tr_gen'], state['val_gen']]:
+            # -- Only stop them if they are not used by the trainer at the moment -- #
+            in_use = gen is getattr(self, 'tr_gen', None) or gen is getattr(self, 'val_gen', None)
+            if hasattr(gen, '_finish') and (force or not in_use):
+                gen._finish()
+
+    def clear_pipelines(self):
+        r"""This function closes all data pipelines in the registry.
+        """
+        while len(self.pipelines) > 0:
+            _, state = self.pipelines.popitem(last=False)
+            self._close_pipeline(state)
+
+    def _get_cached_val_batches(self):
+        r"""This function returns a generator over the cached validation batches of the currently set data pipeline.
+            If the cache does not exist, self.num_val_batches_per_epoch batches are sampled once using self.dl_val and
+            the validation transforms of self.val_gen with a fixed seed (self.val_batch_cache_seed) and stored as
+            memory-mapped numpy arrays along with the subject keys. The cache is stored next to the preprocessed data
+            and identified by the sampling settings, so other processes (eg. evaluation) can use it as well.
+            :return: A generator yielding the batches as dictionaries with 'data', 'target' and 'keys'
+        """
+        # -- Build the identifier of the cache based on everything that changes the sampled batches -- #
+        settings = {'fold': self.fold, 'param_split': self.param_split, 'patch_size': np.array(self.patch_size).tolist(),
+                    'batch_size': self.batch_size, 'num_batches': self.num_val_batches_per_epoch, 'seed': self.val_batch_cache_seed,
+                    'oversample_foreground_percent': self.oversample_foreground_percent,
+                    'deep_supervision_scales': np.array(self.deep_supervision_scales).tolist() if self.deep_supervision_scales is not None else None}
+        if self.use_foreground_index:
+            settings['foreground_index'] = True
+        identifier = hashlib.md5(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+        cache_folder = join(self.folder_with_preprocessed_data, 'val_batch_cache', identifier)
+
+        # -- Sample and store the batches if the cache does not exist yet -- #
+        if not isfile(join(cache_folder, 'keys.json')):
+            self._build_val_batch_cache(cache_folder, settings)
+
+        # -- Load the keys and open the arrays as memmaps, so only the used batch is loaded into memory -- #
+        keys = load_json(join(cache_folder, 'keys.json'))
+        data = np.load(join(cache_folder, 'data.npy'), mmap_mode='r')
+        targets = [np.load(join(cache_folder, 'target_%d.npy' % i), mmap_mode='r') for i in range(len(keys['targets']))]
+        for idx, batch_keys in enumerate(keys['keys']):
+            yield {'data': np.array(data[idx]), 'target': [np.array(t[idx]) for t in targets], 'keys': np.array(batch_keys)}
+
+    def _build_val_batch_cache(self, cache_folder, settings):
+        r"""This function samples the validation batches once with a fixed seed and stores them in cache_folder.
+            The batches are first written into a temporary folder that is renamed at the end, so processes that
+            build the same cache at the same time do not interfere.
+            :param cache_folder: The folder in which the cache should be stored
+            :param settings: Dictionary with the settings used for the sampling, stored for reference
+        """
+        self.print_to_log_file("Sampling {} validation batches for the validation batch cache in {}.".format(self.num_val_batches_per_epoch, cache_folder))
+        
+        # -- Sample the batches in this process with a fixed seed, the random state is restored afterwards -- #
+        # -- NOTE: Only the validation transforms are applied, ie. no augmentation is performed -- #
+        rnd_state = np.random.get_state()
+        np.random.seed(self.val_batch_cache_seed)
+        batches = list()
+        to_numpy = lambda x: x.cpu().numpy() if torch.is_tensor(x) else np.asarray(x)
+        for _ in range(self.num_val_batches_per_epoch):
+            batch = self.val_gen.transform(**next(self.dl_val))
+            target = batch['target'] if isinstance(batch['target'], (list, tuple)) else [batch['target']]
+            batches.append({'data': to_numpy(batch['data']), 'target': [to_numpy(t) for t in target],
+                            'keys': np.array(batch['keys']).tolist()})
+        np.random.set_state(rnd_state)
+
+        # -- Store the data and targets as one array each so they can be opened as memmaps -- #
+        tmp_folder = cache_folder + '_tmp_' + str(os.getpid())
+        maybe_mkdir_p(tmp_folder)
+        np.save(join(tmp_folder, 'data.npy'), np.stack([b['data'] for b in batches]))
+        for i in range(len(batches[0]['target'])):
+            np.save(join(tmp_folder, 'target_%d.npy' % i), np.stack([b['target'][i] for b in batches]))
+        # -- The keys file is stored last since its existence marks a complete cache -- #
+        save_json({'settings': settings, 'targets': len(batches[0]['target']), 'keys': [b['keys'] for b in batches]},
+                  join(tmp_folder, 'keys.json'))
+        del batches
+
+        # -- Move the cache to its final location, if another process was faster use its cache instead -- #
+        try:
+            os.rename(tmp_folder, cache_folder)
+        except OSError:
+            shutil.rmtree(tmp_folder, ignore_errors=True)
 
     def run_training(self, task, output_folder, build_folder=True):
         r"""Perform training using Multi Head Trainer. Simply executes training method of parent class
@@ -521,6 +714,9 @@ class nnUNetTrainerMultiHead(nnUNetTrainerV2): # Inherit default trainer class f
             # -- Now reset self.task to the current task -- #
             self.task = task
 
+        # -- The dataloaders of the first task are built during initialization, so use the foreground index from here on -- #
+        self._attach_foreground_index()
+
         # -- Update the self.output_folder, otherwise the data will always be in the same folder for every task -- #
         # -- and everything will be overwritten over and over again -- #
         # -- Do this after reinitialization since the function might change the path -- #
@@ -545,9 +741,19 @@ class nnUNetTrainerMultiHead(nnUNetTrainerV2): # Inherit default trainer class f
                 self.network.ViT.register_new_task(task)
                 # -- Update self.mh_network.model as well since we now have a set of new LNs -- #
                 self.mh_network.model = copy.deepcopy(self.network)
+                # -- Body and active head need to reference the new running model -- #
+                if self.mh_network.share_parameters:
+                    self.mh_network.bind_to_model()
             # -- Set the correct task_name for training -- #
             self.network.ViT.use_task(task)
 
+        # -- Let the body and active head share the parameters with the running model if desired -- #
+        if self.share_mh_parameters and not self.mh_network.share_parameters:
+            self.mh_network.bind_to_model()
+
+        # -- Set the budget of the cache for assembled task views -- #
+        self.mh_network.set_cache_budget(self.mh_cache_budget_mb)
+
         # -- Activate the model based on task --> self.mh_network.active_task is now set to task as well -- #
         self.network = self.mh_network.assemble_model(task)
         
@@ -569,6 +775,11 @@ class nnUNetTrainerMultiHead(nnUNetTrainerV2): # Inherit default trainer class f
         if self.new_trainer and len(self.already_trained_on) > 1:
             self.new_trainer = False
 
+        # -- Remove the cached outputs of the old model, the old model changes with the next task -- #
+        if self.teacher_cache is not None:
+            self.teacher_cache.reset()
+            self.teacher_cache, self._teacher_cache_model = None, None
+
         # -- Before returning, reset the self.epoch variable, otherwise the following task will only be trained for the last epoch -- #
         self.epoch = 0
 
@@ -614,6 +825,7 @@ class nnUNetTrainerMultiHead(nnUNetTrainerV2): # Inherit default trainer class f
             if do_backprop:
                 self.amp_grad_scaler.scale(l).backward()
                 self.amp_grad_scaler.unscale_(self.optimizer)
+                self.after_backward()
                 torch.nn.utils.clip_grad_norm_(self.network.parameters(), 12)
                 self.amp_grad_scaler.step(self.optimizer)
                 self.amp_grad_scaler.update()
@@ -625,6 +837,7 @@ class nnUNetTrainerMultiHead(nnUNetTrainerV2): # Inherit default trainer class f
 
             if do_backprop:
                 l.backward()
+                self.after_backward()
                 torch.nn.utils.clip_grad_norm_(self.network.parameters(), 12)
                 self.optimizer.step()
 
@@ -643,6 +856,46 @@ class nnUNetTrainerMultiHead(nnUNetTrainerV2): # Inherit default trainer class f
                 l = l.detach().cpu().numpy()
             return l
 
+    def after_backward(self):
+        r"""This function is called after every backward pass during training (after unscaling the gradients when using
+            mixed precision), before the gradients are clipped and the optimizer performs its step. Losses that add their
+            gradients directly instead of building a graph for it, eg. the EWC based losses with ewc_grad_hook, do this here.
+        """
+        if getattr(self.loss, 'ewc_grad_hook', False):
+            self.loss.apply_penalty_gradients()
+
+    def old_network_forward(self, data, keys=None):
+        r"""This function returns the output of the old model (self.network_old) for data, as it is used by the distillation
+            based trainers (MiB, PLOP, POD, Own methods). If self.teacher_cache_size > 0, the outputs and the captured features
+            of the old model (self.old_feature_capture) are cached per sample, so the forward pass is only performed if a
+            sample of the batch has not been seen before. The cache is built again whenever the old model changes.
+            :param data: The input batch, already on the device of the old model
+            :param keys: The keys of the samples of a seeded batch, ie. data_dict['sample_keys'], None does not use the cache
+            :return: The output of the old model
+        """
+        capture = getattr(self, 'old_feature_capture', None)
+        if self.teacher_cache_size <= 0 or keys is None:
+            return self.network_old(data)
+
+        # -- Build a new cache if the old model changed -- #
+        if self.teacher_cache is None or self._teacher_cache_model is not self.network_old:
+            if self.teacher_cache is not None:
+                self.teacher_cache.reset()
+            self.teacher_cache = TeacherCache(join(self.output_folder, 'teacher_cache'), self.teacher_cache_size, self.teacher_cache_topk)
+            self._teacher_cache_model = self.network_old
+
+        # -- Load the outputs and features if every sample is cached, otherwise run the old model and cache its results -- #
+        cached = self.teacher_cache.load(keys, data.device)
+        if cached is not None:
+            output_o, features = cached
+            if capture is not None:
+                capture.results.update(features)
+            return output_o
+        with torch.no_grad():
+            output_o = self.network_old(data)
+        self.teacher_cache.store(keys, output_o, capture.results if capture is not None else dict())
+        return output_o
+
     def on_epoch_end(self):
         """Overwrite this function, since we want to perform a validation after every nth epoch on all tasks
            from the head.
@@ -653,6 +906,15 @@ class nnUNetTrainerMultiHead(nnUNetTrainerV2): # Inherit default trainer class f
         # -- Perform everything the parent class makes -- #
         res = super().on_epoch_end()
 
+        # -- The penalty is not part of the loss when its gradients are added directly, so log it separately -- #
+        # -- NOTE: It is only calculated here, once per epoch, using the parameters of the last iteration -- #
+        if getattr(self.loss, 'ewc_grad_hook', False):
+            self.print_to_log_file("EWC penalty of the last iteration (not included in the train loss): %.4f" % self.loss.penalty_value())
+
+        # -- Report how often the outputs of the old model could be loaded from the teacher cache -- #
+        if self.teacher_cache is not None:
+            self.print_to_log_file("Teacher cache: %d hits, %d misses" % (self.teacher_cache.hits, self.teacher_cache.misses))
+
         # -- If the current epoch can be divided without a rest by self.save_every than its time for a validation -- #
         if self.epoch % self.save_every == self.save_every - 1:   # Same as checkpoint saving from nnU-Net (NOTE: this is because its 0 based)
             self._perform_validation()
@@ -689,6 +951,10 @@ class nnUNetTrainerMultiHead(nnUNetTrainerV2): # Inherit default trainer class f
         # -- Extract the information of the current fold -- #
         trained_on_folds = self.already_trained_on[str(self.fold)]
 
+        # -- Set the budget of the cache for assembled task views and remember the counters to report them -- #
+        self.mh_network.set_cache_budget(self.mh_cache_budget_mb)
+        cache_hits, cache_misses = self.mh_network.cache_hits, self.mh_network.cache_misses
+
         # -- Extract all tasks into a list to loop through -- #
         if use_tasks is None:
             tasks = list(self.mh_network.heads.keys())
@@ -696,6 +962,10 @@ class nnUNetTrainerMultiHead(nnUNetTrainerV2): # Inherit default trainer class f
             # -- Use the provided tasks -- #
             tasks = use_tasks[:]
         
+        # -- Backup the data pipeline of the current task so it can be used for its validation and restored at the end -- #
+        # -- NOTE: When called for evaluation, the pipelines are not stored since they are only used once -- #
+        train_task, train_pipeline = self.task, self._get_pipeline_state()
+
         # -- NOTE: Since the head is an (ordered) ModuleDict, the current task is the last head, so there -- #
         # --       is nothing to restore at the end. -- #
         # -- For each previously trained task perform the validation on the full validation set -- #
@@ -709,32 +979,12 @@ class nnUNetTrainerMultiHead(nnUNetTrainerV2): # Inherit default trainer class f
             running_task_list.append(task)
             running_task = join_texts_with_char(running_task_list, '_')
 
-            # -- Get default configuration for nnunet/nnunet_ext model (finished training) -- #
-            plans_file, _, self.dataset_directory, _, stage, \
-            _ = get_default_configuration(self.network_name, task, running_task, trained_on_folds['prev_trainer'][idx],\
-                                          self.tasks_joined_name, self.identifier, extension_type=self.extension)
-
-            # -- Load the plans file -- #
-            self.plans = load_pickle(plans_file)
-
-            # -- Extract the folder with the preprocessed data in it -- #
-            self.folder_with_preprocessed_data = join(self.dataset_directory, self.plans['data_identifier'] +
-                                                      "_stage%d" % stage)
-                                                
-            # -- Create the corresponding dataloaders for train and val (dataset loading and split performed in function) -- #
-            self.dl_tr, self.dl_val = self.get_basic_generators()
-
-            # -- Unpack the dataset if desired, since we might have to continue training so we have to unpack if desired -- #
-            if self.unpack_data:
-                unpack_dataset(self.folder_with_preprocessed_data)
-
-            # -- Extract corresponding self.val_gen --> the used function is extern and does not change any values from self -- #
-            self.tr_gen, self.val_gen = get_moreDA_augmentation(self.dl_tr, self.dl_val,
-                                                                self.data_aug_params['patch_size_for_spatialtransform'],
-                                                                self.data_aug_params,
-                                                                deep_supervision_scales=self.deep_supervision_scales,
-                                                                pin_memory=self.pin_memory,
-                                                                use_nondetMultiThreadedAugmenter=False)
+            # -- Use the data pipeline of the current task or the one from the registry, it is only built if necessary -- #
+            if not call_for_eval and task == train_task:
+                key = None
+                self._set_pipeline_state(train_pipeline)
+            else:
+                key = self._activate_pipeline(task, running_task, trained_on_folds['prev_trainer'][idx])
 
             # -- Update the log -- #
             self.print_to_log_file("Performing validation with validation data from task {}.".format(task))
@@ -764,8 +1014,17 @@ class nnUNetTrainerMultiHead(nnUNetTrainerV2): # Inherit default trainer class f
                 # -- Run an iteration for each batch in validation generator -- #
                 val_gen_copy = tee(self.val_gen, 1)[0] # <-- Duplicate the generator so the names are extracted correctly during the loop
                 
+                # -- Stream the batches from the cache if desired, the batch is used for the names and the iteration -- #
+                if self.cache_val_batches:
+                    for data in self._get_cached_val_batches():
+                        self.subject_names_raw.append(data['keys'])
+                        if call_for_eval:
+                            _ = self.run_iteration(iter([data]), False, True, no_loss=True)
+                        else:
+                            _ = self.run_iteration(iter([data]), False, True)
+
                 # -- Loop through generator based on number of defined batches -- #
-                for _ in range(self.num_val_batches_per_epoch):
+                for _ in range(self.num_val_batches_per_epoch if not self.cache_val_batches else 0):
                     # -- First, extract the subject names so we can map the predictions to the names -- #
                     data = next(val_gen_copy)
                     self.subject_names_raw.append(data['keys'])
@@ -781,9 +1040,28 @@ class nnUNetTrainerMultiHead(nnUNetTrainerV2): # Inherit default trainer class f
             # -- Calculate Dice and IoU --> self.validation_results is already updated once the evaluation is done -- #
             self.finish_online_evaluation_extended(task)
 
+            # -- Keep the pipeline alive for the next validation -- #
+            if not call_for_eval and key is not None:
+                self._store_pipeline(key)
+            # -- When called for evaluation the pipeline is only used once, so stop its workers and release it -- #
+            elif call_for_eval:
+                self._close_pipeline(self._get_pipeline_state(), force=True)
+                del self.dl_tr, self.dl_val # --> Avoid memory leak
+
+        # -- Restore the data pipeline of the current task -- #
+        if not call_for_eval:
+            self._set_pipeline_state(train_pipeline)
+
         # -- Put current network into train mode again -- #
         self.network.train()
 
+        # -- Report how often the cache of assembled task views has been used during the validation -- #
+        if self.mh_cache_budget_mb > 0:
+            cache_info = self.mh_network.get_cache_info()
+            self.print_to_log_file("Multi Head cache during validation: {} hits, {} misses, {:.2f}/{:.2f} MB used."\
+                                   .format(cache_info['hits'] - cache_hits, cache_info['misses'] - cache_misses,
+                                           cache_info['size_mb'], cache_info['budget_mb']))
+
         # -- Save the dictionary as json file in the corresponding output_folder -- #
         if call_for_eval:
             save_json(self.validation_results, join(self.output_folder, 'val_metrics_eval.json'), sort_keys=False)
@@ -847,31 +1125,31 @@ class nnUNetTrainerMultiHead(nnUNetTrainerV2): # Inherit default trainer class f
             # -- Look at the Note in the function description -- #
             output = output[0]
             target = target[0]
-            #------------------------------------------ Copied from original implementation ------------------------------------------#
             with torch.no_grad():
-                # -- Calculate tp, fp and fn as usual, for every element in the batch -- #
+                # -- Calculate tp, fp and fn for every element in the batch using one confusion matrix per element -- #
+                # -- instead of building three masks per class: the index target * C + prediction is counted per element -- #
                 num_classes = output.shape[1]
-                output_softmax = softmax_helper(output)
-                output_seg = output_softmax.argmax(1)
-                target = target[:, 0]
-                axes = tuple(range(1, len(target.shape)))
-                tp_hard = torch.zeros((target.shape[0], num_classes - 1)).to(output_seg.device.index)
-                fp_hard = torch.zeros((target.shape[0], num_classes - 1)).to(output_seg.device.index)
-                fn_hard = torch.zeros((target.shape[0], num_classes - 1)).to(output_seg.device.index)
-                for c in range(1, num_classes):
-                    tp_hard[:, c - 1] = sum_tensor((output_seg == c).float() * (target == c).float(), axes=axes)
-                    fp_hard[:, c - 1] = sum_tensor((output_seg == c).float() * (target != c).float(), axes=axes)
-                    fn_hard[:, c - 1] = sum_tensor((output_seg != c).float() * (target == c).float(), axes=axes)
-            #------------------------------------------ Copied from original implementation ------------------------------------------#
+                output_seg = output.argmax(1)   # --> softmax does not change the argmax
+                target = target[:, 0].long()
+                batch_size = target.shape[0]
+                # -- Labels that are not in [0, C) are mapped to an extra row, so predictions there still count as fp -- #
+                target = torch.where((target >= 0) & (target < num_classes), target, torch.full_like(target, num_classes))
+                idxs = target.reshape(batch_size, -1) * num_classes + output_seg.reshape(batch_size, -1)
+                idxs = idxs + torch.arange(batch_size, device=idxs.device).unsqueeze(1) * (num_classes + 1) * num_classes
+                confusion = torch.bincount(idxs.flatten(), minlength=batch_size * (num_classes + 1) * num_classes)
+                confusion = confusion.reshape(batch_size, num_classes + 1, num_classes).float()
+                # -- Rows represent the target and columns the prediction, background is omitted -- #
+                tp_hard = torch.diagonal(confusion[:, :num_classes], dim1=1, dim2=2)[:, 1:]
+                fp_hard = confusion.sum(1)[:, 1:] - tp_hard
+                fn_hard = confusion[:, :num_classes].sum(2)[:, 1:] - tp_hard
 
                 # -- Add the calculate tp, fp and fn to the lists --> If we sum them, then we get one value per batch -- #
                 # -- Now we have one value per subject as in self.subject_names_raw -- #
-                # -- NOTE: self.online_eval_XX are lists and conventionally the values are stored in lists. -- #
-                # --       Here we store the values as numpys and transform self.online_eval_XX to a numpy later on -- #
-                # --       for the calculation per subject, thus we need numpy since this makes it more sufficient. -- #
-                self.online_eval_tp.append(tp_hard.detach().cpu().numpy())
-                self.online_eval_fp.append(fp_hard.detach().cpu().numpy())
-                self.online_eval_fn.append(fn_hard.detach().cpu().numpy())
+                # -- NOTE: The values are kept on the device and are transferred to the host at once in -- #
+                # --       finish_online_evaluation_extended for the calculation per subject. -- #
+                self.online_eval_tp.append(tp_hard)
+                self.online_eval_fp.append(fp_hard)
+                self.online_eval_fn.append(fn_hard)
     
     def finish_online_evaluation_extended(self, task):
         r"""Calculate the Dice Score and IoU (Intersection over Union) on the validation dataset during training.
@@ -880,56 +1158,43 @@ class nnUNetTrainerMultiHead(nnUNetTrainerV2): # Inherit default trainer class f
                   than the original one, ie. it is only called in special cases which is why it has a different name.
         """
         # -- Stack the numpy arrays since they are stored differently depending on the run -- #
-        self.subject_names_raw = np.array(self.subject_names_raw).flatten()
+        self.subject_names_raw = np.concatenate([np.asarray(names).flatten() for names in self.subject_names_raw])
 
         # -- Reshape the tp, fp, tn lists so the names are flat, but the different mask labels, ie. last dimension is still in tact -- #
-        self.online_eval_tp = np.array(self.online_eval_tp).reshape(-1, np.array(self.online_eval_tp).shape[-1])
-        self.online_eval_fp = np.array(self.online_eval_fp).reshape(-1, np.array(self.online_eval_fp).shape[-1])
-        self.online_eval_fn = np.array(self.online_eval_fn).reshape(-1, np.array(self.online_eval_fn).shape[-1])
-        
+        if torch.is_tensor(self.online_eval_tp[0]):
+            # -- The values are still on the device, so transfer all of them to the host at once -- #
+            tp, fp, fn = torch.stack([torch.cat(values) for values in [self.online_eval_tp, self.online_eval_fp, self.online_eval_fn]]).cpu().numpy()
+        else:
+            tp, fp, fn = [np.concatenate([np.asarray(v).reshape(-1, np.shape(v)[-1]) for v in values])
+                          for values in [self.online_eval_tp, self.online_eval_fp, self.online_eval_fn]]
+
         # -- Sum the values for tp, fp and fn per subject to get exactly one value per subject in the end -- #
-        # -- Extract the unique names -- #
-        subject_names = np.unique(self.subject_names_raw)
-        
-        # -- Sum the values per subject name based on the idxs -- #
-        tp = list()
-        fp = list()
-        fn = list()
-
-        # -- Build up a list (following the order of subject_names) that stores the indices for every subject since -- #
-        # -- the self.subject_names_raw list matches every other list like tp, fp, fn -- #
-        idxs = list()
-        for subject in subject_names:
-            # -- Get all indices of elements that match the current subject -- #
-            idxs.append(np.where(self.subject_names_raw == subject))
-
-        for subject_idxs in idxs:
-            # -- Sum only those values that belong to the subject based on the subject_idxs -- #
-            # -- NOTE: self.online_eval_XX dimensions: (nr_batches, subject_names (--> subject_idxs), nr_classes) -- #
-            # --       The selection of rows returns all batch results per subject so we only sum them on axis 0 -- #
-            # --       so we keep the results per nr_classes in tact on don't sum the array in a whole to a single value -- #
-            tp.append(np.array(self.online_eval_tp)[subject_idxs].sum(axis=0))
-            fp.append(np.array(self.online_eval_fp)[subject_idxs].sum(axis=0))
-            fn.append(np.array(self.online_eval_fn)[subject_idxs].sum(axis=0))
-
-        # -- Assign the correct values to corresponding lists and remove the three generated lists
-        self.online_eval_tp, self.online_eval_fp, self.online_eval_fn = tp, fp, fn
+        # -- Extract the unique names and for every row the index of its subject in subject_names -- #
+        subject_names, subject_idxs = np.unique(self.subject_names_raw, return_inverse=True)
+
+        # -- Sum all rows that belong to the same subject at once while keeping the results per class in tact -- #
+        # -- NOTE: tp, fp and fn dimensions: (nr_subjects, nr_classes) after the summation -- #
+        sums = list()
+        for values in [tp, fp, fn]:
+            summed = np.zeros((len(subject_names), values.shape[-1]), dtype=values.dtype)
+            np.add.at(summed, subject_idxs, values)
+            sums.append(summed)
+        tp, fp, fn = sums
+        del sums
+
+        # -- Calculate the IoU and Dice per class per subject for all subjects at once -- #
+        # -- NOTE: Like before, 0/0 results in NaN, eg. if a class is neither in the prediction nor in the target -- #
+        with np.errstate(divide='ignore', invalid='ignore'):
+            global_iou_per_class_and_subject = tp / (tp + fp + fn)
+            global_dc_per_class_and_subject = 2 * tp / (2 * tp + fp + fn)
+
+        # -- Remove the subjects where some value(s) in tp are NaN -- #
+        valid = ~np.isnan(tp).any(axis=1)
+        subject_names = subject_names[valid]
+        global_iou_per_class_and_subject = global_iou_per_class_and_subject[valid]
+        global_dc_per_class_and_subject = global_dc_per_class_and_subject[valid]
         del tp, fp, fn
 
-        # -- Calculate the IoU per class per subject --> use numpy since those operations do not work on conventional lists -- #
-        global_iou_per_class_and_subject = list()
-        global_dc_per_class_and_subject = list()
-        for idx, (i, j, k) in enumerate(zip(self.online_eval_tp, self.online_eval_fp, self.online_eval_fn)):
-            # -- If possible, calculate the IoU and Dice per class label and per subject -- #
-            if not np.isnan(i).any():
-                # -- IoU -- #
-                global_iou_per_class_and_subject.extend([i / (i + j + k)])
-                # -- Dice -- #
-                global_dc_per_class_and_subject.extend([2 * i / (2 * i + j + k)])
-            else:
-                # -- Remove the subject from the list since some value(s) in tp are NaN -- #
-                del subject_names[idx]
-
         # -- Store IoU and Dice values. Ensure it is float64 so its JSON serializable -- #
         # -- Do not use self.all_val_eval_metrics since this is used for plotting and then the -- #
         # -- plots do not build correctly because based on self.save_every more dice values than -- #
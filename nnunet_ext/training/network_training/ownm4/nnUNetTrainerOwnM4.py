@@ -7,12 +7,13 @@
 
 # -- This implementation represents our own method -- #
 import os, copy, torch
-from operator import attrgetter
 from torch.cuda.amp import autocast
 from nnunet_ext.paths import default_plans_identifier
 from nnunet.utilities.to_torch import maybe_to_torch, to_cuda
 from batchgenerators.utilities.file_and_folder_operations import *
+from nnunet_ext.utilities.feature_capture import FeatureCapture
 from nnunet.training.loss_functions.dice_loss import DC_and_CE_loss
+from nnunet_ext.utilities.tensor_store import STORE_DEVICE, TensorStore, load_tensor_values
 from nnunet_ext.training.network_training.ownm1.nnUNetTrainerOwnM1 import nnUNetTrainerOwnM1
 from nnunet_ext.training.loss_functions.deep_supervision import MultipleOutputLossOwn2 as OwnLoss
 from nnunet_ext.training.network_training.multihead.nnUNetTrainerMultiHead import nnUNetTrainerMultiHead
@@ -100,26 +101,35 @@ class nnUNetTrainerOwnM4(nnUNetTrainerMultiHead):
             self.fisher = dict()
             self.params = dict()
         else:
-            self.fisher = load_pickle(self.already_trained_on[str(self.fold)]['fisher_at'])
-            self.params = load_pickle(self.already_trained_on[str(self.fold)]['params_at'])
-
-            # -- Put data on GPU since the data is moved to CPU before it is stored -- #
-            for task in self.fisher.keys():
-                for key in self.fisher[task].keys():
-                    to_cuda(self.fisher[task][key])
-            for task in self.params.keys():
-                for key in self.params[task].keys():
-                    to_cuda(self.params[task][key])
+            # -- The values of a task are only loaded (onto the GPU) once they are used -- #
+            self.fisher = load_tensor_values(self.already_trained_on[str(self.fold)]['fisher_at'], STORE_DEVICE)
+            self.params = load_tensor_values(self.already_trained_on[str(self.fold)]['params_at'], STORE_DEVICE)
 
         # -- Define the path where the fisher and param values should be stored/restored -- #
         self.ewc_data_path = join(self.trained_on_path, 'ewc_data_ownm4')
 
+        # -- Specify if the gradient of the EWC penalty should be added to the gradients after the backward pass instead -- #
+        # -- of adding the penalty to the loss, so no graph needs to be built for it, see MultipleOutputLossEWC -- #
+        self.ewc_grad_hook = False
+
+        # -- Specify the number of batches used to estimate the Fisher values (None: num_batches_per_epoch) and if the -- #
+        # -- forward pass should be autocasted (None: as during training, 'none', 'fp16' or 'bf16'), see after_train -- #
+        self.fisher_batches = None
+        self.fisher_autocast = None
+
+        # -- Specify if the fisher and param values should be stored in half precision -- #
+        self.tensor_store_fp16 = False
+
         if self.do_pod:
-            # -- Define the place holders for our results from the previous model on the current data -- #
-            self.old_interm_results = dict()
+            # -- Define the selection and pooling of the modules whose outputs are captured, see FeatureCapture -- #
+            self.pod_layers, self.pod_stages, self.pod_max_depth, self.pod_pool = ['seg_outputs'], None, None, 1
 
-            # -- Define empty dict for the current intermediate results during training -- #
-            self.interm_results = dict()
+            # -- Define the feature captures of the current and the previous model, the hooks are only registered once -- #
+            self.feature_capture, self.old_feature_capture = FeatureCapture(), FeatureCapture()
+
+            # -- The intermediate results of the previous and current model are the dicts that are filled by the captures -- #
+            self.old_interm_results = self.old_feature_capture.results
+            self.interm_results = self.feature_capture.results
 
         # -- Define a flag to indicate if the loss is switched or not -- #
         self.switched = False
@@ -150,16 +160,9 @@ class nnUNetTrainerOwnM4(nnUNetTrainerMultiHead):
         # -- If this trainer has already trained on other tasks, then extract the fisher and params -- #
         if prev_trainer_path is not None and self.already_trained_on[str(self.fold)]['fisher_at'] is not None\
                                          and self.already_trained_on[str(self.fold)]['params_at'] is not None:
-            self.fisher = load_pickle(self.already_trained_on[str(self.fold)]['fisher_at'])
-            self.params = load_pickle(self.already_trained_on[str(self.fold)]['params_at'])
-
-            # -- Put data on GPU since the data is moved to CPU before it is stored -- #
-            for task in self.fisher.keys():
-                for key in self.fisher[task].keys():
-                    to_cuda(self.fisher[task][key])
-            for task in self.params.keys():
-                for key in self.params[task].keys():
-                    to_cuda(self.params[task][key])
+            # -- The values of a task are only loaded (onto the GPU) once they are used -- #
+            self.fisher = load_tensor_values(self.already_trained_on[str(self.fold)]['fisher_at'], STORE_DEVICE)
+            self.params = load_tensor_values(self.already_trained_on[str(self.fold)]['params_at'], STORE_DEVICE)
 
         # -- Calculate T1 and T2 based on nr epoch -- #
         self.T1 = num_epochs / 10
@@ -187,14 +190,6 @@ class nnUNetTrainerOwnM4(nnUNetTrainerMultiHead):
         # -- Print Loss update -- #
         self.print_to_log_file("I am using my own loss now")
         
-        # -- Put data on GPU since the data is moved to CPU before it is stored -- #
-        for task in self.fisher.keys():
-            for key in self.fisher[task].keys():
-                to_cuda(self.fisher[task][key])
-        for task in self.params.keys():
-            for key in self.params[task].keys():
-                to_cuda(self.params[task][key])
-
         # -- Update the fisher and param values in the loss function -- #
         if self.switched:
             self.loss.update_fisher_params(self.fisher, self.params, False)
@@ -211,6 +206,9 @@ class nnUNetTrainerOwnM4(nnUNetTrainerMultiHead):
                   to train, so it will be 500 and it does not set a prev_trainer. The prev_trainer will be set to None!
                   --> Initialize the trainer using your desired num_epochs and prev_trainer before calling run_training.  
         """
+        # -- Set the regularization mode of the own loss -- #
+        self.own_loss.ewc_grad_hook = self.ewc_grad_hook
+
         # -- If there is at least one head and the current task is not in the heads, the network has finished on one task -- #
         # -- In such a case the fisher/param values should exist and should not be empty -- #
         if len(self.mh_network.heads) > 0 and task not in self.mh_network.heads:
@@ -219,6 +217,9 @@ class nnUNetTrainerOwnM4(nnUNetTrainerMultiHead):
 
         # -- Create a deepcopy of the previous, ie. currently set model if we do PLOP training -- #
         if task not in self.mh_network.heads:
+            # -- Remove the hooks of the current network first, otherwise they are copied into the old network as well -- #
+            if hasattr(self, 'feature_capture'):
+                self.feature_capture.remove()
             self.network_old = copy.deepcopy(self.network)
             # -- Save this network using checkpoint saving for restoring purposes -- #
             self.save_checkpoint(join(self.output_folder, "model_latest.model"), old_model=True, fname_old=join(self.output_folder, "model_old.model"))
@@ -246,23 +247,15 @@ class nnUNetTrainerOwnM4(nnUNetTrainerMultiHead):
         # -- This will update the parameters for the current task in self.fisher and self.params -- #
         self.after_train()
 
-        # -- Put data from GPU to CPU before storing them in files -- #
-        for task in self.fisher.keys():
-            for key in self.fisher[task].keys():
-                self.fisher[task][key].cpu()
-        for task in self.params.keys():
-            for key in self.params[task].keys():
-                self.params[task][key].cpu()
-
-        # -- Dump both dicts as pkl files -- #
-        maybe_mkdir_p(self.ewc_data_path)
-        write_pickle(self.fisher, join(self.ewc_data_path, 'fisher_values.pkl'))
-        write_pickle(self.params, join(self.ewc_data_path, 'param_values.pkl'))
+        # -- Store both dicts, only the values of the current task changed, so only they are written -- #
+        TensorStore(join(self.ewc_data_path, 'fisher_values'), self.tensor_store_fp16).save(self.fisher, [task])
+        TensorStore(join(self.ewc_data_path, 'param_values'), self.tensor_store_fp16).save(self.params, [task])
 
-        if self.already_trained_on[str(self.fold)]['fisher_at'] is None or self.already_trained_on[str(self.fold)]['params_at'] is None:
+        if self.already_trained_on[str(self.fold)]['fisher_at'] != join(self.ewc_data_path, 'fisher_values')\
+        or self.already_trained_on[str(self.fold)]['params_at'] != join(self.ewc_data_path, 'param_values'):
             # -- Update the already_trained_on file that the values exist if necessary -- #
-            self.already_trained_on[str(self.fold)]['fisher_at'] = join(self.ewc_data_path, 'fisher_values.pkl')
-            self.already_trained_on[str(self.fold)]['params_at'] = join(self.ewc_data_path, 'param_values.pkl')
+            self.already_trained_on[str(self.fold)]['fisher_at'] = join(self.ewc_data_path, 'fisher_values')
+            self.already_trained_on[str(self.fold)]['params_at'] = join(self.ewc_data_path, 'param_values')
             
             # -- Save the updated dictionary as a json file -- #
             save_json(self.already_trained_on, join(self.trained_on_path, self.extension+'_trained_on.pkl'))
@@ -314,7 +307,7 @@ class nnUNetTrainerOwnM4(nnUNetTrainerMultiHead):
                     # -- Extract the old results using the old network -- #
                     if self.split_gpu and not self.use_vit:
                         data = to_cuda(data, gpu_id=1)
-                    output_o = self.network_old(data) # --> self.old_interm_results is filled with intermediate result now!
+                    output_o = self.old_network_forward(data, data_dict.get('sample_keys', None)) # --> self.old_interm_results is filled with intermediate result now!
                     (x.detach for x in output_o)
                     del data
                     if not no_loss:
@@ -327,6 +320,7 @@ class nnUNetTrainerOwnM4(nnUNetTrainerMultiHead):
                 if do_backprop:
                     self.amp_grad_scaler.scale(loss).backward()
                     self.amp_grad_scaler.unscale_(self.optimizer)
+                    self.after_backward()
                     torch.nn.utils.clip_grad_norm_(self.network.parameters(), 12)
                     self.amp_grad_scaler.step(self.optimizer)
                     self.amp_grad_scaler.update()
@@ -334,7 +328,7 @@ class nnUNetTrainerOwnM4(nnUNetTrainerMultiHead):
                 output = self.network(data)
                 if self.split_gpu and not self.use_vit:
                     data = to_cuda(data, gpu_id=1)
-                output_o = self.network_old(data)
+                output_o = self.old_network_forward(data, data_dict.get('sample_keys', None))
                 (x.detach for x in output_o)
                 del data
                 if not no_loss:
@@ -346,6 +340,7 @@ class nnUNetTrainerOwnM4(nnUNetTrainerMultiHead):
 
                 if do_backprop:
                     loss.backward()
+                    self.after_backward()
                     torch.nn.utils.clip_grad_norm_(self.network.parameters(), 12)
                     self.optimizer.step()
 
@@ -365,8 +360,8 @@ class nnUNetTrainerOwnM4(nnUNetTrainerMultiHead):
 
             if self.do_pod:
                 # -- Empty the dicts -- #
-                self.old_interm_results = dict()
-                self.interm_results = dict()
+                self.old_feature_capture.clear()
+                self.feature_capture.clear()
         
             # -- After running one iteration and calculating the loss, update the parameters of the loss for the next iteration -- #
             # -- NOTE: The gradients DO exist even after the loss detaching of the super function, however the loss function -- #
@@ -390,28 +385,15 @@ class nnUNetTrainerOwnM4(nnUNetTrainerMultiHead):
         nnUNetTrainerOwnM1.after_train(self)
 
     def register_forward_hooks(self, old=False):
-        r"""This function sets the forward hooks for every convolutional layer in the network.
+        r"""This function registers the forward hooks of the feature capture on the selected modules of the network,
+            by default every convolutional layer of the segmentation heads. The hooks are only registered once per network,
+            so calling this function again does not add duplicate hooks.
             The old parameter indicates that the old network should be used to register the hooks.
         """
-        # -- Set the correct network to use -- #
+        # -- Set the correct network and capture to use -- #
         use_network = self.network_old if old else self.network
+        capture = self.old_feature_capture if old else self.feature_capture
 
-        # -- Extract all module names that are of any convolutional type -- #
-        module_names = [name for name, module in use_network.named_modules() if 'conv.Conv' in str(type(module))]
-
-        # -- Register hooks -- #
-        for mod in module_names:
-            # -- Only register hooks for the segmentation heads -- #
-            if 'seg_outputs' in mod:
-                attrgetter(mod)(use_network).register_forward_hook(self._get_activation(mod, old))
-
-    def _get_activation(self, name, old=False):
-        r"""This function returns the hook given a specific (module) name that needs to be
-            registered to the module before calling it with actual data.
-        """
-        def hook(model, input, output):
-            if old:
-                self.old_interm_results[name]  = output.detach()     # Store the output in the dict at corresponding name
-            else:
-                self.interm_results[name] = output.detach()     # Store the output in the dict at corresponding name
-        return hook
+        # -- Set the selection and pooling and register the hooks -- #
+        capture.patterns, capture.stages, capture.max_depth, capture.pool = self.pod_layers, self.pod_stages, self.pod_max_depth, self.pod_pool
+        capture.attach(use_network)
@@ -8,12 +8,12 @@
 import copy, torch
 from time import time
 from tqdm import trange
-from operator import attrgetter
 from torch.cuda.amp import autocast
 from nnunet_ext.paths import default_plans_identifier
 from nnunet.utilities.nd_softmax import softmax_helper
 from nnunet.utilities.to_torch import maybe_to_torch, to_cuda
 from batchgenerators.utilities.file_and_folder_operations import *
+from nnunet_ext.utilities.feature_capture import FeatureCapture
 from nnunet_ext.training.loss_functions.crossentropy import entropy
 from nnunet_ext.training.loss_functions.deep_supervision import MultipleOutputLossPLOP as PLOPLoss
 from nnunet_ext.training.network_training.multihead.nnUNetTrainerMultiHead import nnUNetTrainerMultiHead
@@ -64,11 +64,15 @@ class nnUNetTrainerPLOP(nnUNetTrainerMultiHead):
                           pod_lambda, scales, tasks_list_with_char, mixed_precision, save_csv, del_log, use_vit, self.vit_type,
                           version, split_gpu, transfer_heads, ViT_task_specific_ln, do_LSA, do_SPT)
 
-        # -- Define the place holders for our results from the previous model on the current data -- #
-        self.old_interm_results = dict()
+        # -- Define the selection and pooling of the modules whose outputs are captured, see FeatureCapture -- #
+        self.pod_layers, self.pod_stages, self.pod_max_depth, self.pod_pool = None, None, None, 1
 
-        # -- Define empty dict for the current intermediate results during training -- #
-        self.interm_results = dict()
+        # -- Define the feature captures of the current and the previous model, the hooks are only registered once -- #
+        self.feature_capture, self.old_feature_capture = FeatureCapture(), FeatureCapture()
+
+        # -- The intermediate results of the previous and current model are the dicts that are filled by the captures -- #
+        self.old_interm_results = self.old_feature_capture.results
+        self.interm_results = self.feature_capture.results
 
         # -- Define placeholders for the thresholds and max_entropy and a flag to indicate if the loss is switched or not -- #
         self.thresholds, self.max_entropy = None, dict()
@@ -110,73 +114,70 @@ class nnUNetTrainerPLOP(nnUNetTrainerMultiHead):
             # -- Print Loss update -- #
             self.print_to_log_file("I am using PLOP loss now")
 
-    def extract_max_entropy_and_thresholds(self):
+    @torch.no_grad()
+    def extract_max_entropy_and_thresholds(self, nb_bins=100, base_threshold=0.001):
         r"""This function extracts the max entropy and self.thresholds that are necessary for the pseudo label loss.
             Call this everytime before a new training starts.
             It finds the median prediction score per class using the old model.
             Extracted from here: https://github.com/arthurdouillard/CVPR2021_PLOP/blob/main/train.py#L505
+            The histograms of every output are accumulated on the device over the whole pass and the medians are
+            only calculated once at the end using a cumulative sum and searchsorted.
+            :param nb_bins: The number of bins of the histograms
+            :param base_threshold: The minimum threshold of every class
         """
         # -- Update the log -- #
         self.print_to_log_file("Extracting the max_entropy and thresholds for pseudo labeling..")
         start_time = time()
         
-        device = 'cuda:1' if self.split_gpu and not self.use_vit else 'cuda:0'
-        self.max_entropy = torch.log(torch.tensor(self.num_classes).float().to(device))
-        nb_bins = 100
-        histograms = torch.zeros(self.num_classes, nb_bins).long().to(device)
+        # -- Use the device of the old network, so this works on CPU and (split) GPUs alike -- #
+        device = next(self.network_old.parameters()).device
+        histograms, max_entropy = None, None
         # -- Set softmax_helper --> just in case it is sth different -- #
         self.network_old.inference_apply_nonlin = softmax_helper
         # -- Set network to eval -- #
         self.network_old.eval()
-        with trange(self.num_batches_per_epoch) as tbar:
+        with trange(self.num_batches_per_epoch, disable=not self.use_progress_bar) as tbar:
             for _ in tbar:
                 tbar.set_description("Extracting thresholds")
                 data_dict = next(self.tr_gen)
-                images = data_dict['data']
-                labels = data_dict['target']
-                images = maybe_to_torch(images)
-                labels = maybe_to_torch(labels)
-                # -- Put data on GPU -- #
-                if torch.cuda.is_available():
-                    images = to_cuda(images, gpu_id = int(device.split(':')[-1]))
-                    labels = to_cuda(labels, gpu_id = int(device.split(':')[-1]))
-                if self.fp16:
-                    with autocast():
-                        outputs_old = self.network_old(images)
-                else:
+                images = maybe_to_torch(data_dict['data']).to(device, non_blocking=True)
+                labels = maybe_to_torch(data_dict['target'])
+                with torch.autocast(device_type=device.type, enabled=self.fp16 and device.type == 'cuda'):
                     outputs_old = self.network_old(images)
+                # -- Without deep supervision there is only one output and one target -- #
+                if not isinstance(outputs_old, (tuple, list)):
+                    outputs_old = [outputs_old]
+                if not isinstance(labels, (tuple, list)):
+                    labels = [labels]
+                if histograms is None:
+                    # -- One histogram per output of shape (classes x bins) that is flattened for bincount -- #
+                    histograms = torch.zeros(len(outputs_old), self.num_classes * nb_bins, dtype=torch.long, device=outputs_old[0].device)
+                    max_entropy = torch.log(torch.tensor(self.num_classes, dtype=torch.float32, device=outputs_old[0].device))
                 for idx, outs in enumerate(outputs_old):
-                    mask_bg = labels == 0
-                    probas = self.network_old.inference_apply_nonlin(outs)
+                    # -- The target has a channel dimension, the predicted labels do not -- #
+                    target = labels[idx].to(outs.device, non_blocking=True)
+                    mask_bg = (target[:, 0] if target.dim() == outs.dim() else target) == 0
+                    probas = self.network_old.inference_apply_nonlin(outs.float())
                     _, pseudo_labels = probas.max(dim=1)
-                    values_to_bins = entropy(probas)[mask_bg].view(-1) / self.max_entropy
-                    x_coords = pseudo_labels[mask_bg].view(-1)
-                    y_coords = torch.clamp((values_to_bins * nb_bins).long(), max=nb_bins - 1)
-                    histograms.index_put_((x_coords, y_coords), torch.LongTensor([1]).expand_as(x_coords).to(histograms.device), accumulate=True)
-                    self.thresholds[idx] = torch.zeros(self.num_classes, dtype=torch.float32).to(device)
-                    for c in range(self.num_classes):
-                        total = histograms[c].sum()
-                        if total <= 0.:
-                            continue
-                        half = total / 2
-                        running_sum = 0.
-                        for lower_border in range(nb_bins):
-                            lower_border = lower_border / nb_bins
-                            bin_index = int(lower_border * nb_bins)
-                            if half >= running_sum and half <= (running_sum + histograms[c, bin_index]):
-                                break
-                            running_sum += lower_border * nb_bins
-                        median = lower_border + ((half - running_sum) / histograms[c, bin_index].sum()) * (1 / nb_bins)
-                        self.thresholds[idx][c] = median
-                    base_threshold = 0.001
-                    for c in range(len(self.thresholds[idx])):
-                        self.thresholds[idx][c] = max(self.thresholds[idx][c], base_threshold)
-
-        # -- Put thresholds and max_entropy on device 0 for the loss calculation -- #
-        if self.split_gpu and self.use_vit:
-            self.max_entropy.cuda()
-            for _, threshold in self.thresholds.items():
-                threshold.cuda()
+                    values_to_bins = entropy(probas)[mask_bg] / max_entropy
+                    bins = torch.clamp((values_to_bins * nb_bins).long(), min=0, max=nb_bins - 1)
+                    histograms[idx] += torch.bincount(pseudo_labels[mask_bg] * nb_bins + bins, minlength=self.num_classes * nb_bins)
+
+        # -- Calculate the median of every output and class at once: the median lies in the first bin where the cumulative -- #
+        # -- sum reaches half of the total and is linearly interpolated within this bin -- #
+        histograms = histograms.view(histograms.size(0), self.num_classes, nb_bins).float()
+        cumsum = histograms.cumsum(dim=-1)
+        half = cumsum[..., -1:] / 2
+        bin_index = torch.searchsorted(cumsum, half).clamp_(max=nb_bins - 1)
+        bin_count = histograms.gather(-1, bin_index)
+        running_sum = cumsum.gather(-1, bin_index) - bin_count
+        medians = ((bin_index + (half - running_sum) / bin_count) / nb_bins).squeeze(-1)
+        # -- Classes that have never been predicted have no median and use the base threshold -- #
+        medians = torch.where(half.squeeze(-1) > 0, medians, torch.zeros_like(medians))
+        
+        # -- The thresholds and max_entropy are on the device of the old outputs which they are compared to in the loss -- #
+        self.thresholds = {idx: threshold for idx, threshold in enumerate(medians.clamp_(min=base_threshold))}
+        self.max_entropy = max_entropy
 
         # -- Update the log -- #
         self.print_to_log_file("Extraction took %.2f seconds" % (time() - start_time))
@@ -186,6 +187,9 @@ class nnUNetTrainerPLOP(nnUNetTrainerMultiHead):
         """
         # -- Create a deepcopy of the previous, ie. currently set model if we do PLOP training -- #
         if task not in self.mh_network.heads:
+            # -- Remove the hooks of the current network first, otherwise they are copied into the old network as well -- #
+            if hasattr(self, 'feature_capture'):
+                self.feature_capture.remove()
             self.network_old = copy.deepcopy(self.network)
             # -- Save this network using checkpoint saving for restoring purposes -- #
             self.save_checkpoint(join(self.output_folder, "model_latest.model"), old_model=True, fname_old=join(self.output_folder, "model_old.model"))
@@ -254,7 +258,7 @@ class nnUNetTrainerPLOP(nnUNetTrainerMultiHead):
                     # -- Extract the old results using the old network -- #
                     if self.split_gpu and not self.use_vit:
                         data = to_cuda(data, gpu_id=1)
-                    output_o = self.network_old(data) # --> self.old_interm_results is filled with intermediate result now!
+                    output_o = self.old_network_forward(data, data_dict.get('sample_keys', None)) # --> self.old_interm_results is filled with intermediate result now!
                     (x.detach for x in output_o)
                     del data
                     # -- Put old_interm_results on same GPU as interm_results -- #
@@ -282,7 +286,7 @@ class nnUNetTrainerPLOP(nnUNetTrainerMultiHead):
                 output = self.network(data)
                 if self.split_gpu and not self.use_vit:
                     data = to_cuda(data, gpu_id=1)
-                output_o = self.network_old(data)
+                output_o = self.old_network_forward(data, data_dict.get('sample_keys', None))
                 (x.detach for x in output_o)
                 del data
                 # -- Put old_interm_results on same GPU as interm_results -- #
@@ -319,34 +323,23 @@ class nnUNetTrainerPLOP(nnUNetTrainerMultiHead):
                 loss = loss.detach().cpu().numpy()
 
             # -- Empty the dicts -- #
-            self.old_interm_results = dict()
-            self.interm_results = dict()
+            self.old_feature_capture.clear()
+            self.feature_capture.clear()
 
         # -- Return the loss -- #
         if not no_loss:
             return loss
 
     def register_forward_hooks(self, old=False):
-        r"""This function sets the forward hooks for every convolutional layer in the network.
+        r"""This function registers the forward hooks of the feature capture on the selected modules of the network,
+            by default every convolutional layer. The hooks are only registered once per network,
+            so calling this function again does not add duplicate hooks.
             The old parameter indicates that the old network should be used to register the hooks.
         """
-        # -- Set the correct network to use -- #
+        # -- Set the correct network and capture to use -- #
         use_network = self.network_old if old else self.network
+        capture = self.old_feature_capture if old else self.feature_capture
 
-        # -- Extract all module names that are of any convolutional type -- #
-        module_names = [name for name, module in use_network.named_modules() if 'conv.Conv' in str(type(module))]
-
-        # -- Register hooks -- #
-        for mod in module_names:
-            attrgetter(mod)(use_network).register_forward_hook(self._get_activation(mod, old))
-
-    def _get_activation(self, name, old=False):
-        r"""This function returns the hook given a specific (module) name that needs to be
-            registered to the module before calling it with actual data.
-        """
-        def hook(model, input, output):
-            if old:
-                self.old_interm_results[name]  = output.detach()     # Store the output in the dict at corresponding name
-            else:
-                self.interm_results[name] = output.detach()     # Store the output in the dict at corresponding name
-        return hook
+        # -- Set the selection and pooling and register the hooks -- #
+        capture.patterns, capture.stages, capture.max_depth, capture.pool = self.pod_layers, self.pod_stages, self.pod_max_depth, self.pod_pool
+        capture.attach(use_network)
@@ -68,6 +68,9 @@ class nnUNetTrainerPOD(nnUNetTrainerPLOP):
         """
         # -- Create a deepcopy of the previous, ie. currently set model if we do PLOP training -- #
         if task not in self.mh_network.heads:
+            # -- Remove the hooks of the current network first, otherwise they are copied into the old network as well -- #
+            if hasattr(self, 'feature_capture'):
+                self.feature_capture.remove()
             self.network_old = copy.deepcopy(self.network)
             # -- Save this network using checkpoint saving for restoring purposes -- #
             self.save_checkpoint(join(self.output_folder, "model_latest.model"), old_model=True, fname_old=join(self.output_folder, "model_old.model"))
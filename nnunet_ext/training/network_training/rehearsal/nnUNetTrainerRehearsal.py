@@ -3,11 +3,11 @@
 #----------inspired by original implementation (--> nnUNetTrainerV2), copied code is marked as such.----#
 #########################################################################################################
 
-import random
 from nnunet_ext.paths import default_plans_identifier
 from batchgenerators.utilities.file_and_folder_operations import *
 from nnunet_ext.utilities.helpful_functions import join_texts_with_char
 from nnunet_ext.run.default_configuration import get_default_configuration
+from nnunet_ext.utilities.replay_buffer import ReplayBuffer, MixedDataLoader
 from nnunet.training.dataloading.dataset_loading import load_dataset, DataLoader3D, DataLoader2D
 from nnunet_ext.training.network_training.multihead.nnUNetTrainerMultiHead import nnUNetTrainerMultiHead
 
@@ -36,6 +36,15 @@ class nnUNetTrainerRehearsal(nnUNetTrainerMultiHead):
         # -- Set the seed -- #
         self.seed = seed
 
+        # -- Define the settings of the replay buffer, by default a fraction (self.samples) of every previous task is used -- #
+        # -- If replay_ratio is set, every batch consists of this ratio of replayed cases instead of using the joined dataset -- #
+        self.replay_mode = 'fraction'
+        self.replay_budget = None
+        self.replay_budget_mb = None
+        self.replay_ratio = None
+        self.replay_pin = False
+        self.replay_buffer = None
+
         # -- Add seed in trained on file for restoring to be able to ensure that seed can not be changed during training -- #
         if already_trained_on is not None:
             # -- If the current fold does not exists initialize it -- #
@@ -64,10 +73,8 @@ class nnUNetTrainerRehearsal(nnUNetTrainerMultiHead):
     #------------------------------------------ Partially copied from original implementation ------------------------------------------#
     def get_basic_generators(self):
         r"""Calculate the joined dataset for the rehearsal training task.
+            The dataset index of every previous task is only loaded once and kept in the replay buffer.
         """
-        # -- Set the random seed based on self.seed -- #
-        random.seed(self.seed)
-
         # -- Load the current dataset and perform the splitting -- #
         self.load_dataset()
         self.do_split()
@@ -76,6 +83,7 @@ class nnUNetTrainerRehearsal(nnUNetTrainerMultiHead):
         # -- Without '[:]' for lists or '.copy()' for dicts both variables will change its values which is not desired -- #
         dataset_fused = self.dataset.copy()
         dataset_tr_fused = self.dataset_tr.copy()
+        replay_cases = dict()
         
         # -- Get the data regarding the current fold  -- #
         trained_on_folds = self.already_trained_on[str(self.fold)]
@@ -98,16 +106,21 @@ class nnUNetTrainerRehearsal(nnUNetTrainerMultiHead):
             # -- Update log -- #
             self.print_to_log_file("Start building datasets for rehearsal training.")
 
-            # -- Load random samples from the previous tasks -- #
+            # -- Add the previous tasks to the replay buffer that are not in there yet -- #
+            replay_buffer = self._get_replay_buffer()
             running_task_list = list()
             for idx, task in enumerate(tasks_in_head):
-                # -- Update the log -- #
-                self.print_to_log_file("Adding task \'{}\' to fused dataset for rehearsal training.".format(task))
-
                 # -- Update running task list and create running task which are all (trained tasks and current task joined) for output folder name -- #
                 running_task_list.append(task)
                 running_task = join_texts_with_char(running_task_list, '_')
 
+                # -- The dataset index of the task is already in the buffer -- #
+                if task in replay_buffer.tasks():
+                    continue
+
+                # -- Update the log -- #
+                self.print_to_log_file("Adding task \'{}\' to the replay buffer for rehearsal training.".format(task))
+
                 # -- Get default configuration for nnunet/nnunet_ext model (finished training) -- #
                 plans_file, _, self.dataset_directory, _, stage, \
                 _ = get_default_configuration(self.network_name, task, running_task, trained_on_folds['prev_trainer'][idx],\
@@ -124,47 +137,72 @@ class nnUNetTrainerRehearsal(nnUNetTrainerMultiHead):
                 self.dataset = load_dataset(folder_with_preprocessed_data)
                 self.do_split()
 
-                # -- Extract random sample from train and validation set -- #
-                sample_tr = random.sample(self.dataset_tr.items(), round(len(self.dataset_tr) * self.samples))
-                
-                # -- Extend the fused datasets -- #
-                dataset_fused.update(self.dataset)
-                dataset_tr_fused.update(sample_tr)
+                # -- Add the training cases to the buffer which selects the replayed ones -- #
+                replay_buffer.add_task(task, self.dataset_tr)
+
+            # -- Pin the selected cases if desired and store the buffer for restoring -- #
+            if self.replay_pin:
+                replay_buffer.pin(join(self.trained_on_path, 'replay_cache_fold_%s' % str(self.fold)))
+            replay_buffer.save(self._replay_buffer_path())
+            replay_cases = replay_buffer.cases()
+
+            # -- Extend the fused datasets -- #
+            dataset_fused.update(replay_cases)
+            if self.replay_ratio is None:
+                dataset_tr_fused.update(replay_cases)
 
             # -- Restore the data from backup and delete unnecessary variables -- #
             # -- NOTE: Do not restore self.dataset, since it has to include all data that will be used -- #
             self.dataset = dataset_fused
-            self.dataset_tr = dataset_tr_fused#dataset_tr_backup
+            self.dataset_tr = dataset_tr_fused
             self.dataset_val = dataset_val_backup
             self.dataset_directory = dataset_directory_backup
             del dataset_val_backup, dataset_directory_backup
 
             # -- Update the log -- #
             self.print_to_log_file("Succesfully build dataset for rehearsal training, moving on with training."
-                " Extended the train dataset from {} samples to {} samples.".format(init_tr_len, len(dataset_tr_fused)))
+                " The replay buffer holds {} cases ({:.1f} MB) of {} tasks, the train dataset has {} samples of the current task."
+                .format(len(replay_cases), replay_buffer.size_mb(), len(replay_buffer.tasks()), init_tr_len))
 
         # -- Create the dataloaders for training and validation -- #
-        if self.threeD:
-            dl_tr = DataLoader3D(dataset_tr_fused, self.basic_generator_patch_size, self.patch_size, self.batch_size,
-                                 False, oversample_foreground_percent=self.oversample_foreground_percent,
-                                 pad_mode="constant", pad_sides=self.pad_all_sides, memmap_mode='r')
-            dl_val = DataLoader3D(self.dataset_val, self.patch_size, self.patch_size, self.batch_size, False,
-                                  oversample_foreground_percent=self.oversample_foreground_percent,
-                                  pad_mode="constant", pad_sides=self.pad_all_sides, memmap_mode='r')
+        if self.replay_ratio is not None and len(replay_cases) > 0:
+            # -- Every batch consists of a fixed number of current and replayed cases -- #
+            nr_replay = min(max(int(round(self.batch_size * self.replay_ratio)), 1), self.batch_size - 1)
+            dl_tr = MixedDataLoader(self._build_dataloader(dataset_tr_fused, self.batch_size - nr_replay),
+                                    self._build_dataloader(replay_cases, nr_replay))
         else:
-            dl_tr = DataLoader2D(dataset_tr_fused, self.basic_generator_patch_size, self.patch_size, self.batch_size,
-                                 oversample_foreground_percent=self.oversample_foreground_percent,
-                                 pad_mode="constant", pad_sides=self.pad_all_sides, memmap_mode='r')
-            dl_val = DataLoader2D(self.dataset_val, self.patch_size, self.patch_size, self.batch_size,
-                                  oversample_foreground_percent=self.oversample_foreground_percent,
-                                  pad_mode="constant", pad_sides=self.pad_all_sides, memmap_mode='r')
+            dl_tr = self._build_dataloader(dataset_tr_fused, self.batch_size)
+        dl_val = self._build_dataloader(self.dataset_val, self.batch_size, validation=True)
         
         # -- Remove all fused variables -- #
-        del dataset_fused, dataset_tr_fused
-
-        # -- Reset the seed for random to default -- #
-        random.seed()
+        del dataset_fused, dataset_tr_fused, replay_cases
 
         # --- Return the dataloaders -- #
         return dl_tr, dl_val
-    #------------------------------------------ Partially copied from original implementation ------------------------------------------#
\ No newline at end of file
+    #------------------------------------------ Partially copied from original implementation ------------------------------------------#
+
+    def _build_dataloader(self, dataset, batch_size, validation=False):
+        r"""This function builds the nnU-Net data loader for the dataset, validation loaders do not use the larger patch size.
+        """
+        patch_size = self.patch_size if validation else self.basic_generator_patch_size
+        if self.threeD:
+            return DataLoader3D(dataset, patch_size, self.patch_size, batch_size, False,
+                                oversample_foreground_percent=self.oversample_foreground_percent,
+                                pad_mode="constant", pad_sides=self.pad_all_sides, memmap_mode='r')
+        return DataLoader2D(dataset, patch_size, self.patch_size, batch_size,
+                            oversample_foreground_percent=self.oversample_foreground_percent,
+                            pad_mode="constant", pad_sides=self.pad_all_sides, memmap_mode='r')
+
+    def _replay_buffer_path(self):
+        r"""This function returns the path of the stored replay buffer of the current fold.
+        """
+        return join(self.trained_on_path, self.extension + '_replay_buffer_fold_%s.pkl' % str(self.fold))
+
+    def _get_replay_buffer(self):
+        r"""This function returns the replay buffer, it is restored from disk if it has been stored with the same settings.
+        """
+        if self.replay_buffer is None:
+            self.replay_buffer = ReplayBuffer(self.replay_mode, self.replay_budget, self.replay_budget_mb, self.samples, self.seed)
+            if isfile(self._replay_buffer_path()) and self.replay_buffer.restore(self._replay_buffer_path()):
+                self.print_to_log_file("Restored the replay buffer with the tasks {}.".format(self.replay_buffer.tasks()))
+        return self.replay_buffer
@@ -7,10 +7,11 @@
 # -- Used implementation for PyTorch from here: https://github.com/fcdl94/MiB/blob/master/utils/regularizer.py -- #
 
 import torch
-from nnunet.utilities.to_torch import to_cuda
 from nnunet_ext.paths import default_plans_identifier
 from batchgenerators.utilities.file_and_folder_operations import *
 from nnunet.training.loss_functions.dice_loss import DC_and_CE_loss
+from nnunet_ext.utilities.tensor_store import STORE_DEVICE, TensorStore, load_tensor_values
+from nnunet_ext.training.loss_functions.rw_importance import RWImportance
 from nnunet_ext.training.loss_functions.deep_supervision import MultipleOutputLossRW as RWLoss
 from nnunet_ext.training.network_training.multihead.nnUNetTrainerMultiHead import nnUNetTrainerMultiHead
 
@@ -79,13 +80,24 @@ class nnUNetTrainerRW(nnUNetTrainerMultiHead):
         or self.already_trained_on[str(self.fold)]['scores_at'] is None:
             self.fisher, self.params, self.scores = dict(), dict(), dict()
         else:
-            self.fisher = load_pickle(self.already_trained_on[str(self.fold)]['fisher_at'])
-            self.params = load_pickle(self.already_trained_on[str(self.fold)]['params_at'])
-            self.scores = load_pickle(self.already_trained_on[str(self.fold)]['scores_at'])
+            # -- The values of a task are only loaded (onto the GPU) once they are used -- #
+            self.fisher = load_tensor_values(self.already_trained_on[str(self.fold)]['fisher_at'], STORE_DEVICE)
+            self.params = load_tensor_values(self.already_trained_on[str(self.fold)]['params_at'], STORE_DEVICE)
+            self.scores = load_tensor_values(self.already_trained_on[str(self.fold)]['scores_at'], STORE_DEVICE)
 
         # -- Define the path where the fisher and param values should be stored/restored -- #
         self.rw_data_path = join(self.trained_on_path, 'rw_data')
-        self.prev_param, self.prev_fisher, self.count = None, None, 0
+        self.count = 0
+
+        # -- The engine that updates the fisher and score values of the current task on flattened buffers on the device -- #
+        self.rw_importance = RWImportance(self.alpha, EPSILON)
+
+        # -- Specify if the gradient of the EWC penalty should be added to the gradients after the backward pass instead -- #
+        # -- of adding the penalty to the loss, so no graph needs to be built for it, see MultipleOutputLossEWC -- #
+        self.ewc_grad_hook = False
+
+        # -- Specify if the fisher, param and score values should be stored in half precision -- #
+        self.tensor_store_fp16 = False
 
     def initialize(self, training=True, force_load_plans=False, num_epochs=500, prev_trainer_path=None, call_for_eval=False):
         r"""Overwrite the initialize function so the correct Loss function for the RW method can be set.
@@ -101,9 +113,10 @@ class nnUNetTrainerRW(nnUNetTrainerMultiHead):
         if prev_trainer_path is not None and self.already_trained_on[str(self.fold)]['fisher_at'] is not None\
                                          and self.already_trained_on[str(self.fold)]['params_at'] is not None\
                                          and self.already_trained_on[str(self.fold)]['scores_at'] is not None:
-            self.fisher = load_pickle(self.already_trained_on[str(self.fold)]['fisher_at'])
-            self.params = load_pickle(self.already_trained_on[str(self.fold)]['params_at'])
-            self.scores = load_pickle(self.already_trained_on[str(self.fold)]['scores_at'])
+            # -- The values of a task are only loaded (onto the GPU) once they are used -- #
+            self.fisher = load_tensor_values(self.already_trained_on[str(self.fold)]['fisher_at'], STORE_DEVICE)
+            self.params = load_tensor_values(self.already_trained_on[str(self.fold)]['params_at'], STORE_DEVICE)
+            self.scores = load_tensor_values(self.already_trained_on[str(self.fold)]['scores_at'], STORE_DEVICE)
 
         # -- Reset self.loss from MultipleOutputLoss2 to DC_and_CE_loss so the RW Loss can be initialized properly -- #
         self.loss = DC_and_CE_loss({'batch_dice': self.batch_dice, 'smooth': 1e-5, 'do_bg': False}, {})
@@ -130,17 +143,6 @@ class nnUNetTrainerRW(nnUNetTrainerMultiHead):
             # -- Print Loss update -- #
             self.print_to_log_file("I am using RW loss now")
         
-        # -- Put data on GPU since the data is moved to CPU before it is stored -- #
-        for task in self.fisher.keys():
-            for key in self.fisher[task].keys():
-                to_cuda(self.fisher[task][key])
-        for task in self.params.keys():
-            for key in self.params[task].keys():
-                to_cuda(self.params[task][key])
-        for task in self.scores.keys():
-            for key in self.scores[task].keys():
-                to_cuda(self.scores[task][key])
-
         # -- Update the fisher, param and score values in the loss function -- #
         self.loss.update_rw_params(self.fisher, self.params, self.scores)
 
@@ -152,6 +154,9 @@ class nnUNetTrainerRW(nnUNetTrainerMultiHead):
                   to train, so it will be 500 and it does not set a prev_trainer. The prev_trainer will be set to None!
                   --> Initialize the trainer using your desired num_epochs and prev_trainer before calling run_training.  
         """
+        # -- Set the regularization mode of the loss -- #
+        self.loss.ewc_grad_hook = self.ewc_grad_hook
+
         # -- If there is at least one head and the current task is not in the heads, the network has finished on one task -- #
         # -- In such a case the fisher/param values should exist and should not be empty -- #
         if len(self.mh_network.heads) > 0 and task not in self.mh_network.heads:
@@ -161,18 +166,15 @@ class nnUNetTrainerRW(nnUNetTrainerMultiHead):
         # -- Define the fisher and params before the training -- #
         self.params[task] = dict()
 
-        # -- Set all fisher values to zero --> default to simply add the values easily -- #
-        self.fisher[task] = {n: torch.zeros_like(p, device='cuda:0', requires_grad=False)
-                      for n, p in self.network.named_parameters() if p.requires_grad}
-
-        self.scores[task] = {n: torch.zeros_like(p, device='cuda:0', requires_grad=False)
-                      for n, p in self.network.named_parameters() if p.requires_grad}
+        # -- Set all fisher and score values to zero --> they are views into the flattened buffers of the RW engine -- #
+        self.fisher[task], self.scores[task] = self.rw_importance.bind(self.network.named_parameters())
 
         # -- Execute the training for the desired epochs -- #
         ret = super().run_training(task, output_folder)  # Execute training from parent class --> already_trained_on will be updated there
 
-        # -- Reset score param variable -- #
-        self.prev_param, self.count = None, 0
+        # -- Reset the RW engine and the count variable, the fisher and score values of the task remain -- #
+        self.rw_importance.reset()
+        self.count = 0
 
         # -- Extract the current params as well -- #
         self._extract_params()
@@ -234,31 +236,9 @@ class nnUNetTrainerRW(nnUNetTrainerMultiHead):
         """
         # -- Only do this every fisher_update_after epoch -- #
         if self.count % self.fisher_update_after == 0:
-            # -- Update the scores -- #
-            if self.prev_param is not None:
-                # -- Update the importance score using distance in Riemannian Manifold -- #
-                for name, param in self.network.named_parameters():
-                    if param.grad is not None:
-                        # -- Get parameter difference from old param and current param t -- #
-                        delta = param.grad.detach() * (self.prev_param[name].to(param.device) - param.detach())
-                        # -- Calculate score denominator -- #
-                        den = 0.5 * self.fisher[self.task][name] * (param.detach() - self.prev_param[name].to(param.device)).pow(2) + EPSILON
-                        # -- Score: delat(L) / 0.5*F_t*delta(param)^2 --> only positive or zero values -- #
-                        scores = (delta / den)
-                        scores[scores < 0] = 0  # Ensure no negative values
-                        # -- Update the scores -- #
-                        self.scores[self.task][name] += scores
-
-            # -- Update the prev params -- #
-            self.prev_param = {k: torch.clone(v).detach().cpu() for k, v in self.network.named_parameters() if v.grad is not None}
-
-            # -- Update the fisher values -- #
-            for name, param in self.network.named_parameters():
-                # -- F_t = alpha * F_t + (1-alpha) * F_t-1
-                if param.grad is not None:
-                    f_t = param.grad.data.clone().pow(2)
-                    f_to = self.fisher[self.task][name] if self.fisher[self.task][name] is not None else torch.tensor([0], device='cuda:0')
-                    self.fisher[self.task][name] = (self.alpha * f_t) + ((1 - self.alpha) * f_to)
+            # -- Update the scores using the distance in the Riemannian Manifold and the fisher values -- #
+            # -- F_t = alpha * F_t + (1-alpha) * F_t-1 for all parameters at once, see RWImportance -- #
+            self.rw_importance.update()
         
         # -- Increase our count variable -- #
         self.count += 1
@@ -266,30 +246,18 @@ class nnUNetTrainerRW(nnUNetTrainerMultiHead):
     def save_f_p_s_values(self):
         r"""This function stores the fisher, param and score values.
         """
-        # -- Put data from GPU to CPU before storing them in files -- #
-        for task in self.fisher.keys():
-            for key in self.fisher[task].keys():
-                self.fisher[task][key].cpu()
-        for task in self.params.keys():
-            for key in self.params[task].keys():
-                self.params[task][key].cpu()
-        for task in self.scores.keys():
-            for key in self.scores[task].keys():
-                self.scores[task][key].cpu()
-
-        # -- Dump both dicts as pkl files -- #
-        maybe_mkdir_p(self.rw_data_path)
-        write_pickle(self.fisher, join(self.rw_data_path, 'fisher_values.pkl'))
-        write_pickle(self.params, join(self.rw_data_path, 'param_values.pkl'))
-        write_pickle(self.scores, join(self.rw_data_path, 'score_values.pkl'))
-
-        if self.already_trained_on[str(self.fold)]['fisher_at'] is None\
-        or self.already_trained_on[str(self.fold)]['params_at'] is None\
-        or self.already_trained_on[str(self.fold)]['scores_at'] is None:
+        # -- Store the dicts, only the values of the current task change during the training, so only they are written -- #
+        TensorStore(join(self.rw_data_path, 'fisher_values'), self.tensor_store_fp16).save(self.fisher, [self.task])
+        TensorStore(join(self.rw_data_path, 'param_values'), self.tensor_store_fp16).save(self.params, [self.task])
+        TensorStore(join(self.rw_data_path, 'score_values'), self.tensor_store_fp16).save(self.scores, [self.task])
+
+        if self.already_trained_on[str(self.fold)]['fisher_at'] != join(self.rw_data_path, 'fisher_values')\
+        or self.already_trained_on[str(self.fold)]['params_at'] != join(self.rw_data_path, 'param_values')\
+        or self.already_trained_on[str(self.fold)]['scores_at'] != join(self.rw_data_path, 'score_values'):
             # -- Update the already_trained_on file that the values exist if necessary -- #
-            self.already_trained_on[str(self.fold)]['fisher_at'] = join(self.rw_data_path, 'fisher_values.pkl')
-            self.already_trained_on[str(self.fold)]['params_at'] = join(self.rw_data_path, 'param_values.pkl')
-            self.already_trained_on[str(self.fold)]['scores_at'] = join(self.rw_data_path, 'score_values.pkl')
+            self.already_trained_on[str(self.fold)]['fisher_at'] = join(self.rw_data_path, 'fisher_values')
+            self.already_trained_on[str(self.fold)]['params_at'] = join(self.rw_data_path, 'param_values')
+            self.already_trained_on[str(self.fold)]['scores_at'] = join(self.rw_data_path, 'score_values')
             
             # -- Save the updated dictionary as a json file -- #
             save_json(self.already_trained_on, join(self.trained_on_path, self.extension+'_trained_on.pkl'))
@@ -298,20 +266,6 @@ class nnUNetTrainerRW(nnUNetTrainerMultiHead):
             # -- Resave the final model pkl file so the already trained on is updated there as well -- #
             self.save_init_args(join(self.output_folder, "model_final_checkpoint.model"))
 
-        # -- Put data from CPU back to GPU -- #
-        for task in self.fisher.keys():
-            for key in self.fisher[task].keys():
-                if key == self.task:
-                    to_cuda(self.fisher[task][key])
-        for task in self.params.keys():
-            for key in self.params[task].keys():
-                if key == self.task:
-                    to_cuda(self.params[task][key])
-        for task in self.scores.keys():
-            for key in self.scores[task].keys():
-                if key == self.task:
-                    to_cuda(self.scores[task][key])
-
     def _extract_params(self):
         r"""This function is used to extract the parameters after the finished training.
         """
@@ -0,0 +1,122 @@
+##########################################################################################################
+#------This module contains the feature capture of intermediate results for the distillation trainers.---#
+##########################################################################################################
+
+import re
+import torch.nn.functional as F
+
+def is_conv(module):
+    r"""This function returns if the module is of any convolutional type, ie. Conv and ConvTranspose of any dimension.
+    """
+    return 'conv.Conv' in str(type(module))
+
+def module_stage(name):
+    r"""This function returns the stage of a module, ie. the first index in its path like 2 in conv_blocks_context.2.blocks.0.conv,
+        or None if the path does not contain an index.
+    """
+    for part in name.split('.'):
+        if part.isdigit():
+            return int(part)
+    return None
+
+def select_modules(network, patterns=None, stages=None, max_depth=None, predicate=is_conv):
+    r"""This function selects the names of the modules whose outputs should be captured.
+        :param network: The network the modules are selected from
+        :param patterns: List of regular expressions, a module is selected if any of them is found in its name. None selects all names
+        :param stages: List of stages, a module is selected if its stage (see module_stage) is in the list. None selects all stages
+        :param max_depth: Maximum depth of the module in the network, ie. the number of dots in its name. None selects all depths
+        :param predicate: Function that returns if a module has the right type, by default every convolutional layer
+        :return: List of the selected module names
+    """
+    names = list()
+    for name, module in network.named_modules():
+        if name == '' or not predicate(module):
+            continue
+        if patterns is not None and not any(re.search(pattern, name) for pattern in patterns):
+            continue
+        if stages is not None and module_stage(name) not in stages:
+            continue
+        if max_depth is not None and name.count('.') > max_depth:
+            continue
+        names.append(name)
+    return names
+
+class FeatureCapture():
+    r"""This class captures the outputs of selected modules of a network using forward hooks, eg. for the POD embeddings
+        of the distillation trainers (PLOP, POD, Own methods). The hook handles are tracked, so attaching the capture
+        again does not register duplicate hooks and the hooks can be removed before a network is copied. The captured
+        outputs can optionally be pooled inside the hook, and detached outputs are copied into buffers that are reused
+        during every iteration, so the outputs of the network and their graph do not need to be kept alive.
+    """
+    def __init__(self, patterns=None, stages=None, max_depth=None, pool=1, detach=True, reuse_buffers=True):
+        r"""Constructor of the feature capture.
+            :param patterns: List of regular expressions for the module names to capture, see select_modules
+            :param stages: List of stages of the modules to capture, see select_modules
+            :param max_depth: Maximum depth of the modules to capture, see select_modules
+            :param pool: Kernel size of the average pooling that is applied to the captured outputs, 1 does not pool
+            :param detach: Set this flag if the captured outputs should be detached from the graph
+            :param reuse_buffers: Set this flag if the detached outputs should be copied into buffers that are reused
+        """
+        self.patterns = patterns
+        self.stages = stages
+        self.max_depth = max_depth
+        self.pool = pool
+        self.detach = detach
+        self.reuse_buffers = reuse_buffers
+
+        # -- The captured outputs of the last forward pass, ie. {module_name: tensor} -- #
+        self.results = dict()
+        self._buffers = dict()
+        self._handles = list()
+        self._network = None
+
+    def attach(self, network):
+        r"""This function registers the hooks on the selected modules of the network. If the capture is already attached
+            to this network nothing happens, if it is attached to another network it is removed from it first.
+            :return: The list of the captured module names
+        """
+        if self._network is network and len(self._handles) > 0:
+            return self.module_names()
+        self.remove()
+        for name in select_modules(network, self.patterns, self.stages, self.max_depth):
+            module = network.get_submodule(name)
+            self._handles.append((name, module.register_forward_hook(self._hook(name))))
+        self._network = network
+        return self.module_names()
+
+    def remove(self):
+        r"""This function removes all hooks and buffers of the capture. Call it before the network is deep-copied,
+            otherwise the hooks are copied as well.
+        """
+        for _, handle in self._handles:
+            handle.remove()
+        self._handles, self._network = list(), None
+        self.results.clear()
+        self._buffers.clear()
+
+    def clear(self):
+        r"""This function removes the captured outputs, the buffers are kept so they can be reused.
+        """
+        self.results.clear()
+
+    def module_names(self):
+        r"""This function returns the names of the modules the hooks are registered on.
+        """
+        return [name for name, _ in self._handles]
+
+    def _hook(self, name):
+        r"""This function returns the hook for the module with the provided name.
+        """
+        def hook(module, input, output):
+            value = output.detach() if self.detach else output
+            if self.pool > 1 and value.dim() in [4, 5]:
+                pool_fn = F.avg_pool2d if value.dim() == 4 else F.avg_pool3d
+                value = pool_fn(value, kernel_size=self.pool, ceil_mode=True)
+            if self.detach and self.reuse_buffers:
+                # -- Copy the output into the buffer of the last iteration if it still fits, so no new memory is allocated -- #
+                buffer = self._buffers.get(name, None)
+                if buffer is None or buffer.shape != value.shape or buffer.dtype != value.dtype or buffer.device != value.device:
+                    buffer = self._buffers[name] = value.new_empty(value.shape)
+                value = buffer.copy_(value)
+            self.results[name] = value
+        return hook
@@ -0,0 +1,161 @@
+##########################################################################################################
+#-------This module contains the foreground location index of the preprocessed data for the loaders.-----#
+##########################################################################################################
+
+import os, shutil
+import numpy as np
+from multiprocessing import Pool
+from collections import OrderedDict
+from nnunet.configuration import default_num_threads
+from batchgenerators.utilities.file_and_folder_operations import *
+
+def case_locations(data_file, max_locations=10000, min_coverage=0.01, seed=1234):
+    r"""This function samples the foreground locations of every class of a preprocessed case, in the same way as the
+        nnU-Net preprocessing does for the class_locations, ie. at most max_locations but at least min_coverage of the voxels.
+        :param data_file: The .npz file of the case, the unpacked .npy file is used if it exists
+        :param max_locations: The maximum number of locations per class
+        :param min_coverage: The minimum fraction of the voxels of a class that are sampled
+        :param seed: The seed of the sampling
+        :return: Dictionary {class: int32 array of shape (n, dim)}
+    """
+    if isfile(data_file[:-4] + '.npy'):
+        seg = np.load(data_file[:-4] + '.npy', mmap_mode='r')[-1]
+    else:
+        seg = np.load(data_file)['data'][-1]
+    rnd = np.random.RandomState(seed)
+    locations = dict()
+    for c in np.unique(seg):
+        if c <= 0:
+            continue
+        all_locations = np.argwhere(seg == c)
+        nr_samples = min(len(all_locations), max(max_locations, int(np.ceil(len(all_locations) * min_coverage))))
+        locations[int(c)] = all_locations[rnd.choice(len(all_locations), nr_samples, replace=False)].astype(np.int32)
+    return locations
+
+class ForegroundIndex():
+    r"""This class holds the sampled foreground locations of every class of every case in a folder with preprocessed data.
+        The locations of all cases are stored in one array (foreground_index/locations.npy) next to the preprocessed data,
+        along with the start and end of every case and class in the index file. The array is memory-mapped, so choosing a
+        foreground location of a case only reads one row. The index is built once in parallel and extended by the cases
+        that are missing.
+    """
+    def __init__(self, folder, max_locations=10000, min_coverage=0.01, seed=1234):
+        r"""Constructor of the foreground index, an existing index in folder is used if it has been built with the same settings.
+            :param folder: The folder with the preprocessed data
+            :param max_locations: The maximum number of locations per class and case
+            :param min_coverage: The minimum fraction of the voxels of a class that are sampled
+            :param seed: The seed of the sampling
+        """
+        self.folder = folder
+        self.index_folder = join(folder, 'foreground_index')
+        self.settings = {'max_locations': max_locations, 'min_coverage': min_coverage, 'seed': seed}
+        self.index = {'settings': self.settings, 'cases': dict()}
+        self._locations = None
+        if isfile(join(self.index_folder, 'index.json')):
+            index = load_json(join(self.index_folder, 'index.json'))
+            if index['settings'] == self.settings:
+                self.index = index
+
+    def cases(self):
+        r"""This function returns the cases that are in the index.
+        """
+        return list(self.index['cases'].keys())
+
+    def build(self, cases, num_processes=default_num_threads):
+        r"""This function adds the locations of the cases that are not in the index yet, using several processes.
+            :param cases: Dictionary {case: data_file} or a dataset {case: entry} as returned by load_dataset
+            :param num_processes: The number of processes that sample the locations
+        """
+        cases = OrderedDict((case, value['data_file'] if isinstance(value, dict) else value) for case, value in cases.items()
+                            if case not in self.index['cases'])
+        if len(cases) == 0:
+            return
+        args = [(data_file, self.settings['max_locations'], self.settings['min_coverage'], self.settings['seed']) for data_file in cases.values()]
+        with Pool(max(min(num_processes, len(args)), 1)) as pool:
+            results = pool.starmap(case_locations, args)
+
+        # -- Append the new locations to the existing ones -- #
+        parts = [np.asarray(self.locations())] if self._nr_locations() > 0 else list()
+        offset = self._nr_locations()
+        for case, locations in zip(cases.keys(), results):
+            self.index['cases'][case] = dict()
+            for c, value in locations.items():
+                self.index['cases'][case][str(c)] = [offset, offset + len(value)]
+                offset += len(value)
+                parts.append(value)
+        parts = [part for part in parts if len(part) > 0]
+        array = np.concatenate(parts) if len(parts) > 0 else np.zeros((0, 3), dtype=np.int32)
+
+        # -- Write into temporary files first, so other processes never see a partially written index -- #
+        maybe_mkdir_p(self.index_folder)
+        self._locations = None
+        np.save(join(self.index_folder, 'locations.tmp.npy'), array)
+        os.replace(join(self.index_folder, 'locations.tmp.npy'), join(self.index_folder, 'locations.npy'))
+        save_json(self.index, join(self.index_folder, 'index.tmp.json'))
+        os.replace(join(self.index_folder, 'index.tmp.json'), join(self.index_folder, 'index.json'))
+
+    def locations(self):
+        r"""This function returns the memory-mapped array with the locations of all cases.
+        """
+        if self._locations is None:
+            self._locations = np.load(join(self.index_folder, 'locations.npy'), mmap_mode='r')
+        return self._locations
+
+    def class_locations(self, case):
+        r"""This function returns the locations of a case in the format of the class_locations of the nnU-Net properties,
+            ie. {class: array of shape (n, dim)}, where the arrays are views into the memory-mapped array.
+        """
+        return {int(c): self.locations()[start:end] for c, (start, end) in self.index['cases'][case].items()}
+
+    def random_location(self, case, c=None, rnd=np.random):
+        r"""This function returns a random foreground location of a case in O(1), ie. only one row is read.
+            :param case: The case identifier
+            :param c: The class of the location, None uses a random class of the case
+            :param rnd: The random state to use
+            :return: The location as array of shape (dim,) or None if the case does not contain the class
+        """
+        classes = self.index['cases'][case]
+        if c is None:
+            if len(classes) == 0:
+                return None
+            c = list(classes.keys())[rnd.randint(len(classes))]
+        if str(c) not in classes:
+            return None
+        start, end = classes[str(c)]
+        return np.array(self.locations()[start + rnd.randint(end - start)])
+
+    def reset(self):
+        r"""This function removes the index from the disk.
+        """
+        self.index = {'settings': self.settings, 'cases': dict()}
+        self._locations = None
+        if isdir(self.index_folder):
+            shutil.rmtree(self.index_folder, ignore_errors=True)
+
+    def _nr_locations(self):
+        r"""This function returns the number of stored locations.
+        """
+        return max([end for classes in self.index['cases'].values() for _, end in classes.values()], default=0)
+
+def attach_foreground_index(dataset, num_processes=default_num_threads):
+    r"""This function sets the class_locations in the properties of every case of a dataset to the locations of the
+        foreground index of its folder, which is built first if cases are missing. The nnU-Net data loaders then choose
+        foreground centred patches using the index, without loading the properties of a case every time.
+        Cases are grouped by the folder of their properties file, so datasets joining several tasks (rehearsal) are supported.
+        :param dataset: Dataset {case: entry} as returned by load_dataset, the entries are updated in place
+        :param num_processes: The number of processes that build the index
+    """
+    folders = OrderedDict()
+    for case, entry in dataset.items():
+        if not entry.get('foreground_index', False):
+            folders.setdefault(os.path.dirname(entry['properties_file']), OrderedDict())[case] = entry
+    for folder, cases in folders.items():
+        index = ForegroundIndex(folder)
+        # -- Build the index using the original data files, pinned copies might not exist yet -- #
+        index.build(OrderedDict((case, join(folder, case + '.npz')) for case in cases.keys()), num_processes)
+        for case, entry in cases.items():
+            properties = entry['properties'] if 'properties' in entry else load_pickle(entry['properties_file'])
+            properties = dict(properties)
+            properties['class_locations'] = index.class_locations(case)
+            entry['properties'] = properties
+            entry['foreground_index'] = True
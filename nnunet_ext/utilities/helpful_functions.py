@@ -9,6 +9,7 @@ from torch.cuda.amp import autocast
 from contextlib import contextmanager
 import copy, torch, time, sys, os, shutil, importlib
 from nnunet.utilities.to_torch import maybe_to_torch, to_cuda
+from nnunet_ext.utilities.seeded_batches import seeded_batch, seeded_batches
 from batchgenerators.utilities.file_and_folder_operations import *
 from nnunet_ext.paths import nnUNet_raw_data, nnUNet_cropped_data, preprocessing_output_dir
 
@@ -204,16 +205,22 @@ def dumpDataFrameToCsv(data, path, name, sep='\t'):
     # -- Dump the DataFrame using the path and seperator without using the index from the frame -- #
     data.to_csv(path, index=False, sep=sep)
 
-def calculate_target_logits(mh_network, gen, num_batches_per_epoch, fp16, gpu_id=0):
+def calculate_target_logits(mh_network, gen, num_batches_per_epoch, fp16, gpu_id=0, store=None):
     r"""This function is used to calculate the target_logits based on a transmitted generator.
         The function returns a dictionary representing the target_logits based on the mh_network.
         This function is essential for the LwF Trainer.
         :param mh_network: A MultiHead Network that is used to generate the target logits with (every head is used)
-        :param gen: The generator for which the target_logits are extracted
+        :param gen: The generator for which the target_logits are extracted, or a list of generators. The logits of a
+                    generator with seeded batches (see nnunet_ext/utilities/seeded_batches.py) are computed for every one
+                    of its batches, for the other generators num_batches_per_epoch batches are used
         :param num_batches_per_epoch: Represents the number of batches per epoch
         :param fp16: Specify if using floating point 16 or not
         :param gpu_id: Specify the CUDA ID to put the model and data on. If set to -1, the CPU will be used
-        :return: A dictionary with the target_logits (list of tensors) per task (head)
+        :param store: Optional LogitStore the target_logits are written to per sample instead of keeping them in RAM.
+                      Only the heads whose logits are not yet stored for a batch are computed. The batches need to be
+                      seeded, since the samples are stored by their 'sample_keys'
+        :return: A dictionary with the target_logits (list of tensors) per task (head) or, if a store is provided, the list
+                 of the sample keys of every batch
     """
     # -- Define where to put the data and model during the calculation -- #
     if gpu_id == -1:
@@ -221,48 +228,72 @@ def calculate_target_logits(mh_network, gen, num_batches_per_epoch, fp16, gpu_id
     else:
         device = 'cuda:'+str(gpu_id)
 
-    # -- Loop through tasks and build the corresponding model to make predictions -- #
-    target_logits = dict()
-    for task in list(mh_network.heads.keys()):
-        # -- Build the corresponding network -- #
-        network = mh_network.assemble_model(task)
-        # -- Remove the softmax layer at the end by replacing the corresponding element with an identity function -- #
-        network.inference_apply_nonlin = lambda x: x
-        # -- Put netowrl to CPU or GPU device as desired -- #
-        network.to(device)
-        # -- Set network to eval -- #
-        network.eval()
-        # -- Add the task to the dict -- #
-        target_logits[task] = list()
-
-        # -- Make the predictions and store them in a dictionary to use during the LwF loss -- #
-        for _ in range(num_batches_per_epoch):
-            # -- Extract the current batch from data transform to tensor and push to GPU -- #
-            data_dict = next(gen)
-            x = maybe_to_torch(data_dict['data'])
-            # -- Put data on GPU if no CPU is desired --> currently x is on CPU -- #
-            if device != 'cpu':
-                x = to_cuda(x, gpu_id=gpu_id)
-
-            # -- Make predictions using the loaded model and data -- #
+    # -- Use the running model for the predictions, every head is used on the same batches -- #
+    network = mh_network.model
+    # -- Remove the softmax layer at the end by replacing the corresponding element with an identity function -- #
+    network.inference_apply_nonlin = lambda x: x
+    # -- Put network to CPU or GPU device as desired -- #
+    network.to(device)
+    # -- Set network to eval -- #
+    network.eval()
+    # -- Add the tasks to the dict -- #
+    target_logits = {task: list() for task in mh_network.heads.keys()} if store is None else list()
+
+    # -- Iterate over every seeded batch or over num_batches_per_epoch batches of every generator -- #
+    def batches():
+        for g in (gen if isinstance(gen, (list, tuple)) else [gen]):
+            if seeded_batches(g) is not None:
+                for seed in seeded_batches(g).seeds():
+                    yield seeded_batch(g, seed)
+            else:
+                for _ in range(num_batches_per_epoch):
+                    yield next(g)
+
+    # -- Make the predictions and store them in a dictionary to use during the LwF loss -- #
+    for data_dict in batches():
+        # -- Extract the current batch from data transform to tensor and push to GPU -- #
+        x = maybe_to_torch(data_dict['data'])
+        # -- Put data on GPU if no CPU is desired --> currently x is on CPU -- #
+        if device != 'cpu':
+            x = to_cuda(x, gpu_id=gpu_id)
+
+        # -- Only compute the heads whose logits are missing in the store for this batch -- #
+        tasks = None
+        if store is not None:
+            assert 'sample_keys' in data_dict, "The target_logits can only be stored for seeded batches, see seed_batches."
+            keys = data_dict['sample_keys']
+            target_logits.append(keys)
+            tasks = store.missing_tasks(list(mh_network.heads.keys()), keys)
+            if len(tasks) == 0:
+                continue
+
+        # -- Make predictions with every head at once, so the shared body is only computed once per batch -- #
+        with torch.no_grad():
             if fp16:
                 with autocast():
-                    output = network(x)[0]
+                    outputs = mh_network.forward_all_heads(x, tasks)
             else:
-                output = network(x)[0]
-                
-            task_logit = copy.deepcopy(output.detach().cpu())   # --> To cut any links or references
-            del x, output
+                outputs = mh_network.forward_all_heads(x, tasks)
 
+        for task, output in outputs.items():
+            if store is not None:
+                store.store(task, keys, output[0])
+                continue
+            task_logit = copy.deepcopy(output[0].detach().cpu())   # --> To cut any links or references
             # -- Append the result to target_logits -- #
             target_logits[task].extend(task_logit)
             del task_logit
+        del x, outputs
 
     # -- Empty the GPU cache if a GPU was used -- #
     if device != 'cpu':
         torch.cuda.empty_cache()
 
-    # -- Return the target_logits -- #
+    # -- Write the index of the store, so it can be used again when restoring -- #
+    if store is not None:
+        store.flush()
+
+    # -- Return the target_logits or the keys of the stored samples -- #
     return target_logits
 
 # -- Modified version of https://www.geeksforgeeks.org/common-divisors-of-two-numbers/ -- # 
@@ -0,0 +1,183 @@
+##########################################################################################################
+#-----------This module contains the on-disk store for the target logits of the LwF trainer.-------------#
+##########################################################################################################
+
+import os, shutil, torch
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from batchgenerators.utilities.file_and_folder_operations import *
+
+class LogitStore():
+    r"""This class stores the target logits of every head (task) per sample in memory-mapped files, one file per head,
+        so the logits do not need to be kept in RAM. A sample is identified by its key from a seeded batch (see
+        nnunet_ext/utilities/seeded_batches.py), ie. its case identifier and the seed of its crop and augmentation.
+        The logits are stored in half precision or quantized to 8 bit with an offset and scale per sample and channel.
+        Every head has a fixed number of slots and the oldest samples are replaced first once all slots are used. The
+        index is stored next to the files, so a store can be opened again and only the heads or samples that are missing
+        have to be computed, eg. when a new head is added. The logits of a batch are read at once and can optionally be
+        prefetched into pinned memory by a background thread.
+    """
+    def __init__(self, folder, capacity, quantize=False, prefetch=False):
+        r"""Constructor of the logit store, an existing store in folder is used if it has been built with the same settings.
+            :param folder: The folder in which the memory-mapped files and the index are stored, it is removed again with reset
+            :param capacity: The maximum number of samples that are stored per head
+            :param quantize: Set this flag if the logits should be quantized to 8 bit instead of stored in half precision
+            :param prefetch: Set this flag if the logits should be prefetched into pinned memory by a background thread
+        """
+        assert capacity > 0, "The capacity of the logit store needs to be greater than 0."
+        self.folder = folder
+        self.capacity = capacity
+        self.quantize = quantize
+        self.hits, self.misses = 0, 0
+        self._data, self._pending = dict(), dict()
+        self._executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        self._index = load_json(join(folder, 'index.json')) if isfile(join(folder, 'index.json')) else dict()
+        if any(entry['quantize'] != quantize or entry['capacity'] != capacity for entry in self._index.values()):
+            self.reset()
+
+    def tasks(self):
+        r"""This function returns the names of the heads that have logits in the store.
+        """
+        return list(self._index.keys())
+
+    def contains(self, task, keys):
+        r"""This function returns if the logits of every sample in keys are stored for the head of task.
+        """
+        return task in self._index and all(key in self._index[task]['keys'] for key in keys)
+
+    def missing_tasks(self, tasks, keys):
+        r"""This function returns the heads for which the logits of at least one sample in keys are not stored.
+        """
+        missing = [task for task in tasks if not self.contains(task, keys)]
+        self.misses += len(missing)
+        return missing
+
+    def store(self, task, keys, logits):
+        r"""This function stores the logits of a batch for the head of task, the oldest samples are replaced if all slots are used.
+            :param task: The name of the head the logits belong to
+            :param keys: The keys of the samples, ie. the 'sample_keys' of a seeded batch
+            :param logits: The logits of the batch, ie. a tensor of shape (b, c, ...)
+        """
+        if task not in self._index:
+            self._index[task] = {'shape': list(logits.shape[1:]), 'quantize': self.quantize, 'capacity': self.capacity,
+                                 'keys': dict(), 'slots': [None] * self.capacity, 'next': 0}
+        entry = self._index[task]
+        # -- Logits with another shape, eg. of the last batch, are simply not stored -- #
+        if list(logits.shape[1:]) != entry['shape']:
+            return
+        new = {key: sample for sample, key in enumerate(keys) if key not in entry['keys']}
+        if len(new) == 0:
+            return
+        rows = self._encode(logits.detach()[list(new.values())])
+        # -- Wait for a running prefetch, since its slots might be replaced now -- #
+        if task in self._pending:
+            self._pending[task][1].result()
+        data = self._memmap(task)
+        for key, row in zip(new.keys(), rows):
+            slot = entry['next']
+            if entry['slots'][slot] is not None:
+                del entry['keys'][entry['slots'][slot]]
+            entry['next'] = (slot + 1) % self.capacity
+            data[slot] = row
+            entry['keys'][key], entry['slots'][slot] = slot, key
+
+    def prefetch(self, task, keys):
+        r"""This function starts to read the logits of a batch into pinned memory in the background, the next load with
+            the same keys uses them. Nothing happens if prefetching is disabled or a sample is not stored.
+        """
+        if self._executor is None or not self.contains(task, keys):
+            return
+        slots = [self._index[task]['keys'][key] for key in keys]
+        self._pending[task] = (slots, self._executor.submit(self._read, task, slots, True))
+
+    def load(self, task, keys, device=None):
+        r"""This function loads the logits of a batch for the head of task.
+            :param task: The name of the head
+            :param keys: The keys of the samples, ie. the 'sample_keys' of a seeded batch
+            :param device: The device the logits should be put on
+            :return: The logits of shape (b, c, ...) or None if a sample is not stored
+        """
+        pending = self._pending.pop(task, None)
+        if not self.contains(task, keys):
+            self.misses += 1
+            return None
+        self.hits += 1
+        slots = [self._index[task]['keys'][key] for key in keys]
+        rows = pending[1].result() if pending is not None and pending[0] == slots else self._read(task, slots)
+        return self._decode(task, rows, device)
+
+    def remove_task(self, task):
+        r"""This function removes the logits of the head of task, eg. if the head changed.
+        """
+        if task in self._pending:
+            self._pending.pop(task)[1].result()
+        self._data.pop(task, None)
+        self._index.pop(task, None)
+        if isfile(join(self.folder, task + '.bin')):
+            os.remove(join(self.folder, task + '.bin'))
+
+    def flush(self):
+        r"""This function writes the memory-mapped files and the index to disk, so the store can be opened again.
+        """
+        for data in self._data.values():
+            data.flush()
+        maybe_mkdir_p(self.folder)
+        save_json(self._index, join(self.folder, 'index.json'))
+
+    def reset(self):
+        r"""This function removes all stored logits along with the files, eg. when the model that computes them changed.
+        """
+        for _, future in self._pending.values():
+            future.result()
+        self._data, self._pending, self._index = dict(), dict(), dict()
+        self.hits, self.misses = 0, 0
+        if isdir(self.folder):
+            shutil.rmtree(self.folder, ignore_errors=True)
+
+    def _memmap(self, task):
+        r"""This function returns the memory-mapped file of the head of task, which holds one row of bytes per slot.
+        """
+        if task not in self._data:
+            shape = self._index[task]['shape']
+            row_bytes = int(np.prod(shape, dtype=np.int64)) * (1 if self.quantize else 2) + (2 * shape[0] * 4 if self.quantize else 0)
+            maybe_mkdir_p(self.folder)
+            path = join(self.folder, task + '.bin')
+            self._data[task] = np.memmap(path, dtype=np.uint8, mode='r+' if isfile(path) else 'w+', shape=(self.capacity, row_bytes))
+        return self._data[task]
+
+    def _read(self, task, slots, pin=False):
+        r"""This function reads the rows of the slots at once, sorted by their position in the file.
+        """
+        slots = np.asarray(slots)
+        order = np.argsort(slots)
+        data = self._memmap(task)
+        rows = np.empty((len(slots), data.shape[1]), dtype=np.uint8)
+        rows[order] = data[slots[order]]
+        rows = torch.from_numpy(rows)
+        return rows.pin_memory() if pin and torch.cuda.is_available() else rows
+
+    def _encode(self, logits):
+        r"""This function converts the logits into rows of bytes on their device, so only the encoded bytes are copied.
+            Quantized rows start with the offset and scale per channel (float32), followed by the 8 bit values.
+        """
+        n = logits.size(0)
+        if not self.quantize:
+            return logits.half().reshape(n, -1).cpu().numpy().view(np.uint8)
+        flat = logits.float().reshape(n, logits.size(1), -1)
+        low = flat.amin(dim=2)
+        scale = ((flat.amax(dim=2) - low) / 255).clamp_min(1e-8)
+        values = ((flat - low[..., None]) / scale[..., None]).round_().clamp_(0, 255).to(torch.uint8)
+        params = torch.stack((low, scale), dim=1).reshape(n, -1)
+        return np.concatenate((params.cpu().numpy().view(np.uint8), values.reshape(n, -1).cpu().numpy()), axis=1)
+
+    def _decode(self, task, rows, device):
+        r"""This function converts the rows of bytes back into logits on the device.
+        """
+        shape = self._index[task]['shape']
+        rows = rows.to(device, non_blocking=True)
+        if not self.quantize:
+            return rows.view(torch.float16).reshape(rows.size(0), *shape)
+        nr_params = 2 * shape[0] * 4
+        params = rows[:, :nr_params].contiguous().view(torch.float32).reshape(rows.size(0), 2, shape[0], 1)
+        values = rows[:, nr_params:].reshape(rows.size(0), shape[0], -1).float()
+        return (values * params[:, 1] + params[:, 0]).reshape(rows.size(0), *shape)
@@ -0,0 +1,223 @@
+##########################################################################################################
+#------This module contains the replay buffer and the mixing data loader for the rehearsal trainer.------#
+##########################################################################################################
+
+import os, shutil, random
+import numpy as np
+from collections import OrderedDict
+from batchgenerators.utilities.file_and_folder_operations import *
+from batchgenerators.dataloading.data_loader import SlimDataLoaderBase
+
+# -- Supported selection strategies of the replay buffer -- #
+REPLAY_MODES = ['fraction', 'reservoir', 'class_balanced']
+
+class ReplayBuffer():
+    r"""This class holds the cases of previous tasks that are replayed during the rehearsal training. The dataset index,
+        ie. the training cases after the split, of every task is only loaded once and kept in the buffer, so a new task
+        only adds its own index. The selection of the replayed cases depends on the mode:
+            - fraction: A fixed fraction of every task is selected, ie. the buffer grows with every task
+            - reservoir: Reservoir sampling over the cases of all tasks, so every case seen so far has the same
+                         probability to be in the buffer, which holds a fixed number of cases (budget)
+            - class_balanced: The budget is split evenly between the classes of every task, a case counts for the
+                              rarest foreground class it contains
+        Additionally, a memory budget in MB (size of the preprocessed files) can be set for every mode. The selected cases
+        can be pinned, ie. copied as uncompressed numpy files into a cache folder, so the data loaders can memory-map them.
+    """
+    def __init__(self, mode='fraction', budget=None, budget_mb=None, fraction=0.25, seed=3299):
+        r"""Constructor of the replay buffer.
+            :param mode: The selection strategy, one of REPLAY_MODES
+            :param budget: The maximum number of cases in the buffer, necessary for reservoir and class_balanced
+            :param budget_mb: The maximum size of the cases in the buffer in MB, None does not limit the size
+            :param fraction: The fraction of every task that is selected in the fraction mode
+            :param seed: The seed of the selection
+        """
+        assert mode in REPLAY_MODES, "The replay mode {} is not supported, choose one of {}.".format(mode, REPLAY_MODES)
+        assert mode == 'fraction' or (budget is not None and budget > 0), "The {} mode needs a budget greater than 0.".format(mode)
+        self.mode = mode
+        self.budget = budget
+        self.budget_mb = budget_mb
+        self.fraction = fraction
+        self.seed = seed
+
+        # -- Cached dataset index of every task, ie. {task: {case: entry}}, and the selection as list of (task, case) -- #
+        self.task_cases = OrderedDict()
+        self.selection = list()
+        self.pinned = dict()
+        self._rng = random.Random(seed)
+        self._seen = 0
+        self._classes = dict()
+
+    def settings(self):
+        r"""This function returns the settings of the buffer, a stored buffer is only restored with the same settings.
+        """
+        return {'mode': self.mode, 'budget': self.budget, 'budget_mb': self.budget_mb, 'fraction': self.fraction, 'seed': self.seed}
+
+    def tasks(self):
+        r"""This function returns the tasks whose dataset index is in the buffer.
+        """
+        return list(self.task_cases.keys())
+
+    def add_task(self, task, cases):
+        r"""This function adds the cases of a task to the buffer and updates the selection.
+            :param task: The name of the task
+            :param cases: Dictionary of the training cases, ie. {case: entry} like self.dataset_tr of the trainer
+        """
+        assert task not in self.task_cases, "The task {} is already in the replay buffer.".format(task)
+        self.task_cases[task] = OrderedDict((case, dict(entry)) for case, entry in cases.items())
+        if self.mode == 'fraction':
+            # -- Sample the fraction of the task, the random state is kept between the tasks -- #
+            sample = self._rng.sample(list(cases.keys()), round(len(cases) * self.fraction))
+            self.selection.extend((task, case) for case in sample)
+        elif self.mode == 'reservoir':
+            # -- Stream the cases in a random order through the reservoir -- #
+            stream = list(cases.keys())
+            self._rng.shuffle(stream)
+            for case in stream:
+                self._seen += 1
+                if len(self.selection) < self.budget:
+                    self.selection.append((task, case))
+                else:
+                    idx = self._rng.randrange(self._seen)
+                    if idx < self.budget:
+                        self.selection[idx] = (task, case)
+        else:
+            self.selection = self._class_balanced_selection()
+        self._fit_memory()
+
+    def cases(self):
+        r"""This function returns the selected cases as dictionary {case: entry} that can be used by the data loaders.
+            The entries of pinned cases point to the cache folder.
+        """
+        cases = OrderedDict()
+        for task, case in self.selection:
+            entry = dict(self.task_cases[task][case])
+            if (task, case) in self.pinned:
+                entry['data_file'] = self.pinned[(task, case)][:-4] + '.npz'
+            cases[case] = entry
+        return cases
+
+    def size_mb(self):
+        r"""This function returns the size of the selected cases in MB.
+        """
+        return sum(self._case_mb(self.task_cases[task][case]) for task, case in self.selection)
+
+    def pin(self, folder):
+        r"""This function copies the selected cases as uncompressed numpy files into folder, so the data loaders can
+            memory-map them. Cases that are already pinned are not copied again and cases that are not selected anymore
+            are removed from the folder.
+            :param folder: The cache folder, eg. on a fast local disk
+        """
+        pinned = dict()
+        for task, case in self.selection:
+            target = join(folder, task, case + '.npy')
+            if not isfile(target):
+                maybe_mkdir_p(join(folder, task))
+                source = self.task_cases[task][case]['data_file']
+                # -- Write into a temporary file first, so an interrupted copy is not used -- #
+                if isfile(source[:-4] + '.npy'):
+                    shutil.copyfile(source[:-4] + '.npy', target + '.tmp')
+                else:
+                    with open(target + '.tmp', 'wb') as f:
+                        np.save(f, np.load(source)['data'])
+                os.replace(target + '.tmp', target)
+            pinned[(task, case)] = target
+        for task, case in set(self.pinned.keys()) - set(pinned.keys()):
+            if isfile(self.pinned[(task, case)]):
+                os.remove(self.pinned[(task, case)])
+        self.pinned = pinned
+
+    def save(self, fname):
+        r"""This function stores the buffer including the random state, so the selection continues identically after restoring.
+        """
+        save_pickle({'settings': self.settings(), 'task_cases': self.task_cases, 'selection': self.selection,
+                     'pinned': self.pinned, 'rng': self._rng.getstate(), 'seen': self._seen}, fname)
+
+    def restore(self, fname):
+        r"""This function restores a buffer stored with save if it has been built with the same settings.
+            :return: True if the buffer has been restored, False otherwise
+        """
+        state = load_pickle(fname)
+        if state['settings'] != self.settings():
+            return False
+        self.task_cases, self.selection, self.pinned, self._seen = state['task_cases'], state['selection'], state['pinned'], state['seen']
+        self._rng.setstate(state['rng'])
+        return True
+
+    def _class_balanced_selection(self):
+        r"""This function selects the cases round robin over the groups (task, class), where every case is in the group
+            of the rarest foreground class it contains. Cases without foreground form the group of class 0.
+        """
+        rng = random.Random(self.seed)
+        groups = OrderedDict()
+        for task, cases in self.task_cases.items():
+            classes = {case: self._case_classes(task, case, entry) for case, entry in cases.items()}
+            counts = dict()
+            for case_classes in classes.values():
+                for c in case_classes:
+                    counts[c] = counts.get(c, 0) + 1
+            for case, case_classes in classes.items():
+                rarest = min(case_classes, key=lambda c: (counts[c], c)) if len(case_classes) > 0 else 0
+                groups.setdefault((task, rarest), list()).append(case)
+        for members in groups.values():
+            rng.shuffle(members)
+
+        # -- Take one case of every group in turn until the budget is reached -- #
+        selection, depth = list(), 0
+        while len(selection) < self.budget and any(len(members) > depth for members in groups.values()):
+            for (task, _), members in groups.items():
+                if len(members) > depth and len(selection) < self.budget:
+                    selection.append((task, members[depth]))
+            depth += 1
+        return selection
+
+    def _case_classes(self, task, case, entry):
+        r"""This function returns the foreground classes of a case based on its properties, which are loaded only once.
+        """
+        if (task, case) not in self._classes:
+            properties = entry['properties'] if 'properties' in entry else load_pickle(entry['properties_file'])
+            self._classes[(task, case)] = [int(c) for c in properties.get('classes', list()) if c > 0]
+        return self._classes[(task, case)]
+
+    def _case_mb(self, entry):
+        r"""This function returns the size of the preprocessed file of a case in MB, preferably of the unpacked one.
+        """
+        fname = entry['data_file'][:-4] + '.npy' if isfile(entry['data_file'][:-4] + '.npy') else entry['data_file']
+        return os.path.getsize(fname) / 1024**2 if isfile(fname) else 0
+
+    def _fit_memory(self):
+        r"""This function removes cases until the memory budget is met. For the class balanced selection the last cases of
+            the round robin are removed, so the balance is kept, otherwise randomly selected ones.
+        """
+        if self.budget_mb is None:
+            return
+        size = self.size_mb()
+        while size > self.budget_mb and len(self.selection) > 0:
+            idx = len(self.selection) - 1 if self.mode == 'class_balanced' else self._rng.randrange(len(self.selection))
+            task, case = self.selection.pop(idx)
+            size -= self._case_mb(self.task_cases[task][case])
+
+class MixedDataLoader(SlimDataLoaderBase):
+    r"""This data loader combines the batches of two data loaders, eg. one for the cases of the current task and one for the
+        replayed cases, so every batch consists of a fixed number of cases of both.
+    """
+    def __init__(self, current_loader, replay_loader, number_of_threads_in_multithreaded=None):
+        r"""Constructor of the mixed data loader, the batch size is the sum of the batch sizes of both loaders.
+        """
+        super().__init__(None, current_loader.batch_size + replay_loader.batch_size, number_of_threads_in_multithreaded)
+        self.loaders = [current_loader, replay_loader]
+
+    def set_thread_id(self, thread_id):
+        r"""This function sets the thread id of both loaders as well.
+        """
+        super().set_thread_id(thread_id)
+        for loader in self.loaders:
+            loader.set_thread_id(thread_id)
+
+    def generate_train_batch(self):
+        r"""This function concatenates the batches of both loaders.
+        """
+        batches = [loader.generate_train_batch() for loader in self.loaders]
+        return {'data': np.concatenate([batch['data'] for batch in batches]),
+                'seg': np.concatenate([batch['seg'] for batch in batches]),
+                'properties': [p for batch in batches for p in batch['properties']],
+                'keys': np.concatenate([np.asarray(batch['keys']) for batch in batches])}
@@ -0,0 +1,117 @@
+##########################################################################################################
+#--------This module contains the seeded batches used to identify samples by their crop and augmentation.-#
+##########################################################################################################
+
+import random
+import numpy as np
+
+def sample_keys(name, case_keys, seed):
+    r"""This function builds the keys of the samples of a seeded batch. The crop and the augmentation of every sample
+        are determined by the seed of the batch and its position in the batch, so a key identifies the exact input.
+        :param name: The name of the data pipeline, eg. the task, so the same case of another pipeline has other keys
+        :param case_keys: List of case identifiers of the samples, eg. data_dict['keys']
+        :param seed: The seed the batch is drawn and augmented with
+        :return: List of keys, one per sample
+    """
+    return ['{}:{}:{}:{}'.format(name, key, seed, idx) for idx, key in enumerate(case_keys)]
+
+class SeededBatches():
+    r"""This class wraps a nnU-Net data loader, so every batch is one of nr_batches fixed batches. A batch is drawn with
+        the seeds first_seed, ..., first_seed + nr_batches - 1, ie. the cases and their crops are chosen with np.random
+        seeded with it, and the seed is added to the batch ('seed') along with the keys of its samples ('sample_keys').
+        Together with the SeededTransform the augmentation is seeded as well, so a batch can be created again at any
+        time, eg. to compute the outputs of a model for every batch ahead of time. The random state of the process is
+        restored afterwards, so the seeds of the batches are still drawn randomly.
+    """
+    def __init__(self, data_loader, nr_batches, name, first_seed=0):
+        r"""Constructor of the seeded batches.
+            :param data_loader: The nnU-Net data loader, eg. DataLoader3D
+            :param nr_batches: The number of different batches
+            :param name: The name of the data pipeline, see sample_keys
+            :param first_seed: The seed of the first batch
+        """
+        assert nr_batches > 0, "The number of seeded batches needs to be greater than 0."
+        self.data_loader = data_loader
+        self.nr_batches = nr_batches
+        self.name = name
+        self.first_seed = first_seed
+
+    def set_thread_id(self, thread_id):
+        self.data_loader.set_thread_id(thread_id)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.batch(self.first_seed + np.random.randint(self.nr_batches))
+
+    def seeds(self):
+        r"""This function returns the seeds of all batches.
+        """
+        return list(range(self.first_seed, self.first_seed + self.nr_batches))
+
+    def batch(self, seed):
+        r"""This function draws the batch of seed, without any augmentation.
+        """
+        rnd_state = np.random.get_state()
+        np.random.seed(seed)
+        try:
+            batch = next(self.data_loader)
+        finally:
+            np.random.set_state(rnd_state)
+        batch['seed'] = seed
+        batch['sample_keys'] = sample_keys(self.name, np.array(batch['keys']).tolist(), seed)
+        return batch
+
+class SeededTransform():
+    r"""This class wraps the transforms of an augmenter, so the augmentation of a batch from SeededBatches is performed
+        with np.random and random seeded with the seed of the batch, since the batchgenerators transforms use both.
+        Batches without a seed are augmented as usual.
+    """
+    def __init__(self, transform):
+        self.transform = transform
+
+    def __call__(self, **data_dict):
+        if self.transform is None:
+            return data_dict
+        if data_dict.get('seed', None) is None:
+            return self.transform(**data_dict)
+        rnd_state, py_state = np.random.get_state(), random.getstate()
+        # -- Use another seed than for the crop, the augmentation does not need to repeat the draws of the crop -- #
+        np.random.seed(data_dict['seed'] + 2**31)
+        random.seed(data_dict['seed'])
+        try:
+            return self.transform(**data_dict)
+        finally:
+            np.random.set_state(rnd_state)
+            random.setstate(py_state)
+
+def seed_batches(gen, nr_batches, name, first_seed=0):
+    r"""This function lets the (MultiThreaded)Augmenter gen draw its batches from nr_batches seeded batches, see SeededBatches.
+        It needs to be called before the worker processes of gen are started, ie. before it is used for the first time.
+        :param gen: The augmenter, eg. the tr_gen or val_gen of a trainer
+        :param nr_batches: The number of different batches
+        :param name: The name of the data pipeline, see sample_keys
+        :param first_seed: The seed of the first batch, the pipelines of a trainer should use seeds that do not overlap
+        :return: gen that now draws the seeded batches
+    """
+    attr = 'generator' if hasattr(gen, 'generator') else 'data_loader'
+    if not isinstance(getattr(gen, attr), SeededBatches):
+        setattr(gen, attr, SeededBatches(getattr(gen, attr), nr_batches, name, first_seed))
+        gen.transform = SeededTransform(gen.transform)
+    return gen
+
+def seeded_batch(gen, seed):
+    r"""This function creates the augmented batch of seed in this process, ie. the exact batch the worker processes of gen
+        return for this seed.
+        :param gen: The augmenter whose batches are seeded, see seed_batches
+        :param seed: The seed of the batch, one of seeded_batches(gen).seeds()
+        :return: The augmented batch
+    """
+    return gen.transform(**seeded_batches(gen).batch(seed))
+
+def seeded_batches(gen):
+    r"""This function returns the SeededBatches of the augmenter gen or None if its batches are not seeded.
+    """
+    batches = getattr(gen, 'generator', getattr(gen, 'data_loader', None))
+    return batches if isinstance(batches, SeededBatches) else None
@@ -0,0 +1,128 @@
+##########################################################################################################
+#--------This module contains the cache for the outputs of the old model used by distillation trainers.--#
+##########################################################################################################
+
+import os, shutil, torch
+import numpy as np
+from batchgenerators.utilities.file_and_folder_operations import *
+
+class TeacherCache():
+    r"""This class caches the outputs and captured intermediate features of the old (teacher) model per sample in a
+        memory-mapped file in half precision, so the forward pass of the old model is only necessary once per sample.
+        A sample is identified by its key from a seeded batch (see nnunet_ext/utilities/seeded_batches.py), which consists
+        of its case identifier and the seed that determines its crop and augmentation, so a sample is only reused if the
+        old model would get the exact same input.
+        The cache has a fixed number of slots and the oldest samples are replaced first once all slots are used.
+        The logits can optionally be stored as top-k values, the other classes are then set to the log-mean-exp of the
+        logits that are not stored, ie. the cached logits are an approximation that preserves the softmax probabilities
+        of the top-k classes. Features can be pooled using the FeatureCapture.
+    """
+    def __init__(self, folder, capacity, topk=None):
+        r"""Constructor of the teacher cache.
+            :param folder: The folder in which the memory-mapped file is stored, it is removed again with reset
+            :param capacity: The maximum number of samples that are stored
+            :param topk: Optional number of logits per voxel that are stored, None stores all logits
+        """
+        assert capacity > 0, "The capacity of the teacher cache needs to be greater than 0."
+        self.folder = folder
+        self.capacity = capacity
+        self.topk = topk
+        self.hits, self.misses = 0, 0
+        self._layout, self._data = None, None
+        self._index, self._slots, self._next = dict(), [None] * capacity, 0
+
+    def load(self, keys, device=None):
+        r"""This function loads the cached outputs and features of a batch.
+            :param keys: The keys of the samples, ie. the 'sample_keys' of a seeded batch
+            :param device: The device the tensors should be put on
+            :return: Tuple (outputs, features) as they have been stored, or None if a sample is not in the cache
+        """
+        if self._layout is None or any(key not in self._index for key in keys):
+            self.misses += 1
+            return None
+        self.hits += 1
+        rows = self._data[[self._index[key] for key in keys]]
+        values = dict()
+        for name, (offset, dtype, shape, torch_dtype) in self._layout['entries'].items():
+            nbytes = int(np.prod(shape, dtype=np.int64)) * np.dtype(dtype).itemsize
+            array = np.ascontiguousarray(rows[:, offset:offset+nbytes]).view(dtype).reshape(len(keys), *shape)
+            values[name] = torch.from_numpy(array).to(device)
+        outputs = list()
+        for idx in range(self._layout['nr_outputs']):
+            if self.topk is None:
+                output = values['output_%d' % idx]
+            else:
+                # -- Set all classes that are not stored to the log-mean-exp of the logits that are not stored -- #
+                top_values, top_indices = values['output_%d_values' % idx], values['output_%d_indices' % idx].long()
+                output = values['output_%d_rest' % idx].to(top_values.dtype).expand(-1, self._layout['classes'][idx], *top_values.shape[2:]).clone()
+                output.scatter_(1, top_indices, top_values)
+            outputs.append(output.to(self._layout['dtypes'][idx]))
+        features = {name[len('feature:'):]: value.to(self._layout['entries'][name][3]) for name, value in values.items() if name.startswith('feature:')}
+        return (outputs if self._layout['is_list'] else outputs[0]), features
+
+    def store(self, keys, outputs, features=dict()):
+        r"""This function stores the outputs and features of a batch, the oldest samples are replaced if the cache is full.
+            :param keys: The keys of the samples, ie. the 'sample_keys' of a seeded batch
+            :param outputs: The output of the old model, ie. a tensor or a list/tuple of tensors (deep supervision)
+            :param features: Dictionary of captured intermediate features of the old model, eg. FeatureCapture.results
+        """
+        is_list = isinstance(outputs, (tuple, list))
+        outputs = list(outputs) if is_list else [outputs]
+        values = dict()
+        for idx, output in enumerate(outputs):
+            output = output.detach()
+            if self.topk is None or self.topk >= output.size(1):
+                values['output_%d' % idx] = output
+            else:
+                top_values, top_indices = output.topk(self.topk, dim=1)
+                # -- Store the log-mean-exp of the other logits, so the softmax probabilities of the top-k classes are preserved -- #
+                lse, top_lse = torch.logsumexp(output.float(), 1, keepdim=True), torch.logsumexp(top_values.float(), 1, keepdim=True)
+                rest = lse + torch.log1p(-torch.exp(top_lse - lse).clamp(max=1-1e-6)) - np.log(output.size(1) - self.topk)
+                values['output_%d_values' % idx] = top_values
+                values['output_%d_rest' % idx] = torch.minimum(rest, top_values.float().min(1, keepdim=True)[0])
+                values['output_%d_indices' % idx] = top_indices.to(torch.uint8 if output.size(1) <= 256 else torch.int16)
+        values.update({'feature:' + name: feature.detach() for name, feature in features.items()})
+        # -- Store floating point values in half precision -- #
+        arrays = {name: (value.half() if value.is_floating_point() else value).cpu().numpy() for name, value in values.items()}
+        if self._layout is None:
+            self._build(arrays, values, outputs, is_list)
+        # -- The layout of the samples does not fit, eg. for the last batch with another shape, so simply do not cache it -- #
+        if any(name not in self._layout['entries'] or arrays[name].shape[1:] != tuple(self._layout['entries'][name][2]) for name in arrays)\
+        or len(arrays) != len(self._layout['entries']):
+            return
+        for sample, key in enumerate(keys):
+            if key in self._index:
+                continue
+            # -- Replace the oldest sample if the cache is full -- #
+            slot = self._next
+            if self._slots[slot] is not None:
+                del self._index[self._slots[slot]]
+            self._next = (self._next + 1) % self.capacity
+            for name, array in arrays.items():
+                offset, dtype = self._layout['entries'][name][:2]
+                data = np.ascontiguousarray(array[sample]).view(np.uint8).reshape(-1)
+                self._data[slot, offset:offset+data.size] = data
+            self._index[key], self._slots[slot] = slot, key
+
+    def reset(self):
+        r"""This function removes all cached samples along with the memory-mapped file, eg. when the old model changed.
+        """
+        self._data = None
+        self._layout = None
+        self._index, self._slots, self._next = dict(), [None] * self.capacity, 0
+        self.hits, self.misses = 0, 0
+        if isdir(self.folder):
+            shutil.rmtree(self.folder, ignore_errors=True)
+
+    def _build(self, arrays, values, outputs, is_list):
+        r"""This function builds the layout of one sample and creates the memory-mapped file for all slots.
+        """
+        entries, offset = dict(), 0
+        for name, array in arrays.items():
+            offset += (-offset) % 8   # --> Align every entry
+            entries[name] = (offset, array.dtype.str, list(array.shape[1:]), values[name].dtype)
+            offset += array[0].nbytes
+        self._layout = {'entries': entries, 'nr_outputs': len(outputs), 'is_list': is_list,
+                        'classes': [output.size(1) for output in outputs], 'dtypes': [output.dtype for output in outputs]}
+        maybe_mkdir_p(self.folder)
+        self._data = np.memmap(join(self.folder, 'teacher_cache_%d.bin' % os.getpid()), dtype=np.uint8, mode='w+', shape=(self.capacity, offset))
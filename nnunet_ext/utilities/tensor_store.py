@@ -0,0 +1,205 @@
+##########################################################################################################
+#------This module contains the memory-mapped tensor store for the Fisher, param and score values.-------#
+##########################################################################################################
+
+import os, re, hashlib, torch
+import numpy as np
+from collections.abc import MutableMapping
+from batchgenerators.utilities.file_and_folder_operations import *
+
+# -- Define the name of the index file and the alignment of every tensor in a task file -- #
+INDEX_FILE = 'index.json'
+ALIGNMENT = 64
+
+# -- Define the device the stored values are loaded onto by the trainers -- #
+STORE_DEVICE = 'cuda:0' if torch.cuda.is_available() else None
+
+class TensorStore():
+    r"""This class stores nested dictionaries of the form {task: {name: tensor}}, eg. the Fisher values, in a folder.
+        Every task is stored in its own binary file that is memory-mapped when loading, and a small JSON index
+        keeps track of the files along with the dtype, shape and offset of every tensor. Tasks can be loaded lazily
+        one at a time, and writing a task only rewrites the file of this task, which is done atomically, ie. the data
+        is first written into a temporary file that replaces the old one only when it is complete.
+    """
+    def __init__(self, folder, fp16=False):
+        r"""Constructor of the tensor store.
+            :param folder: The folder in which the index and the task files are stored
+            :param fp16: Set this flag if floating point tensors should be stored in half precision to save space.
+                         They are converted back to their original dtype when loading.
+        """
+        self.folder = folder
+        self.fp16 = fp16
+        self.index = load_json(join(folder, INDEX_FILE)) if isfile(join(folder, INDEX_FILE)) else {'tasks': dict()}
+
+    @staticmethod
+    def exists(folder):
+        r"""This function returns if a tensor store exists in the provided folder.
+        """
+        return isfile(join(folder, INDEX_FILE))
+
+    def tasks(self):
+        r"""This function returns the list of stored tasks in the order they have been added.
+        """
+        return list(self.index['tasks'].keys())
+
+    def load_task(self, task, device=None):
+        r"""This function loads the tensors of a single task.
+            :param task: The task that should be loaded
+            :param device: The device the tensors should be put on, None keeps them on CPU
+            :return: Dictionary of the form {name: tensor}
+        """
+        assert task in self.index['tasks'], "The task \'{}\' is not in the tensor store at {}.".format(task, self.folder)
+        entry = self.index['tasks'][task]
+        values = dict()
+        if len(entry['tensors']) == 0:
+            return values
+        data = np.memmap(join(self.folder, entry['file']), dtype=np.uint8, mode='r')
+        for name, info in entry['tensors'].items():
+            dtype = np.dtype(info['dtype'])
+            count = int(np.prod(info['shape'], dtype=np.int64))
+            array = np.frombuffer(data, dtype=dtype, count=count, offset=info['offset']).reshape(info['shape'])
+            # -- Copy the data, so the file is not referenced anymore and can be replaced -- #
+            tensor = torch.from_numpy(array.copy()).to(getattr(torch, info['torch_dtype']))
+            values[name] = tensor.to(device) if device is not None else tensor
+        del data
+        return values
+
+    def save_task(self, task, values):
+        r"""This function (over-)writes the tensors of a single task atomically and updates the index.
+            :param task: The task that should be stored
+            :param values: Dictionary of the form {name: tensor}
+        """
+        maybe_mkdir_p(self.folder)
+        old = self.index['tasks'].get(task, None)
+        generation = old['generation'] + 1 if old is not None else 0
+        file_name = '{}.{}.bin'.format(self._file_prefix(task), generation)
+
+        # -- Write the tensors into a temporary file -- #
+        tensors, offset = dict(), 0
+        with open(join(self.folder, file_name + '.tmp'), 'wb') as f:
+            for name, tensor in values.items():
+                tensor = tensor.detach()
+                torch_dtype = str(tensor.dtype).split('.')[-1]
+                if tensor.is_floating_point():
+                    tensor = tensor.to(torch.float16 if self.fp16 else (torch.float32 if tensor.dtype == torch.bfloat16 else tensor.dtype))
+                array = np.ascontiguousarray(tensor.cpu().numpy())
+                # -- Align every tensor, so the memory-mapped views are aligned as well -- #
+                padding = (-offset) % ALIGNMENT
+                f.write(b'\0' * padding)
+                offset += padding
+                f.write(array.tobytes())
+                tensors[name] = {'dtype': array.dtype.str, 'torch_dtype': torch_dtype, 'shape': list(array.shape), 'offset': offset}
+                offset += array.nbytes
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(join(self.folder, file_name + '.tmp'), join(self.folder, file_name))
+
+        # -- Update the index and remove the old file only after the index points to the new one -- #
+        self.index['tasks'][task] = {'file': file_name, 'generation': generation, 'tensors': tensors}
+        self._write_index()
+        if old is not None and old['file'] != file_name and isfile(join(self.folder, old['file'])):
+            os.remove(join(self.folder, old['file']))
+
+    def remove_task(self, task):
+        r"""This function removes a task from the store.
+        """
+        old = self.index['tasks'].pop(task, None)
+        if old is None:
+            return
+        self._write_index()
+        if isfile(join(self.folder, old['file'])):
+            os.remove(join(self.folder, old['file']))
+
+    def save(self, values, tasks=None):
+        r"""This function writes the provided tasks of values into the store. Tasks that are not in values anymore
+            are removed from the store, all other tasks are not touched.
+            :param values: Dictionary of the form {task: {name: tensor}}, eg. a LazyTensorDict of this store
+            :param tasks: List of tasks that changed and should be written, None writes every task in values
+        """
+        tasks = list(values.keys()) if tasks is None else tasks
+        for task in [t for t in self.tasks() if t not in values.keys()]:
+            self.remove_task(task)
+        for task in tasks:
+            if task in values:
+                self.save_task(task, values[task])
+            else:
+                self.remove_task(task)
+        # -- Keep the order of the tasks in the index the same as in values -- #
+        order = [t for t in values.keys() if t in self.index['tasks']]
+        if order != self.tasks():
+            self.index['tasks'] = {t: self.index['tasks'][t] for t in order}
+            self._write_index()
+
+    def as_dict(self, device=None):
+        r"""This function returns a dictionary like object of the stored tasks that loads the tasks lazily.
+            :param device: The device the tensors should be put on when a task is loaded
+        """
+        return LazyTensorDict(self, device)
+
+    def _write_index(self):
+        r"""This function writes the index atomically.
+        """
+        save_json(self.index, join(self.folder, INDEX_FILE + '.tmp'))
+        os.replace(join(self.folder, INDEX_FILE + '.tmp'), join(self.folder, INDEX_FILE))
+
+    def _file_prefix(self, task):
+        r"""This function returns a file name prefix for the task that is safe to use on every file system.
+        """
+        if re.fullmatch(r'[A-Za-z0-9_\-]+', task):
+            return task
+        return hashlib.md5(task.encode()).hexdigest()
+
+class LazyTensorDict(MutableMapping):
+    r"""This class behaves like the dictionary {task: {name: tensor}} of a TensorStore, but a task is only loaded
+        from the store when it is accessed for the first time. Tasks that are set or deleted only change the
+        dictionary, use TensorStore.save to write them.
+    """
+    def __init__(self, store, device=None):
+        self.store = store
+        self.device = device
+        self._keys = store.tasks()
+        self._loaded = dict()
+
+    def __getitem__(self, task):
+        if task not in self._loaded:
+            if task not in self._keys:
+                raise KeyError(task)
+            self._loaded[task] = self.store.load_task(task, self.device)
+        return self._loaded[task]
+
+    def __setitem__(self, task, value):
+        if task not in self._keys:
+            self._keys.append(task)
+        self._loaded[task] = value
+
+    def __delitem__(self, task):
+        if task not in self._keys:
+            raise KeyError(task)
+        self._keys.remove(task)
+        self._loaded.pop(task, None)
+
+    def __iter__(self):
+        return iter(list(self._keys))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, task):
+        return task in self._keys
+
+    def __repr__(self):
+        return 'LazyTensorDict({}, loaded: {})'.format(self._keys, list(self._loaded.keys()))
+
+def load_tensor_values(path, device=None):
+    r"""This function loads the values stored at path, either lazily from a TensorStore folder or from a pickle
+        file as they have been stored before the TensorStore was introduced.
+        :param path: Path to a TensorStore folder or a pickle file
+        :param device: The device the tensors should be put on
+        :return: Dictionary like object of the form {task: {name: tensor}}
+    """
+    if TensorStore.exists(path):
+        return TensorStore(path).as_dict(device)
+    values = load_pickle(path)
+    if device is not None:
+        values = {task: {name: v.to(device) for name, v in vals.items()} for task, vals in values.items()}
+    return values
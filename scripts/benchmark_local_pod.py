@@ -0,0 +1,62 @@
+import os, sys, time, torch
+
+# -- Make nnunet_ext importable when the script is run from the repository root without installing it -- #
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nnunet_ext.training.loss_functions.embeddings import local_POD, pod_embed
+
+def looped_local_POD(h_, h_old, scales):
+    r"""The local POD distance calculated by looping over every window at every scale, ie. the implementation
+        before local_POD was vectorized. It is only used as the baseline of this benchmark.
+    """
+    POD_, POD_old = None, None
+    W, H = h_.size(-1), h_.size(-2)
+    for scale in range(0, scales, 1):
+        w, h = int(W/(2**scale)), int(H/(2**scale))
+        for i in range(0, W-w, w):
+            for j in range(0, H-h, h):
+                pod_, pod_old = pod_embed(h_[..., i:i+w, j:j+h]), pod_embed(h_old[..., i:i+w, j:j+h])
+                POD_ = pod_ if POD_ is None else torch.cat((POD_, pod_), dim=2)
+                POD_old = pod_old if POD_old is None else torch.cat((POD_old, pod_old), dim=2)
+    layer_loss = torch.stack([torch.linalg.norm(p_ - p_o, dim=-1) for p_, p_o in zip(POD_, POD_old)])
+    return torch.mean(layer_loss)
+
+def benchmark_local_pod(pod_fn, shape, scales=3, nr_iterations=20, device='cpu'):
+    r"""This function measures the average time of the forward and backward pass of a local POD function.
+        :param pod_fn: The local POD function that is timed, ie. local_POD or looped_local_POD
+        :param shape: The shape of the feature maps, eg. (B, C, H, W) for 2D
+        :param scales: The number of scales of the local POD
+        :param nr_iterations: Number of iterations that are timed
+        :param device: The device on which the benchmark is performed, e.g. 'cpu' or 'cuda:0'
+        :return: The average time per iteration in seconds and the last loss
+    """
+    h_old = torch.randn(shape, device=device)
+    h_ = (h_old + 0.1 * torch.randn(shape, device=device)).requires_grad_()
+
+    # -- Run the iterations and measure the time for each -- #
+    times = list()
+    for i in range(nr_iterations + 1):
+        start = time.time()
+        loss = pod_fn(h_, h_old, scales)
+        loss.backward()
+        if 'cuda' in str(device):
+            torch.cuda.synchronize()
+        if i > 0:   # --> First iteration is only a warm-up
+            times.append(time.time() - start)
+
+    # -- Return the average time -- #
+    return sum(times) / len(times), loss.item()
+
+if __name__ == '__main__':
+    for shape, scales in [((8, 32, 64, 64), 3), ((8, 64, 32, 32), 4), ((8, 128, 16, 16), 3), ((2, 32, 16, 32, 32), 2),
+                          ((2, 32, 32, 64, 64), 3), ((2, 16, 48, 96, 96), 4)]:
+        after, loss_after = benchmark_local_pod(local_POD, shape, scales)
+        # -- NOTE: The looped implementation can not concatenate the 3D embeddings of more than one window, -- #
+        # --       ie. it only runs in 3D with at most two scales where only a single window exists -- #
+        if len(shape) == 5 and scales > 2:
+            print('Shape {} with {} scales: {:.2f} ms per iteration vectorized, not supported by the looped implementation, loss {:.6f}.'\
+                  .format(shape, scales, after * 1000, loss_after))
+            continue
+        before, loss_before = benchmark_local_pod(looped_local_POD, shape, scales)
+        print('Shape {} with {} scales: {:.2f} ms per iteration before, {:.2f} ms per iteration vectorized ({:.2f}x), loss {:.6f} vs. {:.6f}.'\
+              .format(shape, scales, before * 1000, after * 1000, before / after, loss_before, loss_after))
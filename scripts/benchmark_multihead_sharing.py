@@ -0,0 +1,56 @@
+import os, sys, time, torch
+
+# -- Make nnunet_ext importable when the script is run from the repository root without installing it -- #
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nnunet_ext.network_architecture.MultiHead_Module import MultiHead_Module
+from nnunet.network_architecture.generic_UNet import Generic_UNet
+
+def benchmark_multihead_sharing(split, nr_iterations=20, share_parameters=False, device='cpu', **net_args):
+    r"""This function measures the average time of a training iteration (forward, backward, optimizer step and
+        update_after_iteration) of a MultiHead_Module with or without shared parameters, along with the average
+        time that is spent in update_after_iteration alone.
+        :param split: The split path that is used to build the Multi Head Network
+        :param nr_iterations: Number of iterations that are timed
+        :param share_parameters: Specify if the body and active head should share the parameters with the running model
+        :param device: The device on which the benchmark is performed, e.g. 'cpu' or 'cuda:0'
+        :param net_args: Keyword arguments to initialize the (2D) Generic_UNet (input_channels, base_num_features, etc.)
+        :return: The average time per iteration and the average time of update_after_iteration in seconds
+    """
+    # -- Build the network and optimizer -- #
+    mh_network = MultiHead_Module(Generic_UNet, split, 'task_A', prev_trainer=None, share_parameters=share_parameters, **net_args)
+    mh_network.to(device)
+    optimizer = torch.optim.SGD(mh_network.model.parameters(), lr=1e-3, momentum=0.99, nesterov=True)
+    data = torch.rand((2, net_args['input_channels'], 256, 256), device=device)
+
+    # -- Run the iterations and measure the time for each -- #
+    times, update_times = list(), list()
+    for i in range(nr_iterations + 1):
+        start = time.time()
+        optimizer.zero_grad()
+        output = mh_network(data)
+        loss = output[0].mean() if isinstance(output, (tuple, list)) else output.mean()
+        loss.backward()
+        optimizer.step()
+        if 'cuda' in str(device):
+            torch.cuda.synchronize()
+        update_start = time.time()
+        mh_network.update_after_iteration()
+        if 'cuda' in str(device):
+            torch.cuda.synchronize()
+        if i > 0:   # --> First iteration is only a warm-up
+            times.append(time.time() - start)
+            update_times.append(time.time() - update_start)
+
+    # -- Return the average times -- #
+    return sum(times) / len(times), sum(update_times) / len(update_times)
+
+if __name__ == '__main__':
+    device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+    net_args = {'input_channels': 1, 'base_num_features': 32, 'num_classes': 3, 'num_pool': 5, 'deep_supervision': True}
+    for split in ['seg_outputs', 'conv_blocks_localization.2', 'conv_blocks_context.3']:
+        before, update_before = benchmark_multihead_sharing(split, share_parameters=False, device=device, **net_args)
+        after, update_after = benchmark_multihead_sharing(split, share_parameters=True, device=device, **net_args)
+        print('Split \'{}\': {:.2f} ms per iteration before ({:.2f} ms in update_after_iteration), {:.2f} ms per iteration '\
+              'with shared parameters ({:.2f} ms in update_after_iteration).'.format(split, before * 1000, update_before * 1000,
+                                                                                      after * 1000, update_after * 1000))
@@ -0,0 +1,50 @@
+import time, torch
+from torch import nn
+from nnunet_ext.network_architecture.vision_transformer import Block
+from nnunet_ext.network_architecture.generic_ViT_UNet import VIT_TYPES
+
+def benchmark_vit_attention(vit_type, attn_backend, is_LSA=False, nr_tokens=257, batch_size=2, nr_iterations=10, device='cpu'):
+    r"""This function measures the average time and the peak memory of a forward and backward pass through the
+        transformer blocks of a ViT type using the specified attention backend.
+        :param vit_type: The ViT type, one of 'base', 'large' or 'huge'
+        :param attn_backend: The attention backend, one of 'sdpa' or 'manual'
+        :param is_LSA: Specify if the blocks use Locality Self-Attention
+        :param nr_tokens: Number of tokens including the class token, ie. number of patches + 1
+        :param batch_size: The batch size of the input
+        :param nr_iterations: Number of iterations that are timed
+        :param device: The device on which the benchmark is performed, e.g. 'cpu' or 'cuda:0'
+        :return: The average time per iteration in seconds and the peak memory in MB (None on the CPU)
+    """
+    # -- Build the blocks with the same weights for every backend -- #
+    torch.manual_seed(0)
+    config = VIT_TYPES[vit_type]
+    blocks = nn.Sequential(*[Block(config['embed_size'], config['head'], qkv_bias=True, is_LSA=is_LSA, num_patches=nr_tokens-1,
+                                   attn_backend=attn_backend) for _ in range(config['layers'])]).to(device)
+    data = torch.rand((batch_size, nr_tokens, config['embed_size']), device=device, requires_grad=True)
+
+    # -- Run the iterations and measure the time for each -- #
+    times = list()
+    if 'cuda' in str(device):
+        torch.cuda.reset_peak_memory_stats(device)
+    for i in range(nr_iterations + 1):
+        start = time.time()
+        blocks(data).mean().backward()
+        if 'cuda' in str(device):
+            torch.cuda.synchronize()
+        if i > 0:   # --> First iteration is only a warm-up
+            times.append(time.time() - start)
+    memory = torch.cuda.max_memory_allocated(device) / 1024**2 if 'cuda' in str(device) else None
+
+    # -- Return the average time and the memory -- #
+    return sum(times) / len(times), memory
+
+if __name__ == '__main__':
+    device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+    nr_tokens = 1025 if 'cuda' in device else 257   # --> 32*32 or 16*16 patches
+    for vit_type in ['base', 'large', 'huge']:
+        for is_LSA in [False, True]:
+            results = {backend: benchmark_vit_attention(vit_type, backend, is_LSA, nr_tokens, device=device) for backend in ['manual', 'sdpa']}
+            (before, mem_before), (after, mem_after) = results['manual'], results['sdpa']
+            memory = ', {:.0f} MB before, {:.0f} MB with sdpa'.format(mem_before, mem_after) if mem_before is not None else ''
+            print('ViT \'{}\'{}: {:.2f} ms per iteration before, {:.2f} ms per iteration with sdpa ({:.2f}x){}.'\
+                  .format(vit_type, ' (LSA)' if is_LSA else '', before * 1000, after * 1000, before / after, memory))
@@ -2,6 +2,7 @@
 # -- Test suite to test the MultiHead Network provided with this extension of the nnUNet -- #
 #############################################################################################
 
+import torch
 import numpy as np
 from torch import nn
 import os, sys, copy
@@ -270,12 +271,149 @@ def test_multihead_network():
             assert False, "When providing a prev_trainer, it is expected to throw an error if the trainer is empty."
     
 
+def test_multihead_network_shared_parameters():
+    r"""This function is used to test the Multi Head Network Module when the body and the active head share the
+        parameters with the running model."""
+    for split in ['conv_blocks_context.2', 'conv_blocks_localization.2.0.blocks.0.instnorm']:
+        # -- Reload the Multi Head module, otherwise there will be mixups during runtime and wrong results will be produced -- #
+        refresh_imports(MultiHead_Module, reload=True)
+        mh_network = MultiHead_Module.MultiHead_Module(Generic_UNet, split, 'test', prev_trainer=None, share_parameters=True,
+                                                       input_channels=3, base_num_features=5, num_classes=2, num_pool=3)
+        mh_network.add_new_task('new_test', use_init=True)
+
+        # -- Check that body and active head use the same storage as the running model -- #
+        model_params = {name: param.data_ptr() for name, param in mh_network.model.named_parameters()}
+        for part in [mh_network.body, mh_network.heads['test']]:
+            for name, param in part.named_parameters():
+                assert model_params[name] == param.data_ptr(), "The parameter \'{}\' is not shared with the running model.".format(name)
+
+        # -- Perform an optimizer step and check that the body and head are updated without splitting -- #
+        optimizer = torch.optim.SGD(mh_network.model.parameters(), lr=1.0)
+        optimizer.zero_grad()
+        mh_network(torch.rand((2, 3, 32, 32)))[0].sum().backward()
+        optimizer.step()
+        mh_network.update_after_iteration()
+        for part in [mh_network.body, mh_network.heads['test']]:
+            for name, param in part.state_dict().items():
+                assert torch.equal(param, mh_network.model.state_dict()[name]), "The state_dicts with key \'{}\' are not identical.".format(name)
+
+        # -- Switch the head and check that the trained head is kept while the new one is not trained -- #
+        trained_head = copy.deepcopy(mh_network.heads['test'].state_dict())
+        mh_network.assemble_model('new_test')
+        for name, param in mh_network.heads['new_test'].state_dict().items():
+            assert torch.equal(param, mh_network.model.state_dict()[name]), "The state_dicts with key \'{}\' are not identical.".format(name)
+        for name, param in mh_network.heads['test'].state_dict().items():
+            assert torch.equal(param, trained_head[name]), "Switching the head changed the state_dict of the old head with key \'{}\'.".format(name)
+            assert mh_network.heads['test'].state_dict()[name].data_ptr() != mh_network.model.state_dict()[name].data_ptr(),\
+                "The inactive head should not share the parameters with the running model."
+
+        # -- Switch back and check that the trained head is loaded again -- #
+        mh_network.assemble_model('test')
+        for name, param in trained_head.items():
+            assert torch.equal(param, mh_network.model.state_dict()[name]), "The trained head has not been restored for key \'{}\'.".format(name)
+
+def test_multihead_network_cache():
+    r"""This function is used to test the cache of assembled task views of the Multi Head Network Module, ie. that
+        cached views are identical to assembled ones and that they are invalidated once body or head change."""
+    # -- Reload the Multi Head module, otherwise there will be mixups during runtime and wrong results will be produced -- #
+    refresh_imports(MultiHead_Module, reload=True)
+    mh_network = MultiHead_Module.MultiHead_Module(Generic_UNet, 'seg_outputs', 'test', prev_trainer=None, cache_budget_mb=100,
+                                                   input_channels=3, base_num_features=5, num_classes=2, num_pool=3)
+    mh_network.add_new_task('new_test', use_init=True)
+
+    # -- Assemble both tasks once to fill the cache and store the assembled states -- #
+    states = dict()
+    for task in ['new_test', 'test']:
+        mh_network.assemble_model(task)
+        states[task] = copy.deepcopy(mh_network.model.state_dict())
+    hits = mh_network.cache_hits
+
+    # -- Switching back has to use the cache and produce the identical model -- #
+    for task in ['new_test', 'test']:
+        mh_network.assemble_model(task)
+        for name, param in states[task].items():
+            assert torch.equal(param, mh_network.model.state_dict()[name]), "The cached view with key \'{}\' is not identical.".format(name)
+    assert mh_network.cache_hits == hits + 2, "The cached views have not been used."
+
+    # -- Change the body and check that the cached views are not used anymore -- #
+    with torch.no_grad():
+        for param in mh_network.model.parameters():
+            param.add_(1)
+    mh_network.update_after_iteration()
+    misses = mh_network.cache_misses
+    mh_network.assemble_model('new_test')
+    assert mh_network.cache_misses == misses + 1, "An outdated view has been loaded after the body changed."
+    for name, param in mh_network.body.state_dict().items():
+        assert torch.equal(param, mh_network.model.state_dict()[name]), "The updated body with key \'{}\' has not been assembled.".format(name)
+
+    # -- A budget that is too small disables the caching -- #
+    mh_network.set_cache_budget(1e-6)
+    assert len(mh_network.get_cache_info()['views']) == 0, "The cache should be empty if the budget is too small."
+    
+def test_multihead_network_forward_all_heads():
+    r"""This function is used to test that forward_all_heads produces the same outputs as assembling and running
+        the model for every head separately."""
+    for split in ['seg_outputs', 'tu', 'conv_blocks_localization.1', 'conv_blocks_context.2']:
+        # -- Reload the Multi Head module, otherwise there will be mixups during runtime and wrong results will be produced -- #
+        refresh_imports(MultiHead_Module, reload=True)
+        mh_network = MultiHead_Module.MultiHead_Module(Generic_UNet, split, 'test', prev_trainer=None,
+                                                       input_channels=3, base_num_features=5, num_classes=2, num_pool=3)
+        mh_network.add_new_task('new_test', use_init=True)
+        # -- Change the new head so the outputs differ between the heads -- #
+        with torch.no_grad():
+            for param in mh_network.heads['new_test'].parameters():
+                param.add_(0.1)
+        mh_network.assemble_model('test')
+        mh_network.model.eval()
+
+        # -- Compute the expected outputs by running the model for every head separately -- #
+        x = torch.rand((2, 3, 32, 32))
+        expected = dict()
+        with torch.no_grad():
+            for task in ['test', 'new_test']:
+                mh_network.assemble_model(task)
+                expected[task] = mh_network(x)
+            mh_network.assemble_model('test')
+            # -- The first call checks once if the heads can be fanned out for the split using a forward pass -- #
+            mh_network.forward_all_heads(x)
+            # -- Count the calls of the first encoder block, which is part of the body for the first two splits -- #
+            calls = list()
+            handle = mh_network.model.conv_blocks_context[0].register_forward_hook(lambda *args: calls.append(1))
+            outputs = mh_network.forward_all_heads(x)
+            handle.remove()
+
+        # -- Check that the outputs are identical and the previous task is active again -- #
+        assert list(outputs.keys()) == ['test', 'new_test'], "Not every head has been used."
+        for task in ['test', 'new_test']:
+            for out, exp in zip(outputs[task], expected[task]):
+                assert torch.equal(out, exp), "The output of head \'{}\' differs from the one of the assembled model.".format(task)
+        assert mh_network.active_task == 'test', "The previously active task has been changed."
+        assert all(len(module._forward_hooks) + len(module._forward_pre_hooks) == 0 for module in mh_network.model.modules()),\
+            "The hooks of forward_all_heads have not been removed."
+        if split in ['seg_outputs', 'tu']:
+            assert len(calls) == 1, "The body should only be computed once but it has been computed {} times.".format(len(calls))
+        assert not torch.equal(outputs['test'][0], outputs['new_test'][0]), "The heads should produce different outputs."
+
+        # -- Errors that are not caused by the fan out, eg. a wrong number of channels, are raised -- #
+        mh_network._fan_out_heads = None
+        try:
+            with torch.no_grad():
+                mh_network.forward_all_heads(torch.rand((2, 4, 32, 32)))
+            raised = False
+        except RuntimeError:
+            raised = True
+        assert raised and mh_network._fan_out_heads is None, "An error that is not caused by the fan out should be raised."
+
+
 if __name__ == "__main__":
     # -- Block all prints that are done during testing which are no errors but done in calling functions -- #
     sys.stdout = open(os.devnull, 'w')
 
     # -- Run the test suite -- #
     test_multihead_network()
+    test_multihead_network_shared_parameters()
+    test_multihead_network_cache()
+    test_multihead_network_forward_all_heads()
 
 
 """ GenericUNet using input_channels=3, base_num_features=5, num_classes=2, num_pool=3:
@@ -0,0 +1,48 @@
+#########################################################################################################
+#-----------This class represents the PyTests for the shape planning of the Generic_ViT_UNet.-----------#
+#########################################################################################################
+
+import torch
+from torch import nn
+from nnunet.network_architecture.generic_UNet import Generic_UNet
+from nnunet_ext.network_architecture.generic_ViT_UNet import plan_shapes
+
+def _dummy_forward(network, input_channels, patch_size):
+    r"""The sizes of the skip connections, the bottleneck and the decoder outputs determined by a forward pass of a
+        random sample, ie. the way the Generic_ViT_UNet determined them before the shapes were planned analytically."""
+    skip_sizes, out_sizes, skips = list(), list(), list()
+    with torch.no_grad():
+        x = torch.rand(1, input_channels, *patch_size)
+        for d in range(len(network.conv_blocks_context) - 1):
+            x = network.conv_blocks_context[d](x)
+            skip_sizes.append(x.size())
+            skips.append(x)
+            if not network.convolutional_pooling:
+                x = network.td[d](x)
+        x = network.conv_blocks_context[-1](x)
+        bottleneck_size = x.size()
+        for u in range(len(network.tu)):
+            x = network.conv_blocks_localization[u](torch.cat((network.tu[u](x), skips[-(u + 1)]), dim=1))
+            out_sizes.append(x.size())
+    return skip_sizes, bottleneck_size, out_sizes
+
+def test_generic_ViT_UNet_shapes():
+    r"""This function is used to test that the analytically planned shapes are identical to the ones of a forward pass
+        for 2D and 3D networks with anisotropic pooling, mixed kernel sizes and convolutional pooling or upsampling.
+    """
+    configs = [([64, 48], 4, {'conv_op': nn.Conv2d}),
+               ([64, 48], 3, {'conv_op': nn.Conv2d, 'pool_op_kernel_sizes': [[2, 2], [2, 1], [2, 2]],
+                              'conv_kernel_sizes': [[3, 3], [3, 1], [3, 3], [1, 3]], 'convolutional_pooling': True,
+                              'convolutional_upsampling': True}),
+               ([16, 32, 24], 3, {'conv_op': nn.Conv3d, 'norm_op': nn.InstanceNorm3d, 'dropout_op': nn.Dropout3d,
+                                  'pool_op_kernel_sizes': [[1, 2, 2], [2, 2, 2], [2, 2, 2]],
+                                  'conv_kernel_sizes': [[1, 3, 3], [3, 3, 3], [3, 3, 3], [3, 3, 3]], 'convolutional_pooling': True,
+                                  'convolutional_upsampling': True})]
+    for patch_size, num_pool, net_args in configs:
+        network = Generic_UNet(2, 8, 3, num_pool, max_num_features=32, **net_args)
+        skip_sizes, bottleneck_size, out_sizes = plan_shapes(network, 2, patch_size, decoder=True)
+        assert (skip_sizes, bottleneck_size, out_sizes) == _dummy_forward(network, 2, patch_size)
+        assert plan_shapes(network, 2, patch_size)[2] is None
+
+if __name__ == "__main__":
+    test_generic_ViT_UNet_shapes()
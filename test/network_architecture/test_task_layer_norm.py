@@ -0,0 +1,50 @@
+#########################################################################################################
+#-----------This class represents the PyTests for the task specific LayerNorms of the ViT.--------------#
+#########################################################################################################
+
+import torch
+from torch import nn
+from functools import partial
+from nnunet_ext.network_architecture.vision_transformer import TaskLayerNorm
+
+def test_task_layer_norm():
+    r"""This function is used to test that the TaskLayerNorm is identical to one LayerNorm per task, normalizes mixed
+        batches per sample, only trains the active task and loads state_dicts of the previous ModuleDict format.
+    """
+    torch.manual_seed(0)
+    norm_layer = partial(nn.LayerNorm, eps=1e-6)
+    x = torch.rand(4, 5, 8)
+
+    # -- Build the previous LayerNorms per task and the TaskLayerNorm with the same parameters -- #
+    norms = nn.ModuleDict({task: norm_layer(8) for task in ['task_A', 'task_B']})
+    for norm in norms.values():
+        nn.init.normal_(norm.weight)
+        nn.init.normal_(norm.bias)
+    task_norm = TaskLayerNorm(8, 'task_A', norm_layer)
+    task_norm.register_new_task('task_B')
+    assert 'task_B' in task_norm and 'task_C' not in task_norm
+    task_norm.load_state_dict(norms.state_dict())
+    assert sorted(task_norm.state_dict().keys()) == ['bias.0', 'bias.1', 'weight.0', 'weight.1']
+
+    # -- Single task and mixed batches are identical to the LayerNorm of every task -- #
+    for task, norm in norms.items():
+        task_norm.use_task(task)
+        assert torch.allclose(task_norm(x), norm(x), atol=1e-6)
+    tasks = ['task_B', 'task_A', 'task_A', 'task_B']
+    expected = torch.stack([norms[task](x[i]) for i, task in enumerate(tasks)])
+    assert torch.allclose(task_norm(x, tasks), expected, atol=1e-6)
+
+    # -- Only the parameters of the active task receive a gradient -- #
+    task_norm.use_task('task_B')
+    task_norm(x).sum().backward()
+    assert task_norm.weight[0].grad is None and task_norm.weight[1].grad is not None
+
+    # -- A new task is initialized like a new LayerNorm and an Identity stays an Identity -- #
+    task_norm.register_new_task('task_C')
+    assert torch.allclose(task_norm(x, 'task_C'), norm_layer(8)(x), atol=1e-6)
+    identity = TaskLayerNorm(8, 'task_A')
+    identity.register_new_task('task_B')
+    assert len(list(identity.parameters())) == 0 and torch.equal(identity(x, 'task_B'), x)
+
+if __name__ == "__main__":
+    test_task_layer_norm()
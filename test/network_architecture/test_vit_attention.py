@@ -0,0 +1,55 @@
+#########################################################################################################
+#-------------This class represents the PyTests for the attention backends of the ViT.------------------#
+#########################################################################################################
+
+import torch
+from timm.models.vision_transformer import Attention as AttentionTimm
+from nnunet_ext.network_architecture.vision_transformer import Attention, _HAS_SDPA
+
+def _reference_LSA(attn, x):
+    r"""The LSA forward with einsum and the masking by indexing, ie. the implementation before the attention backends."""
+    b, n, _ = x.shape
+    q, k, v = attn.qkv(x).reshape(b, n, 3, attn.num_heads, -1).permute(2, 0, 3, 1, 4)
+    dots = torch.einsum('b h i d, b h j d -> b h i j', q, k) * attn.scale.view(1, -1, 1, 1)
+    mask = torch.nonzero(torch.eye(n) == 1, as_tuple=False)
+    dots[:, :, mask[:, 0], mask[:, 1]] = -987654321
+    out = torch.einsum('b h i j, b h j d -> b h i d', dots.softmax(dim=-1), v)
+    return attn.to_out(out.transpose(1, 2).reshape(b, n, -1))
+
+def test_vit_attention():
+    r"""This function is used to test that both attention backends are identical to the previous LSA and the timm
+        attention and that the state_dict of the attention did not change.
+    """
+    torch.manual_seed(0)
+    x = torch.rand(2, 17, 64)
+    backends = ['manual', 'sdpa'] if _HAS_SDPA else ['manual']
+
+    # -- LSA with a learned temperature of every head -- #
+    lsa = Attention(64, num_heads=4, is_LSA=True, num_patches=16, attn_backend='manual')
+    with torch.no_grad():
+        lsa.scale.mul_(torch.tensor([0.5, 1, 1.5, 2]))
+    expected = _reference_LSA(lsa, x)
+    for backend in backends:
+        lsa.attn_backend = backend
+        assert torch.allclose(lsa(x), expected, atol=1e-5)
+    assert 'attn_mask' not in lsa.state_dict() and 'scale' in lsa.state_dict()
+
+    # -- Standard attention with the weights of timm -- #
+    timm_attn = AttentionTimm(64, num_heads=4, qkv_bias=True)
+    attn = Attention(64, num_heads=4, qkv_bias=True, attn_backend='manual')
+    attn.load_state_dict(timm_attn.state_dict())
+    for backend in backends:
+        attn.attn_backend = backend
+        assert torch.allclose(attn(x), timm_attn(x), atol=1e-5)
+
+    # -- The gradient of the temperature is identical for every backend -- #
+    grads = list()
+    for backend in backends:
+        lsa.attn_backend = backend
+        lsa.zero_grad()
+        lsa(x).sum().backward()
+        grads.append(lsa.scale.grad.clone())
+    assert all(torch.allclose(grad, grads[0], atol=1e-4) for grad in grads)
+
+if __name__ == "__main__":
+    test_vit_attention()
@@ -0,0 +1,43 @@
+#########################################################################################################
+#----------This class represents the PyTests for the POD embeddings of the POD based losses.------------#
+#########################################################################################################
+
+import torch
+from nnunet_ext.training.loss_functions.embeddings import local_POD, pod_embed
+
+def _reference_local_POD(h_, h_old, scales):
+    r"""Local POD distance calculated by looping over every window at every scale as it was done before."""
+    POD_, POD_old = None, None
+    W, H = h_.size(-1), h_.size(-2)
+    for scale in range(0, scales, 1):
+        w, h = int(W/(2**scale)), int(H/(2**scale))
+        for i in range(0, W-w, w):
+            for j in range(0, H-h, h):
+                pod_, pod_old = pod_embed(h_[..., i:i+w, j:j+h]), pod_embed(h_old[..., i:i+w, j:j+h])
+                POD_ = pod_ if POD_ is None else torch.cat((POD_, pod_), dim=2)
+                POD_old = pod_old if POD_old is None else torch.cat((POD_old, pod_old), dim=2)
+    layer_loss = torch.stack([torch.linalg.norm(p_ - p_o, dim=-1) for p_, p_o in zip(POD_, POD_old)])
+    return torch.mean(layer_loss)
+
+def test_local_POD():
+    r"""This function is used to test that the vectorized local POD is identical to the looped one, including the gradients."""
+    torch.manual_seed(0)
+    # -- 2D square and non-square feature maps (the latter with windows that are cut off at the border) and 3D feature maps -- #
+    for shape, scales in [((2, 4, 16, 16), 3), ((2, 4, 17, 17), 4), ((2, 3, 12, 8), 3), ((2, 3, 4, 8, 8), 2)]:
+        h_old = torch.randn(shape)
+        h_ = (h_old + 0.1 * torch.randn(shape)).requires_grad_()
+        expected = _reference_local_POD(h_, h_old, scales)
+        expected_grad, = torch.autograd.grad(expected, h_)
+        loss = local_POD(h_, h_old, scales)
+        grad, = torch.autograd.grad(loss, h_)
+        assert torch.allclose(loss, expected, rtol=1e-5), "The vectorized local POD differs from the looped one for shape {}.".format(shape)
+        assert torch.allclose(grad, expected_grad, rtol=1e-4, atol=1e-7), "The gradients differ for shape {}.".format(shape)
+
+    # -- Identical embeddings have no distance and no NaN gradients -- #
+    h_ = torch.randn(2, 4, 16, 16, requires_grad=True)
+    loss = local_POD(h_, h_.detach().clone(), 3)
+    grad, = torch.autograd.grad(loss, h_)
+    assert loss.item() == 0 and torch.isfinite(grad).all()
+
+if __name__ == "__main__":
+    test_local_POD()
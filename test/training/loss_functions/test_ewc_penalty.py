@@ -0,0 +1,111 @@
+#########################################################################################################
+#----------This class represents the PyTests for the EWC penalty engine of the EWC based losses.---------#
+#########################################################################################################
+
+import torch
+from nnunet.network_architecture.generic_UNet import Generic_UNet
+from nnunet_ext.training.loss_functions.ewc_penalty import FlatEWCPenalty, CONSOLIDATED_KEY, consolidate_ewc_values
+
+def _reference_penalty(network_params, tasks, weights, anchors, match_sth=False, match=list(), match_true=True):
+    r"""Penalty calculated by looping over every task and parameter as it is described in the EWC paper."""
+    penalty = 0
+    for task in tasks:
+        for name, param in network_params:
+            if (match_sth and match_true and all(m_name in name for m_name in match))\
+            or (match_sth and not match_true and all(m_name not in name for m_name in match))\
+            or (not match_sth):
+                penalty += (weights[task][name] * (param - anchors[task][name]).pow(2)).sum()
+    return penalty
+
+def test_flat_ewc_penalty():
+    r"""This function is used to test that the fused penalty is identical to the looped one, including the gradients."""
+    torch.manual_seed(0)
+    network = Generic_UNet(input_channels=3, base_num_features=5, num_classes=2, num_pool=3)
+    tasks = ['task_A', 'task_B']
+    weights = {t: {n: torch.rand_like(p) for n, p in network.named_parameters()} for t in tasks}
+    anchors = {t: {n: p.detach() + torch.randn_like(p) for n, p in network.named_parameters()} for t in tasks}
+
+    for match_sth, match, match_true in [(False, list(), True), (True, ['conv_blocks_context'], True), (True, ['seg_outputs'], False)]:
+        engine = FlatEWCPenalty(match_sth, match, match_true)
+        # -- Compare penalty and gradients to the reference implementation -- #
+        network.zero_grad()
+        expected = _reference_penalty(list(network.named_parameters()), tasks, weights, anchors, match_sth, match, match_true)
+        expected.backward()
+        expected_grads = {n: p.grad.clone() for n, p in network.named_parameters() if p.grad is not None}
+        network.zero_grad()
+        penalty = engine(network.named_parameters(), tasks, weights, anchors)
+        penalty.backward()
+        assert torch.allclose(penalty, expected, rtol=1e-5), "The fused penalty differs from the looped one."
+        for n, p in network.named_parameters():
+            if n in expected_grads:
+                assert torch.allclose(p.grad, expected_grads[n], rtol=1e-5, atol=1e-6), "The gradient of \'{}\' differs.".format(n)
+
+        # -- The values of the matched parameters are views into the flattened buffers, so they are not stored twice -- #
+        for n, _ in network.named_parameters():
+            if engine.matches(n):
+                assert weights['task_B'][n]._base is engine._weights and anchors['task_B'][n]._base is engine._anchors,\
+                    "The value of \'{}\' should be a view into the flattened buffers.".format(n)
+
+        # -- The buffers are reused as long as nothing changes and are rebuilt after reset -- #
+        weights_buffer = engine._weights
+        engine(network.named_parameters(), tasks, weights, anchors)
+        assert engine._weights is weights_buffer, "The flattened buffers should be reused."
+        engine.reset()
+        engine(network.named_parameters(), tasks[:1], weights, anchors)
+        assert engine._weights.shape[0] == 1, "The flattened buffers should be rebuilt for the new tasks."
+
+def test_consolidated_ewc_penalty():
+    r"""This function is used to test that the consolidated values result in the same gradients as the per task values."""
+    torch.manual_seed(0)
+    network = Generic_UNet(input_channels=3, base_num_features=5, num_classes=2, num_pool=3)
+    tasks = ['task_A', 'task_B', 'task_C']
+    weights = {t: {n: torch.rand_like(p) for n, p in network.named_parameters()} for t in tasks}
+    anchors = {t: {n: p.detach() + torch.randn_like(p) for n, p in network.named_parameters()} for t in tasks}
+    # -- Parameters without gradients only have a single fisher value, and a zero precision should not lead to NaNs -- #
+    name = next(iter(weights['task_A']))
+    weights['task_A'][name], weights['task_B'][name] = torch.tensor([1.]), torch.zeros_like(weights['task_B'][name])
+
+    network.zero_grad()
+    FlatEWCPenalty()(network.named_parameters(), tasks, weights, anchors).backward()
+    expected_grads = {n: p.grad.clone() for n, p in network.named_parameters()}
+
+    for task in tasks:
+        consolidate_ewc_values(weights, anchors, task)
+    assert list(weights.keys()) == [CONSOLIDATED_KEY] and list(anchors.keys()) == [CONSOLIDATED_KEY],\
+        "Only the consolidated values should be left."
+    network.zero_grad()
+    FlatEWCPenalty()(network.named_parameters(), [CONSOLIDATED_KEY], weights, anchors).backward()
+    for n, p in network.named_parameters():
+        assert torch.allclose(p.grad, expected_grads[n], rtol=1e-4, atol=1e-5), "The gradient of \'{}\' differs.".format(n)
+
+def test_ewc_penalty_gradients():
+    r"""This function is used to test that adding the gradients directly results in the same gradients as the backward pass."""
+    torch.manual_seed(0)
+    network = Generic_UNet(input_channels=3, base_num_features=5, num_classes=2, num_pool=3, deep_supervision=False)
+    network.eval()  # --> No dropout, so both forward passes are identical
+    tasks = ['task_A', 'task_B']
+    weights = {t: {n: torch.rand_like(p) for n, p in network.named_parameters()} for t in tasks}
+    anchors = {t: {n: p.detach() + torch.randn_like(p) for n, p in network.named_parameters()} for t in tasks}
+    importance = {t: {n: torch.rand_like(p) for n, p in network.named_parameters()} for t in tasks}
+    x = torch.rand((2, 3, 32, 32))
+
+    for imp in [None, importance]:
+        engine = FlatEWCPenalty()
+        network.zero_grad()
+        expected = network(x).mean() + 0.2 * engine(network.named_parameters(), tasks, weights, anchors, imp)
+        expected.backward()
+        expected_grads = {n: p.grad.clone() for n, p in network.named_parameters()}
+
+        # -- Backward pass without the penalty and add its gradients afterwards -- #
+        network.zero_grad()
+        loss = network(x).mean()
+        loss.backward()
+        engine.add_gradients(network.named_parameters(), tasks, weights, anchors, 0.2, imp)
+        for n, p in network.named_parameters():
+            assert torch.allclose(p.grad, expected_grads[n], rtol=1e-4, atol=1e-5), "The gradient of \'{}\' differs.".format(n)
+        assert abs(loss.item() + engine.last_value() - expected.item()) < 1e-3 * abs(expected.item()), "The penalty value differs."
+
+if __name__ == "__main__":
+    test_flat_ewc_penalty()
+    test_consolidated_ewc_penalty()
+    test_ewc_penalty_gradients()
@@ -0,0 +1,60 @@
+#########################################################################################################
+#----------This class represents the PyTests for the pseudo label loss of the PLOP approach.------------#
+#########################################################################################################
+
+import torch, copy
+from nnunet_ext.training.loss_functions.crossentropy import entropy, RobustCrossEntropyLoss
+from nnunet_ext.training.loss_functions.deep_supervision import MultipleOutputLossPLOP
+
+def _reference_pseudo_label_loss(x, x_o, y, thresholds, max_entropy):
+    r"""Pseudo label loss using deep copies of the labels and two CE passes as it was done before."""
+    ce = RobustCrossEntropyLoss(ignore_index=255)
+    mask_background = y == 0
+    probs = torch.softmax(x_o, dim=1)
+    _, pseudo_labels = probs.max(dim=1)
+    mask_valid_pseudo = (entropy(probs) / max_entropy) < thresholds[pseudo_labels]
+    num = (mask_valid_pseudo & mask_background).float().sum(dim=(1,2))
+    den = mask_background.float().sum(dim=(1,2))
+    classif_adaptive_factor = (num / den)[:, None, None]
+    mask = mask_background & mask_valid_pseudo
+    lab = copy.deepcopy(y)
+    lab[mask] = 255
+    loss_not_pseudo = ce(x, lab.long())
+    _labels = copy.deepcopy(y)
+    _labels[~mask] = 255
+    _labels[mask] = pseudo_labels[mask].float()
+    loss_pseudo = ce(x, _labels)
+    return (classif_adaptive_factor * (loss_pseudo + loss_not_pseudo)).mean()
+
+def test_plop_loss():
+    r"""This function is used to test that the fused pseudo label loss is identical to the previous implementation,
+        including the gradients, and that outputs with a weight of 0 are skipped.
+    """
+    torch.manual_seed(0)
+    weights = [1, 0.5, 0]
+    shapes = [(16, 16), (8, 8), (4, 4)]
+    x = [torch.randn(2, 4, *shape, requires_grad=True) for shape in shapes]
+    x_o = [torch.randn(2, 4, *shape) * 3 for shape in shapes]
+    y = [(torch.rand(2, 1, *shape) * 8).floor().clamp(max=3) * (torch.rand(2, 1, *shape) > 0.5) for shape in shapes]
+    y[0][0, 0, 0, :3] = 255  # --> Labels that are already ignored
+    thresholds = {idx: torch.rand(4) * 0.5 + 0.3 for idx in range(len(shapes))}
+    max_entropy = torch.tensor(0.9)
+
+    loss = MultipleOutputLossPLOP(nr_classes=3, weight_factors=weights)
+    loss.update_plop_params(dict(), dict(), thresholds, max_entropy)
+    fused = loss(x, x_o, y)
+    fused_grads = torch.autograd.grad(fused, x, allow_unused=True)
+
+    reference = sum(w * _reference_pseudo_label_loss(x[i], x_o[i], y[i].squeeze(), thresholds[i], max_entropy)
+                    for i, w in enumerate(weights) if w != 0)
+    reference_grads = torch.autograd.grad(reference, x[:2])
+
+    assert torch.allclose(fused, reference, rtol=1e-5, atol=1e-7), "The fused loss differs from the reference."
+    for fused_grad, reference_grad in zip(fused_grads[:2], reference_grads):
+        assert torch.allclose(fused_grad, reference_grad, rtol=1e-5, atol=1e-7), "The gradients of the fused loss differ."
+
+    # -- The output with a weight of 0 is not part of the graph -- #
+    assert fused_grads[2] is None, "The output with a weight of 0 should be skipped."
+
+if __name__ == "__main__":
+    test_plop_loss()
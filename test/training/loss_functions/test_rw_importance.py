@@ -0,0 +1,49 @@
+#########################################################################################################
+#----------This class represents the PyTests for the RW engine of the importance scores.----------------#
+#########################################################################################################
+
+import torch
+from nnunet_ext.training.loss_functions.rw_importance import RWImportance
+
+def _reference_update(network, fisher, scores, prev_param, alpha, epsilon=1e-8):
+    r"""Update of the scores and fisher values by looping over every parameter as it was done in the RW trainer."""
+    if prev_param is not None:
+        for name, param in network.named_parameters():
+            if param.grad is not None:
+                delta = param.grad.detach() * (prev_param[name] - param.detach())
+                den = 0.5 * fisher[name] * (param.detach() - prev_param[name]).pow(2) + epsilon
+                score = delta / den
+                score[score < 0] = 0
+                scores[name] += score
+    prev_param = {k: torch.clone(v).detach() for k, v in network.named_parameters() if v.grad is not None}
+    for name, param in network.named_parameters():
+        if param.grad is not None:
+            fisher[name] = (alpha * param.grad.data.clone().pow(2)) + ((1 - alpha) * fisher[name])
+    return prev_param
+
+def test_rw_importance():
+    r"""This function is used to test that the flattened RW updates are identical to the looped ones."""
+    torch.manual_seed(0)
+    network = torch.nn.Sequential(torch.nn.Conv2d(3, 4, 3), torch.nn.ReLU(), torch.nn.Conv2d(4, 2, 1), torch.nn.Conv2d(2, 2, 1))
+    optimizer = torch.optim.SGD(network.parameters(), lr=0.1)
+    engine = RWImportance(alpha=0.9)
+    fisher, scores = engine.bind(network.named_parameters())
+    ref_fisher = {n: torch.zeros_like(p) for n, p in network.named_parameters()}
+    ref_scores = {n: torch.zeros_like(p) for n, p in network.named_parameters()}
+    prev_param = None
+
+    for it in range(5):
+        optimizer.zero_grad(set_to_none=True)
+        # -- The last layer is not used in the last iteration, so its parameters do not have gradients -- #
+        out = network[:3](torch.randn(2, 3, 8, 8)) if it == 4 else network(torch.randn(2, 3, 8, 8))
+        out.pow(2).mean().backward()
+        optimizer.step()
+        prev_param = _reference_update(network, ref_fisher, ref_scores, prev_param, 0.9)
+        engine.update()
+
+    for name in ref_fisher.keys():
+        assert torch.allclose(fisher[name], ref_fisher[name], rtol=1e-5, atol=1e-7), "The fisher values of {} differ.".format(name)
+        assert torch.allclose(scores[name], ref_scores[name], rtol=1e-4, atol=1e-6), "The scores of {} differ.".format(name)
+
+if __name__ == "__main__":
+    test_rw_importance()
@@ -0,0 +1,58 @@
+#########################################################################################################
+#----------This class represents the PyTests for the gradient-hook mode of the EWC ViT/UNet/LN trainers.-#
+#########################################################################################################
+
+import torch
+import tempfile
+import numpy as np
+from batchgenerators.utilities.file_and_folder_operations import join
+from nnunet_ext.training.network_training.ewc_ln.nnUNetTrainerEWCLN import nnUNetTrainerEWCLN
+from nnunet_ext.training.network_training.ewc_vit.nnUNetTrainerEWCViT import nnUNetTrainerEWCViT
+from nnunet_ext.training.network_training.ewc_unet.nnUNetTrainerEWCUNet import nnUNetTrainerEWCUNet
+
+class _Loss(torch.nn.Module):
+    r"""A loss in gradient-hook mode that records when its penalty gradients are added."""
+    def __init__(self, network):
+        super().__init__()
+        self.network = network
+        self.ewc_grad_hook = True
+        self.grads_at_hook = None
+
+    def forward(self, output, target):
+        return torch.nn.functional.mse_loss(output, target)
+
+    def apply_penalty_gradients(self):
+        self.grads_at_hook = [param.grad.clone() for param in self.network.parameters()]
+
+    def update_network_params(self, network_params):
+        self.network_params = [name for name, _ in network_params]
+
+class _MultiHead():
+    def update_after_iteration(self):
+        pass
+
+def test_ewc_grad_hook():
+    r"""This function is used to test that the EWC ViT, UNet and LN trainers add the EWC gradients after the backward
+        pass, ie. call after_backward(), when the loss is in gradient-hook mode.
+    """
+    for trainer_class in [nnUNetTrainerEWCViT, nnUNetTrainerEWCUNet, nnUNetTrainerEWCLN]:
+        with tempfile.TemporaryDirectory() as folder:
+            output_folder = join(folder, 'Task_A', trainer_class.__name__ + '__nnUNetPlansv2.1', 'fold_0')
+            trainer = trainer_class('seg_outputs', 'Task_A', join(folder, 'plans.pkl'), 0, output_folder=output_folder,
+                                    dataset_directory=folder, use_progress=False, tasks_list_with_char=(['Task_A'], '_'), network='2d')
+            # -- Set everything initialize would set that is used by run_iteration -- #
+            trainer.fp16 = False
+            trainer.network = torch.nn.Linear(4, 1)
+            trainer.loss = _Loss(trainer.network)
+            trainer.optimizer = torch.optim.SGD(trainer.network.parameters(), lr=0.1)
+            trainer.mh_network = _MultiHead()
+            batch = {'data': np.ones((2, 4), dtype=np.float32), 'target': np.zeros((2, 1), dtype=np.float32)}
+
+            trainer.run_iteration(iter([batch]), do_backprop=True)
+
+            # -- The penalty gradients are added once the gradients of the loss exist -- #
+            assert trainer.loss.grads_at_hook is not None
+            assert all(grad.abs().sum() > 0 for grad in trainer.loss.grads_at_hook)
+
+if __name__ == "__main__":
+    test_ewc_grad_hook()
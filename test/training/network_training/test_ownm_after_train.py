@@ -0,0 +1,75 @@
+#########################################################################################################
+#----------This class represents the PyTests for the estimation of the Fisher values of our own trainers.-#
+#########################################################################################################
+
+import torch
+import tempfile
+import numpy as np
+from batchgenerators.utilities.file_and_folder_operations import join
+from nnunet_ext.training.network_training.ownm1.nnUNetTrainerOwnM1 import nnUNetTrainerOwnM1
+from nnunet_ext.training.network_training.ownm4.nnUNetTrainerOwnM4 import nnUNetTrainerOwnM4
+
+class _Network(torch.nn.Module):
+    r"""A small network with a ViT part, since our own trainers only keep the Fisher values of the ViT parameters."""
+    def __init__(self):
+        super().__init__()
+        self.ViT = torch.nn.Linear(4, 3)
+        self.head = torch.nn.Linear(3, 1)
+
+    def forward(self, x):
+        return self.head(self.ViT(x))
+
+def _batches(nr_batches):
+    r"""This function returns nr_batches random batches and a generator that counts the drawn batches."""
+    rnd = np.random.RandomState(0)
+    batches = [{'data': rnd.rand(2, 4).astype(np.float32), 'target': rnd.rand(2, 1).astype(np.float32)} for _ in range(nr_batches)]
+    drawn = list()
+    def gen():
+        for batch in batches:
+            drawn.append(batch)
+            yield batch
+    return batches, drawn, gen()
+
+def test_ownm_after_train():
+    r"""This function is used to test that after_train of our own trainers estimates the Fisher values with the settings
+        of the trainer, ie. fisher_batches and fisher_autocast, and only keeps the values of the ViT parameters.
+    """
+    for trainer_class in [nnUNetTrainerOwnM1, nnUNetTrainerOwnM4]:
+        with tempfile.TemporaryDirectory() as folder:
+            output_folder = join(folder, 'Task_A', trainer_class.__name__ + '__nnUNetPlansv2.1', 'fold_0')
+            trainer = trainer_class('seg_outputs', 'Task_A', join(folder, 'plans.pkl'), 0, output_folder=output_folder,
+                                    dataset_directory=folder, use_progress=False, tasks_list_with_char=(['Task_A'], '_'), network='2d')
+            # -- The settings of the Fisher estimation are defined by the constructor -- #
+            assert trainer.fisher_batches is None and trainer.fisher_autocast is None
+
+            # -- Set everything initialize would set that is used by after_train -- #
+            trainer.network = _Network()
+            trainer.loss = torch.nn.MSELoss()
+            trainer.optimizer = torch.optim.SGD(trainer.network.parameters(), lr=0.1)
+            trainer.num_batches_per_epoch = 4
+            trainer.fisher_batches = 3
+            trainer.fisher[trainer.task], trainer.params[trainer.task] = dict(), dict()
+            batches, drawn, trainer.tr_gen = _batches(4)
+            weights = {name: param.detach().clone() for name, param in trainer.network.named_parameters()}
+
+            trainer.after_train()
+
+            # -- Only fisher_batches batches are used and the weights are not changed -- #
+            assert len(drawn) == 3
+            assert all(torch.equal(param, weights[name]) for name, param in trainer.network.named_parameters())
+
+            # -- The Fisher values are the mean of the squared gradients of the ViT parameters -- #
+            expected = {name: torch.zeros_like(param) for name, param in trainer.network.named_parameters()}
+            for batch in batches[:3]:
+                trainer.network.zero_grad()
+                trainer.loss(trainer.network(torch.from_numpy(batch['data'])), torch.from_numpy(batch['target'])).backward()
+                for name, param in trainer.network.named_parameters():
+                    expected[name] += param.grad.pow(2) / 3
+            assert sorted(trainer.fisher[trainer.task].keys()) == ['ViT.bias', 'ViT.weight']
+            assert sorted(trainer.params[trainer.task].keys()) == ['ViT.bias', 'ViT.weight']
+            for name, values in trainer.fisher[trainer.task].items():
+                assert torch.allclose(values, expected[name], atol=1e-6)
+                assert torch.equal(trainer.params[trainer.task][name], weights[name])
+
+if __name__ == "__main__":
+    test_ownm_after_train()
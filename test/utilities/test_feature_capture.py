@@ -0,0 +1,49 @@
+#########################################################################################################
+#----------This class represents the PyTests for the FeatureCapture of the distillation trainers.-------#
+#########################################################################################################
+
+import copy, torch
+from nnunet.network_architecture.generic_UNet import Generic_UNet
+from nnunet_ext.utilities.feature_capture import FeatureCapture, select_modules
+
+def test_feature_capture():
+    r"""This function is used to test that the FeatureCapture selects the right layers, registers its hooks only once
+        and reuses its buffers.
+    """
+    torch.manual_seed(0)
+    network = Generic_UNet(input_channels=1, base_num_features=4, num_classes=2, num_pool=2, deep_supervision=False).eval()
+    conv_names = [name for name, module in network.named_modules() if isinstance(module, torch.nn.Conv2d)]
+    assert set(conv_names) <= set(select_modules(network)), "Every convolutional layer should be selected by default."
+    assert all('seg_outputs' in name for name in select_modules(network, patterns=['seg_outputs']))
+    assert all(name.startswith('conv_blocks_context.1') for name in select_modules(network, patterns=['conv_blocks_context'], stages=[1]))
+
+    # -- Attaching the capture twice does not register duplicate hooks -- #
+    capture = FeatureCapture(patterns=['conv_blocks_context'])
+    names = capture.attach(network)
+    assert capture.attach(network) == names
+    assert sum(len(network.get_submodule(name)._forward_hooks) for name in names) == len(names), "The hooks should only be registered once."
+
+    # -- The buffers are reused in every iteration and contain the outputs of the last forward pass -- #
+    data = torch.rand(2, 1, 32, 32)
+    with torch.no_grad():
+        network(data)
+        pointers = {name: value.data_ptr() for name, value in capture.results.items()}
+        capture.clear()
+        network(data)
+    assert set(capture.results.keys()) == set(names)
+    assert all(capture.results[name].data_ptr() == pointers[name] for name in names), "The buffers should be reused."
+
+    # -- Removing the capture removes its hooks, so they are not copied with the network -- #
+    capture.remove()
+    network_old = copy.deepcopy(network)
+    assert all(len(module._forward_hooks) == 0 for module in network_old.modules())
+
+    # -- Pooling reduces the size of the captured outputs -- #
+    pooled = FeatureCapture(patterns=['conv_blocks_context.0'], pool=2)
+    pooled.attach(network)
+    with torch.no_grad():
+        network(data)
+    assert all(value.shape[-1] == 16 for value in pooled.results.values())
+
+if __name__ == "__main__":
+    test_feature_capture()
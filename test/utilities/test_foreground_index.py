@@ -0,0 +1,50 @@
+#########################################################################################################
+#-----------This class represents the PyTests for the foreground index of the data loaders.-------------#
+#########################################################################################################
+
+import tempfile
+import numpy as np
+from batchgenerators.utilities.file_and_folder_operations import *
+from nnunet_ext.utilities.foreground_index import ForegroundIndex, attach_foreground_index
+
+def _create_case(folder, case, seed):
+    r"""This function creates a preprocessed case with one image channel and a segmentation with the classes 1 and 2."""
+    rnd = np.random.RandomState(seed)
+    seg = rnd.choice([-1, 0, 1, 2], size=(6, 8, 8), p=[0.1, 0.6, 0.25, 0.05]).astype(np.float32)
+    np.savez(join(folder, case + '.npz'), data=np.stack((rnd.rand(6, 8, 8).astype(np.float32), seg)))
+    save_pickle({'classes': np.array([-1, 0, 1, 2]), 'class_locations': {1: np.zeros((0, 3)), 2: np.zeros((0, 3))}},
+                join(folder, case + '.pkl'))
+    return seg
+
+def test_foreground_index():
+    r"""This function is used to test that the foreground index holds valid locations of every class, is extended
+        by missing cases without changing the existing ones and is attached to the properties of a dataset.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        segs = {'case_%d' % i: _create_case(folder, 'case_%d' % i, i) for i in range(3)}
+        dataset = {case: {'data_file': join(folder, case + '.npz'), 'properties_file': join(folder, case + '.pkl')} for case in segs}
+
+        # -- Every class is indexed and every location belongs to its class -- #
+        index = ForegroundIndex(folder, max_locations=20)
+        index.build({case: dataset[case] for case in ['case_0', 'case_1']}, num_processes=2)
+        locations_0 = {c: np.array(v) for c, v in index.class_locations('case_0').items()}
+        for c in [1, 2]:
+            assert len(locations_0[c]) == min(20, (segs['case_0'] == c).sum())
+            assert all(segs['case_0'][tuple(location)] == c for location in locations_0[c])
+            assert segs['case_1'][tuple(index.random_location('case_1', c))] == c
+
+        # -- A missing case is added, the existing locations stay the same -- #
+        index.build(dataset, num_processes=2)
+        reopened = ForegroundIndex(folder, max_locations=20)
+        assert sorted(reopened.cases()) == ['case_0', 'case_1', 'case_2']
+        assert all(np.array_equal(reopened.class_locations('case_0')[c], locations_0[c]) for c in [1, 2])
+        assert ForegroundIndex(folder, max_locations=10).cases() == []
+
+        # -- The dataset uses the locations of the index with the default settings -- #
+        attach_foreground_index(dataset, num_processes=2)
+        for case, entry in dataset.items():
+            assert entry['foreground_index'] and sorted(entry['properties']['class_locations'].keys()) == [1, 2]
+            assert all(segs[case][tuple(location)] == 2 for location in entry['properties']['class_locations'][2])
+
+if __name__ == "__main__":
+    test_foreground_index()
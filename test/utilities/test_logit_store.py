@@ -0,0 +1,48 @@
+#########################################################################################################
+#----------This class represents the PyTests for the LogitStore of the LwF trainer.---------------------#
+#########################################################################################################
+
+import torch, tempfile
+from batchgenerators.utilities.file_and_folder_operations import *
+from nnunet_ext.utilities.logit_store import LogitStore
+from nnunet_ext.utilities.seeded_batches import sample_keys
+
+def test_logit_store():
+    r"""This function is used to test that the LogitStore restores the logits of a batch per head, replaces the oldest
+        samples and can be opened again, in half precision as well as quantized.
+    """
+    torch.manual_seed(0)
+    logits = {'task_A': torch.randn(2, 3, 16, 16) * 4, 'task_B': torch.randn(2, 3, 16, 16) * 4}
+    with tempfile.TemporaryDirectory() as folder:
+        store = LogitStore(join(folder, 'logits'), capacity=3, prefetch=True)
+        keys = sample_keys('task_C', ['case_0', 'case_1'], seed=0)
+        assert store.missing_tasks(['task_A', 'task_B'], keys) == ['task_A', 'task_B'] and store.load('task_A', keys) is None
+        for task, value in logits.items():
+            store.store(task, keys, value)
+
+        # -- The logits are restored in half precision, also in another order and from the prefetched rows -- #
+        store.prefetch('task_B', keys[::-1])
+        assert torch.allclose(store.load('task_A', keys).float(), logits['task_A'], atol=1e-2)
+        assert torch.allclose(store.load('task_B', keys[::-1]).float(), logits['task_B'][[1, 0]], atol=1e-2)
+
+        # -- The oldest sample is replaced once all slots are used -- #
+        other = sample_keys('task_C', ['case_2', 'case_3'], seed=1)
+        store.store('task_A', other, logits['task_A'])
+        assert not store.contains('task_A', keys[:1]) and store.contains('task_A', keys[1:] + other)
+
+        # -- The store can be opened again and only the missing head is computed -- #
+        store.flush()
+        reopened = LogitStore(join(folder, 'logits'), capacity=3)
+        assert reopened.missing_tasks(['task_A', 'task_B', 'task_C'], keys[1:]) == ['task_C']
+        assert torch.allclose(reopened.load('task_B', keys).float(), logits['task_B'], atol=1e-2)
+
+        # -- Quantized logits are restored up to half of the quantization step -- #
+        quantized = LogitStore(join(folder, 'quantized'), capacity=2, quantize=True)
+        quantized.store('task_A', keys, logits['task_A'])
+        step = (logits['task_A'].amax(dim=(2, 3)) - logits['task_A'].amin(dim=(2, 3))) / 255
+        assert ((quantized.load('task_A', keys) - logits['task_A']).abs() <= step[..., None, None] / 2 + 1e-5).all()
+        quantized.reset()
+        assert not isdir(join(folder, 'quantized'))
+
+if __name__ == "__main__":
+    test_logit_store()
@@ -0,0 +1,85 @@
+#########################################################################################################
+#----------This class represents the PyTests for the ReplayBuffer of the rehearsal trainer.-------------#
+#########################################################################################################
+
+import tempfile
+import numpy as np
+from batchgenerators.utilities.file_and_folder_operations import *
+from nnunet_ext.utilities.replay_buffer import ReplayBuffer, MixedDataLoader
+
+def _create_task(folder, task, nr_cases, classes):
+    r"""This function creates the preprocessed files of a task, case i contains the classes classes[i % len(classes)]."""
+    maybe_mkdir_p(join(folder, task))
+    cases = dict()
+    for i in range(nr_cases):
+        case = '{}_{:03d}'.format(task, i)
+        np.savez(join(folder, task, case + '.npz'), data=np.full((2, 4, 4), i, dtype=np.float32))
+        save_pickle({'classes': np.array([0] + classes[i % len(classes)])}, join(folder, task, case + '.pkl'))
+        cases[case] = {'data_file': join(folder, task, case + '.npz'), 'properties_file': join(folder, task, case + '.pkl')}
+    return cases
+
+class _DummyLoader():
+    r"""Data loader that returns batches of a fixed value."""
+    def __init__(self, batch_size, value):
+        self.batch_size, self.value = batch_size, value
+    def set_thread_id(self, thread_id):
+        self.thread_id = thread_id
+    def generate_train_batch(self):
+        return {'data': np.full((self.batch_size, 1, 2, 2), self.value), 'seg': np.zeros((self.batch_size, 1, 2, 2)),
+                'properties': [dict()] * self.batch_size, 'keys': np.array([str(self.value)] * self.batch_size)}
+
+def test_replay_buffer():
+    r"""This function is used to test that the ReplayBuffer keeps its budget over several tasks, selects the cases
+        deterministically, can be restored and pins the selected cases.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        tasks = {'Task_A': _create_task(folder, 'Task_A', 12, [[1], [1], [1], [2]]),
+                 'Task_B': _create_task(folder, 'Task_B', 8, [[1], [1, 3]]),
+                 'Task_C': _create_task(folder, 'Task_C', 10, [[1]])}
+
+        # -- The fraction mode uses the fraction of every task -- #
+        buffer = ReplayBuffer('fraction', fraction=0.25, seed=1)
+        for task, cases in tasks.items():
+            buffer.add_task(task, cases)
+        assert len(buffer.cases()) == 3 + 2 + 2
+
+        # -- The reservoir keeps the budget, is deterministic and continues identically after restoring -- #
+        buffer = ReplayBuffer('reservoir', budget=5, seed=1)
+        buffer.add_task('Task_A', tasks['Task_A'])
+        buffer.save(join(folder, 'buffer.pkl'))
+        restored = ReplayBuffer('reservoir', budget=5, seed=1)
+        assert restored.restore(join(folder, 'buffer.pkl')) and not ReplayBuffer('reservoir', budget=4, seed=1).restore(join(folder, 'buffer.pkl'))
+        for task in ['Task_B', 'Task_C']:
+            buffer.add_task(task, tasks[task])
+            restored.add_task(task, tasks[task])
+            assert len(buffer.selection) == 5
+        assert buffer.selection == restored.selection
+
+        # -- The class balanced selection contains every rare class -- #
+        buffer = ReplayBuffer('class_balanced', budget=5, seed=1)
+        for task, cases in tasks.items():
+            buffer.add_task(task, cases)
+        selected = set(buffer.cases().keys())
+        assert len(selected) == 5 and any(case in selected for case in ['Task_A_003', 'Task_A_007', 'Task_A_011'])
+        assert any(case in selected for case in ['Task_B_001', 'Task_B_003', 'Task_B_005', 'Task_B_007'])
+
+        # -- The memory budget removes cases until the size fits -- #
+        buffer = ReplayBuffer('fraction', budget_mb=2.5 * ReplayBuffer()._case_mb(tasks['Task_A']['Task_A_000']), fraction=1)
+        buffer.add_task('Task_A', tasks['Task_A'])
+        assert len(buffer.selection) == 2
+
+        # -- Pinned cases are loaded from the cache folder as uncompressed files -- #
+        buffer.pin(join(folder, 'cache'))
+        for case, entry in buffer.cases().items():
+            assert entry['data_file'].startswith(join(folder, 'cache'))
+            assert np.array_equal(np.load(entry['data_file'][:-4] + '.npy', mmap_mode='r'), np.load(tasks['Task_A'][case]['data_file'])['data'])
+
+    # -- The mixed data loader combines the batches of both loaders -- #
+    loader = MixedDataLoader(_DummyLoader(3, 0), _DummyLoader(1, 1))
+    loader.set_thread_id(2)
+    batch = loader.generate_train_batch()
+    assert loader.batch_size == 4 and batch['data'].shape[0] == 4 and list(batch['keys']) == ['0', '0', '0', '1']
+    assert all(l.thread_id == 2 for l in loader.loaders)
+
+if __name__ == "__main__":
+    test_replay_buffer()
@@ -0,0 +1,54 @@
+#########################################################################################################
+#----------This class represents the PyTests for the seeded batches of the data pipelines.--------------#
+#########################################################################################################
+
+import tempfile
+import numpy as np
+from batchgenerators.utilities.file_and_folder_operations import *
+from batchgenerators.transforms.abstract_transforms import Compose
+from nnunet.training.dataloading.dataset_loading import DataLoader3D
+from batchgenerators.dataloading.multi_threaded_augmenter import MultiThreadedAugmenter
+from batchgenerators.transforms.noise_transforms import GaussianNoiseTransform
+from batchgenerators.transforms.spatial_transforms import MirrorTransform
+from nnunet_ext.utilities.seeded_batches import seed_batches, seeded_batch, seeded_batches
+
+def _create_case(folder, case, seed):
+    r"""This function creates a preprocessed case with one image channel and a segmentation with the classes 0 and 1."""
+    rnd = np.random.RandomState(seed)
+    seg = (rnd.rand(12, 12, 12) > 0.8).astype(np.float32)
+    np.savez(join(folder, case + '.npz'), data=np.stack((rnd.rand(12, 12, 12).astype(np.float32), seg)))
+    save_pickle({'classes': np.array([0, 1]), 'class_locations': {1: np.argwhere(seg == 1)}}, join(folder, case + '.pkl'))
+
+def test_seeded_batches():
+    r"""This function is used to test that the seeded batches of the worker processes are the same as the ones created
+        in the main process, ie. the crop and the augmentation of a sample are determined by its key.
+    """
+    with tempfile.TemporaryDirectory() as folder:
+        for i in range(4):
+            _create_case(folder, 'case_%d' % i, i)
+        dataset = {'case_%d' % i: {'data_file': join(folder, 'case_%d.npz' % i), 'properties_file': join(folder, 'case_%d.pkl' % i)}
+                   for i in range(4)}
+        dl = DataLoader3D(dataset, (8, 8, 8), (8, 8, 8), 2, oversample_foreground_percent=0.5)
+        transform = Compose([MirrorTransform(), GaussianNoiseTransform(p_per_sample=0.5)])
+        gen = seed_batches(MultiThreadedAugmenter(dl, transform, 2, 1, seeds=[0, 1]), 3, 'task_A', first_seed=10)
+        assert seeded_batches(gen).seeds() == [10, 11, 12]
+
+        # -- Every batch of the workers is one of the seeded batches and equals the batch created in this process -- #
+        try:
+            for _ in range(6):
+                batch = next(gen)
+                assert batch['seed'] in [10, 11, 12]
+                assert batch['sample_keys'] == ['task_A:{}:{}:{}'.format(key, batch['seed'], idx) for idx, key in enumerate(batch['keys'])]
+                expected = seeded_batch(gen, batch['seed'])
+                assert np.array_equal(batch['data'], expected['data']) and np.array_equal(batch['seg'], expected['seg'])
+        finally:
+            gen._finish()
+
+        # -- The random state of this process is not changed by a seeded batch -- #
+        np.random.seed(0)
+        state = np.random.get_state()[1].copy()
+        seeded_batch(gen, 11)
+        assert np.array_equal(np.random.get_state()[1], state)
+
+if __name__ == "__main__":
+    test_seeded_batches()
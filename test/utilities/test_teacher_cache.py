@@ -0,0 +1,46 @@
+#########################################################################################################
+#----------This class represents the PyTests for the TeacherCache of the distillation trainers.---------#
+#########################################################################################################
+
+import torch, tempfile
+from batchgenerators.utilities.file_and_folder_operations import *
+from nnunet_ext.utilities.teacher_cache import TeacherCache
+from nnunet_ext.utilities.seeded_batches import sample_keys
+
+def test_teacher_cache():
+    r"""This function is used to test that the TeacherCache restores the cached outputs and features of a batch and
+        only returns them for the exact same samples.
+    """
+    torch.manual_seed(0)
+    outputs = (torch.randn(2, 3, 16, 16), torch.randn(2, 3, 8, 8))
+    features = {'conv_blocks_context.0': torch.randn(2, 4, 16, 16)}
+    with tempfile.TemporaryDirectory() as folder:
+        cache = TeacherCache(join(folder, 'teacher_cache'), capacity=3)
+        keys = sample_keys('task_A', ['case_0', 'case_1'], seed=0)
+        assert cache.load(keys) is None
+        cache.store(keys, outputs, features)
+
+        # -- The samples are restored in half precision, also in another order -- #
+        restored, restored_features = cache.load(keys[::-1])
+        assert isinstance(restored, list) and len(restored) == 2
+        assert torch.allclose(restored[0], outputs[0][[1, 0]], atol=1e-2) and restored[0].dtype == torch.float32
+        assert torch.allclose(restored_features['conv_blocks_context.0'], features['conv_blocks_context.0'][[1, 0]], atol=1e-2)
+
+        # -- Another crop and augmentation of the same case is another sample -- #
+        assert cache.load(sample_keys('task_A', ['case_0', 'case_1'], seed=1)) is None
+
+        # -- The oldest sample is replaced once the cache is full -- #
+        other = sample_keys('task_A', ['case_2', 'case_3'], seed=0)
+        cache.store(other, outputs, features)
+        assert cache.load(keys[:1]) is None and cache.load(keys[1:]) is not None and cache.load(other) is not None
+
+        # -- With top-k only the largest logits are exact and the arg max is preserved -- #
+        cache_topk = TeacherCache(join(folder, 'teacher_cache_topk'), capacity=2, topk=1)
+        cache_topk.store(keys, outputs[0])
+        restored, _ = cache_topk.load(keys)
+        assert torch.equal(restored.argmax(1), outputs[0].argmax(1))
+        cache_topk.reset()
+        assert not isdir(join(folder, 'teacher_cache_topk'))
+
+if __name__ == "__main__":
+    test_teacher_cache()
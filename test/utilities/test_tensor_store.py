@@ -0,0 +1,45 @@
+#########################################################################################################
+#----------This class represents the PyTests for the TensorStore of the EWC based trainers.-------------#
+#########################################################################################################
+
+import os, torch, tempfile
+from batchgenerators.utilities.file_and_folder_operations import *
+from nnunet_ext.utilities.tensor_store import TensorStore, LazyTensorDict, load_tensor_values
+
+def test_tensor_store():
+    r"""This function is used to test that the TensorStore restores the stored values, loads them lazily and only
+        rewrites the tasks that changed.
+    """
+    torch.manual_seed(0)
+    values = {task: {'conv.weight': torch.randn(4, 3, 3, 3), 'conv.bias': torch.randn(4), 'count': torch.arange(5)}
+              for task in ['task_A', 'task_B']}
+    with tempfile.TemporaryDirectory() as folder:
+        store = TensorStore(join(folder, 'fisher_values'))
+        store.save(values)
+
+        # -- Every value is restored exactly and the tasks are only loaded when they are accessed -- #
+        restored = load_tensor_values(join(folder, 'fisher_values'))
+        assert isinstance(restored, LazyTensorDict) and list(restored.keys()) == ['task_A', 'task_B']
+        assert len(restored._loaded) == 0, "No task should be loaded before it is accessed."
+        for name, value in values['task_B'].items():
+            assert torch.equal(restored['task_B'][name], value) and restored['task_B'][name].dtype == value.dtype
+        assert list(restored._loaded.keys()) == ['task_B'], "Only the accessed task should be loaded."
+
+        # -- Only the changed task is written again, removed tasks are removed from the store -- #
+        file_a = store.index['tasks']['task_A']['file']
+        restored['task_C'] = {'conv.bias': torch.ones(4)}
+        del restored['task_B']
+        store.save(restored, ['task_C'])
+        assert store.tasks() == ['task_A', 'task_C'] and store.index['tasks']['task_A']['file'] == file_a
+        assert sorted(f for f in os.listdir(join(folder, 'fisher_values')) if f.endswith('.bin')) == ['task_A.0.bin', 'task_C.0.bin']
+        assert torch.equal(TensorStore(join(folder, 'fisher_values')).load_task('task_C')['conv.bias'], torch.ones(4))
+
+        # -- Half precision storage restores the original dtype -- #
+        store_fp16 = TensorStore(join(folder, 'fp16'), fp16=True)
+        store_fp16.save_task('task_A', values['task_A'])
+        restored = store_fp16.load_task('task_A')
+        assert restored['conv.weight'].dtype == torch.float32 and torch.allclose(restored['conv.weight'], values['task_A']['conv.weight'], atol=1e-2)
+        assert torch.equal(restored['count'], values['task_A']['count'])
+
+if __name__ == "__main__":
+    test_tensor_store()